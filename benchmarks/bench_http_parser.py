@@ -0,0 +1,144 @@
+"""HTTP 请求头解析基准测试
+
+比较按行切分并构建首部字典的解析方式与 pyproxy.http 基于偏移量的解析方式,
+请求头分别一次性到达和按 segment 字节分段到达.
+
+    PYTHONPATH=. python benchmarks/bench_http_parser.py --number 20000 --segment 64
+"""
+import json
+import sys
+import time
+
+from typing import Callable, Dict, List
+
+import typer
+
+from pyproxy.http import HEAD_END, HttpStream, read_request
+
+_typer = typer.Typer()
+
+CORPUS: Dict[str, bytes] = {
+    'curl': (b'GET http://example.com/ HTTP/1.1\r\n'
+             b'Host: example.com\r\n'
+             b'User-Agent: curl/7.88.1\r\n'
+             b'Accept: */*\r\n'
+             b'Proxy-Connection: Keep-Alive\r\n'
+             b'\r\n'),
+    'browser': (b'GET http://www.example.com/static/js/app.3f2a1b.js?v=20230101 HTTP/1.1\r\n'
+                b'Host: www.example.com\r\n'
+                b'Proxy-Connection: keep-alive\r\n'
+                b'User-Agent: Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 '
+                b'(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36\r\n'
+                b'Accept: */*\r\n'
+                b'Referer: http://www.example.com/index.html\r\n'
+                b'Accept-Encoding: gzip, deflate\r\n'
+                b'Accept-Language: zh-CN,zh;q=0.9,en;q=0.8\r\n'
+                b'Cookie: ' + b'; '.join(b'k%d=%s' % (i, b'v' * 24) for i in range(16)) + b'\r\n'
+                b'If-None-Match: "5f2a1b-3c4d"\r\n'
+                b'If-Modified-Since: Sat, 01 Jul 2023 00:00:00 GMT\r\n'
+                b'\r\n'),
+    'post': (b'POST http://api.example.com/v1/items HTTP/1.1\r\n'
+             b'Host: api.example.com\r\n'
+             b'Content-Type: application/json\r\n'
+             b'Content-Length: 27\r\n'
+             b'Authorization: Bearer ' + b'x' * 160 + b'\r\n'
+             b'Connection: keep-alive\r\n'
+             b'\r\n'
+             b'{"name": "item", "id": 123}'),
+    'connect': (b'CONNECT www.example.com:443 HTTP/1.1\r\n'
+                b'Host: www.example.com:443\r\n'
+                b'User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/115.0\r\n'
+                b'Proxy-Connection: keep-alive\r\n'
+                b'\r\n'),
+}
+
+
+def _legacy_parse(data: bytes):
+    """按行切分并构建首部字典"""
+    head, _, body = data.partition(HEAD_END)
+    lines = head.split(b'\r\n')
+    method, target, version = lines[0].split(b' ', 2)
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(b':')
+        headers[name.strip().lower()] = value.strip()
+    return method, target, version, headers.get(b'host'), headers.get(b'content-length'), body
+
+
+class _SegmentReader:
+    """按固定大小返回数据的 StreamReader 替身"""
+
+    def __init__(self, data: bytes, segment: int):
+        self._chunks = [data[i:i + segment] for i in range(0, len(data), segment)]
+        self._index = 0
+
+    async def read(self, n: int = -1) -> bytes:
+        if self._index >= len(self._chunks):
+            return b''
+        self._index += 1
+        return self._chunks[self._index - 1]
+
+
+def _run(coro):
+    # 数据全部就绪, 协程不会真正挂起
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    raise RuntimeError('parser suspended')
+
+
+async def _legacy_read(reader: _SegmentReader):
+    # 首部不完整时拼接缓冲区, 并重新查找整个缓冲区
+    buffer = b''
+    while HEAD_END not in buffer:
+        chunk = await reader.read()
+        if not chunk:
+            raise EOFError
+        buffer += chunk
+    return _legacy_parse(buffer)
+
+
+async def _offset_read(reader: _SegmentReader):
+    stream = HttpStream(reader)  # type: ignore
+    request = await read_request(stream)
+    return request.method, request.target, request.version, request.get_header(b'host'), \
+        request.get_header(b'content-length'), stream.leftover()
+
+
+def _timeit(func: Callable[[], object], number: int) -> float:
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return time.perf_counter() - start
+
+
+@_typer.command()
+def main(
+    number: int = typer.Option(20000,
+                               '--number',
+                               help='每个请求的解析次数'),
+    segment: int = typer.Option(64,
+                                '--segment',
+                                help='分段到达时每段的字节数'),
+):
+    results: List[dict] = []
+    for name, data in CORPUS.items():
+        assert _run(_legacy_read(_SegmentReader(data, segment))) == _run(_offset_read(_SegmentReader(data, segment)))
+        cases = {
+            'legacy': lambda: _run(_legacy_read(_SegmentReader(data, len(data)))),
+            'offset': lambda: _run(_offset_read(_SegmentReader(data, len(data)))),
+            'legacy-segmented': lambda: _run(_legacy_read(_SegmentReader(data, segment))),
+            'offset-segmented': lambda: _run(_offset_read(_SegmentReader(data, segment))),
+        }
+        for parser, func in cases.items():
+            elapsed = _timeit(func, number)
+            result = {'request': name, 'parser': parser, 'size': len(data), 'ns_per_op': elapsed / number * 1e9}
+            results.append(result)
+            print(f'{name:>8} {parser:>17}: {result["ns_per_op"]:10.0f} ns/op  ({len(data)} bytes)', file=sys.stderr)
+
+    print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    _typer()
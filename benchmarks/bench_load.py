@@ -0,0 +1,499 @@
+"""端到端负载与延迟基准测试
+
+不依赖外部网络: 在独立进程中启动本地 TCP echo、HTTP 源服务器与 UDP echo, 再以子进程启动代理,
+由多个并发客户端分别测试以下场景, 统计吞吐量、每秒完成的操作数与 p50/p99/p999 延迟:
+
+- socks5-connect: 每次操作新建 SOCKS5 CONNECT 隧道, 往返 size 字节后关闭
+- http-connect: 每次操作新建 HTTP CONNECT 隧道, 往返 size 字节后关闭
+- socks5-stream: 每个客户端保持一个 SOCKS5 隧道, 连续往返 size 字节
+- http: 每个客户端保持一个 keep-alive 连接, 连续发送普通 HTTP 请求, 响应体为 size 字节
+- udp: 每个客户端建立一个 UDP ASSOCIATE, 连续往返 size 字节的数据报, 1 秒未收到回复计为丢失
+- idle: 建立 idle 个空闲隧道, 统计代理进程每个连接占用的内存(RSS)
+
+结果以 JSON 输出, 可以通过 --output 保存, 并通过 --baseline 与另一次的结果比较.
+
+    PYTHONPATH=. python benchmarks/bench_load.py --concurrency 64 --duration 5 --output HEAD.json
+    PYTHONPATH=. python benchmarks/bench_load.py --proxy-args '--relay stream' --baseline HEAD.json
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shlex
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Tuple
+
+import typer
+
+from pyproxy.const import EventLoop
+from pyproxy.utils import install_event_loop
+
+_typer = typer.Typer()
+
+SCENARIOS = ['socks5-connect', 'http-connect', 'socks5-stream', 'http', 'udp', 'idle']
+UDP_TIMEOUT = 1.0
+
+
+class Stats:
+
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.ops = 0
+        self.bytes = 0
+        self.errors = 0
+        self.lost = 0
+
+    def merge(self, other: 'Stats'):
+        self.latencies += other.latencies
+        self.ops += other.ops
+        self.bytes += other.bytes
+        self.errors += other.errors
+        self.lost += other.lost
+
+
+# 源服务器
+
+
+async def _echo(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while True:
+            data = await reader.read(2**16)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+def _http_origin(body: bytes):
+    response = b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body)
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                await reader.readuntil(b'\r\n\r\n')
+                writer.write(response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+class _UdpEcho(asyncio.DatagramProtocol):
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.transport.sendto(data, addr)
+
+
+def _serve_origins(tcp: socket.socket, http: socket.socket, udp: socket.socket, size: int):
+    install_event_loop(EventLoop.AUTO)
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        await asyncio.start_server(_echo, sock=tcp, backlog=4096)
+        await asyncio.start_server(_http_origin(bytes(size)), sock=http, backlog=4096)
+        await loop.create_datagram_endpoint(_UdpEcho, sock=udp)
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+# 客户端
+
+
+async def _socks5_open(proxy: Tuple[str, int], dst: Tuple[str, int], cmd: int = 1):
+    reader, writer = await asyncio.open_connection(*proxy)
+    writer.write(b'\x05\x01\x00')
+    await reader.readexactly(2)
+    writer.write(b'\x05' + bytes((cmd, )) + b'\x00\x01' + socket.inet_aton(dst[0]) + struct.pack('>H', dst[1]))
+    reply = await reader.readexactly(10)
+    if reply[1] != 0:
+        writer.close()
+        raise ConnectionError(f'socks5 reply {reply[1]}')
+    return reader, writer, reply
+
+
+async def _http_connect_open(proxy: Tuple[str, int], dst: Tuple[str, int]):
+    reader, writer = await asyncio.open_connection(*proxy)
+    writer.write(b'CONNECT %s:%d HTTP/1.1\r\n\r\n' % (dst[0].encode(), dst[1]))
+    head = await reader.readuntil(b'\r\n\r\n')
+    if head.split(b' ', 2)[1] != b'200':
+        writer.close()
+        raise ConnectionError(head.split(b'\r\n', 1)[0].decode())
+    return reader, writer
+
+
+async def _roundtrip(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, payload: bytes):
+    writer.write(payload)
+    await reader.readexactly(len(payload))
+
+
+async def _connect_client(ctx: Dict[str, Any], stats: Stats, deadline: float):
+    payload = ctx['payload']
+    open_tunnel = ctx['open']
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            stream = await open_tunnel(ctx['proxy'], ctx['echo'])
+            reader, writer = stream[0], stream[1]
+            await _roundtrip(reader, writer, payload)
+            writer.close()
+        except (OSError, asyncio.IncompleteReadError) as e:
+            stats.errors += 1
+            ctx['verbose'] and print(f'error: {e!r}', file=sys.stderr)  # type: ignore
+            await asyncio.sleep(0.01)
+            continue
+        stats.latencies.append(time.perf_counter() - start)
+        stats.ops += 1
+        stats.bytes += len(payload)
+
+
+async def _stream_client(ctx: Dict[str, Any], stats: Stats, deadline: float):
+    payload = ctx['payload']
+    reader, writer, _ = await _socks5_open(ctx['proxy'], ctx['echo'])
+    try:
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            await _roundtrip(reader, writer, payload)
+            stats.latencies.append(time.perf_counter() - start)
+            stats.ops += 1
+            stats.bytes += len(payload)
+    finally:
+        writer.close()
+
+
+async def _http_client(ctx: Dict[str, Any], stats: Stats, deadline: float):
+    host, port = ctx['http']
+    request = b'GET http://%s:%d/ HTTP/1.1\r\nHost: %s:%d\r\n\r\n' % (host.encode(), port, host.encode(), port)
+    reader, writer = await asyncio.open_connection(*ctx['proxy'])
+    try:
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            writer.write(request)
+            head = await reader.readuntil(b'\r\n\r\n')
+            length = int(head.lower().split(b'content-length:', 1)[1].split(b'\r\n', 1)[0])
+            await reader.readexactly(length)
+            stats.latencies.append(time.perf_counter() - start)
+            stats.ops += 1
+            stats.bytes += length
+    finally:
+        writer.close()
+
+
+class _UdpClient(asyncio.DatagramProtocol):
+
+    def __init__(self):
+        self.waiter: Optional[asyncio.Future] = None
+
+    def datagram_received(self, data, addr):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(data)
+
+
+async def _udp_client(ctx: Dict[str, Any], stats: Stats, deadline: float):
+    loop = asyncio.get_running_loop()
+    _, control, reply = await _socks5_open(ctx['proxy'], ('0.0.0.0', 0), cmd=3)
+    relay = (socket.inet_ntoa(reply[4:8]), struct.unpack('>H', reply[8:10])[0])
+    dst = ctx['udp']
+    packet = b'\x00\x00\x00\x01' + socket.inet_aton(dst[0]) + struct.pack('>H', dst[1]) + ctx['payload']
+    transport, protocol = await loop.create_datagram_endpoint(_UdpClient, remote_addr=relay)
+    try:
+        while time.perf_counter() < deadline:
+            protocol.waiter = loop.create_future()
+            start = time.perf_counter()
+            transport.sendto(packet)
+            try:
+                await asyncio.wait_for(protocol.waiter, UDP_TIMEOUT)
+            except asyncio.TimeoutError:
+                stats.lost += 1
+                continue
+            stats.latencies.append(time.perf_counter() - start)
+            stats.ops += 1
+            stats.bytes += len(ctx['payload'])
+    finally:
+        transport.close()
+        control.close()
+
+
+_CLIENTS: Dict[str, Callable[[Dict[str, Any], Stats, float], Coroutine]] = {
+    'socks5-connect': _connect_client,
+    'http-connect': _connect_client,
+    'socks5-stream': _stream_client,
+    'http': _http_client,
+    'udp': _udp_client,
+}
+
+
+def _run_clients(scenario: str, ctx: Dict[str, Any], concurrency: int, duration: float) -> Stats:
+    """在当前进程中运行 concurrency 个客户端, 可以在多个进程中并行调用"""
+    install_event_loop(EventLoop.AUTO)
+    ctx = dict(ctx, open=_http_connect_open if scenario == 'http-connect' else _socks5_open)
+
+    async def main():
+        deadline = time.perf_counter() + duration
+        stats = [Stats() for _ in range(concurrency)]
+        results = await asyncio.gather(
+            *(_CLIENTS[scenario](ctx, s, deadline) for s in stats), return_exceptions=True
+        )
+        total = Stats()
+        for s, result in zip(stats, results):
+            total.merge(s)
+            if isinstance(result, BaseException):
+                total.errors += 1
+                ctx['verbose'] and print(f'client failed: {result!r}', file=sys.stderr)  # type: ignore
+        return total
+
+    return asyncio.run(main())
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def _rss(pid: int) -> int:
+    """进程及其子进程(多进程模式的 worker)的 RSS, 单位字节"""
+    total = 0
+    pids = [pid]
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            pids += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    for p in pids:
+        try:
+            with open(f'/proc/{p}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+def _idle(ctx: Dict[str, Any], count: int, pid: int) -> dict:
+    install_event_loop(EventLoop.AUTO)
+
+    async def main():
+        before = _rss(pid)
+        tunnels = []
+        errors = 0
+        for i in range(0, count, 100):
+            results = await asyncio.gather(
+                *(_socks5_open(ctx['proxy'], ctx['echo']) for _ in range(min(100, count - i))), return_exceptions=True
+            )
+            for result in results:
+                if isinstance(result, BaseException):
+                    errors += 1
+                else:
+                    tunnels.append(result)
+        await asyncio.sleep(0.5)
+        after = _rss(pid)
+        for _, writer, _ in tunnels:
+            writer.close()
+        opened = len(tunnels)
+        return {
+            'connections': opened,
+            'errors': errors,
+            'rss_before': before,
+            'rss_after': after,
+            'rss_per_connection': (after - before) / opened if opened else 0,
+        }
+
+    return asyncio.run(main())
+
+
+def _wait_listening(port: int):
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'proxy on port {port} not ready')
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _bind(type_: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, type_)
+    sock.bind(('127.0.0.1', 0))
+    if type_ == socket.SOCK_STREAM:
+        sock.listen(4096)
+    return sock
+
+
+def _compare(results: List[dict], path: str):
+    with open(path) as f:
+        baseline = {r['scenario']: r for r in json.load(f)['results']}
+    keys = ('ops_per_sec', 'mib_per_sec', 'p50_ms', 'p99_ms', 'p999_ms', 'rss_per_connection')
+    for result in results:
+        base = baseline.get(result['scenario'])
+        if base is None:
+            continue
+        changes = []
+        for key in keys:
+            if base.get(key) and key in result:
+                changes.append(f'{key} {(result[key] / base[key] - 1) * 100:+.1f}%')
+        print(f'{result["scenario"]:>15} vs baseline: {", ".join(changes)}', file=sys.stderr)
+
+
+@_typer.command()
+def main(
+    scenarios: str = typer.Option(','.join(SCENARIOS),
+                                  '--scenarios',
+                                  help='逗号分隔的测试场景'),
+    concurrency: int = typer.Option(64,
+                                    '--concurrency',
+                                    help='每个客户端进程的并发客户端数'),
+    processes: int = typer.Option(1,
+                                  '--processes',
+                                  help='客户端进程数, 单个 Python 进程不足以压满代理时增加'),
+    duration: float = typer.Option(5,
+                                   '--duration',
+                                   help='每个场景的持续时间, 单位秒'),
+    size: int = typer.Option(1024,
+                             '--size',
+                             help='每次往返的数据量与 HTTP 响应体大小, 单位字节'),
+    idle: int = typer.Option(2000,
+                             '--idle',
+                             help='idle 场景建立的空闲隧道数量'),
+    port: int = typer.Option(7950,
+                             '--port',
+                             help='代理监听端口'),
+    proxy_args: str = typer.Option('',
+                                   '--proxy-args',
+                                   help="传给代理的额外参数, 如 '--relay stream --workers 2'"),
+    output: str = typer.Option('',
+                               '--output',
+                               help='结果保存路径'),
+    baseline: str = typer.Option('',
+                                 '--baseline',
+                                 help='用于比较的另一次结果'),
+    verbose: bool = typer.Option(False,
+                                 '--verbose',
+                                 help='输出客户端错误'),
+):
+    # 空闲隧道与并发客户端需要较多的文件描述符
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    tcp, http, udp = _bind(socket.SOCK_STREAM), _bind(socket.SOCK_STREAM), _bind(socket.SOCK_DGRAM)
+    origins = multiprocessing.Process(target=_serve_origins, args=(tcp, http, udp, size), daemon=True)
+    origins.start()
+    ctx = {
+        'proxy': ('127.0.0.1', port),
+        'echo': tcp.getsockname(),
+        'http': http.getsockname(),
+        'udp': udp.getsockname(),
+        'payload': bytes(size),
+        'verbose': verbose,
+    }
+
+    args = [
+        sys.executable,
+        '-m',
+        'pyproxy.console',
+        '--host',
+        '127.0.0.1',
+        '--port',
+        str(port),
+        '--proxy_port',
+        str(port),
+        '--log_level',
+        '40',
+        '--soft_limit',
+        str(hard - 1),
+        *shlex.split(proxy_args),
+    ]
+    proc = subprocess.Popen(args)
+    results = []
+    try:
+        _wait_listening(port)
+        for scenario in scenarios.split(','):
+            scenario = scenario.strip()
+            if scenario == 'idle':
+                result = {'scenario': scenario, **_idle(ctx, idle, proc.pid)}
+                print(
+                    f'{scenario:>15}: {result["connections"]} connections, '
+                    f'{result["rss_per_connection"] / 1024:.1f} KiB/connection',
+                    file=sys.stderr
+                )
+                results.append(result)
+                continue
+            if scenario not in _CLIENTS:
+                raise typer.BadParameter(f'unknown scenario: {scenario}')
+
+            with multiprocessing.Pool(processes) as pool:
+                parts = pool.starmap(_run_clients, [(scenario, ctx, concurrency, duration)] * processes)
+            stats = Stats()
+            for part in parts:
+                stats.merge(part)
+            latencies = sorted(stats.latencies)
+            result = {
+                'scenario': scenario,
+                'clients': concurrency * processes,
+                'duration': duration,
+                'size': size,
+                'ops': stats.ops,
+                'errors': stats.errors,
+                'lost': stats.lost,
+                'ops_per_sec': stats.ops / duration,
+                'mib_per_sec': stats.bytes / duration / 2**20,
+                'p50_ms': _percentile(latencies, 0.5) * 1000,
+                'p99_ms': _percentile(latencies, 0.99) * 1000,
+                'p999_ms': _percentile(latencies, 0.999) * 1000,
+                'rss': _rss(proc.pid),
+            }
+            results.append(result)
+            print(
+                f'{scenario:>15}: {result["ops_per_sec"]:10.0f} ops/s {result["mib_per_sec"]:8.1f} MiB/s  '
+                f'p50 {result["p50_ms"]:.2f}ms p99 {result["p99_ms"]:.2f}ms p999 {result["p999_ms"]:.2f}ms  '
+                f'errors {stats.errors} lost {stats.lost}',
+                file=sys.stderr
+            )
+    finally:
+        proc.terminate()
+        proc.wait()
+        origins.terminate()
+
+    report = {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'proxy_args': proxy_args,
+        'results': results,
+    }
+    if baseline:
+        _compare(results, baseline)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report))
+
+
+if __name__ == '__main__':
+    _typer()
@@ -0,0 +1,184 @@
+"""空闲隧道内存基准测试
+
+代理在子进程中运行并开启 tracemalloc, 本进程启动 TCP echo 服务器并建立大量 SOCKS5 CONNECT 隧道,
+每个隧道往返一个字节后保持空闲, 统计代理进程每个隧道占用的 Python 堆内存(tracemalloc)与 RSS.
+建立隧道之前先预热一轮, 不计入缓冲区池、模块导入等一次性分配.
+
+splice 引擎每个隧道在代理进程中额外占用两个管道(4 个文件描述符), 隧道数量受文件描述符上限限制.
+
+    PYTHONPATH=. python benchmarks/bench_memory.py --tunnels 5000 --engines buffered,stream
+    PYTHONPATH=. python benchmarks/bench_memory.py --loop uvloop --output memory.json
+"""
+import asyncio
+import gc
+import json
+import logging
+import multiprocessing
+import resource
+import socket
+import struct
+import sys
+import time
+import tracemalloc
+
+from multiprocessing.connection import Connection
+from typing import List, Tuple
+
+import typer
+
+from pyproxy.console import start_server
+from pyproxy.const import EventLoop
+from pyproxy.utils import install_event_loop
+
+_typer = typer.Typer()
+
+
+def _rss() -> int:
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def _serve_proxy(port: int, engine: str, loop: str, conn: Connection):
+    install_event_loop(EventLoop(loop))
+    logging.basicConfig(level=logging.ERROR)
+    tracemalloc.start()
+
+    def on_request():
+        conn.recv()
+        gc.collect()
+        conn.send({'traced': tracemalloc.get_traced_memory()[0], 'rss': _rss()})
+
+    async def main():
+        asyncio.get_running_loop().add_reader(conn.fileno(), on_request)
+        await start_server('127.0.0.1', port, proxy_addr='127.0.0.1', proxy_port=port, relay=engine, idle_timeout=0)
+
+    asyncio.run(main())
+
+
+async def _echo(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while True:
+            data = await reader.read(1024)
+            if not data:
+                break
+            writer.write(data)
+    except (ConnectionError, asyncio.CancelledError):
+        # 结束测试时仍未关闭的连接
+        pass
+    writer.close()
+
+
+async def _open_tunnel(port: int, dst: Tuple[str, int]) -> asyncio.StreamWriter:
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'\x05\x01\x00')
+    await reader.readexactly(2)
+    writer.write(b'\x05\x01\x00\x01' + socket.inet_aton(dst[0]) + struct.pack('>H', dst[1]))
+    reply = await reader.readexactly(10)
+    if reply[1] != 0:
+        raise ConnectionError(f'socks5 reply {reply[1]}')
+    # 往返一个字节, 确认隧道已进入转发阶段
+    writer.write(b'x')
+    await reader.readexactly(1)
+    return writer
+
+
+async def _open_tunnels(port: int, dst: Tuple[str, int], count: int) -> List[asyncio.StreamWriter]:
+    writers: List[asyncio.StreamWriter] = []
+    for i in range(0, count, 200):
+        writers += await asyncio.gather(*(_open_tunnel(port, dst) for _ in range(min(200, count - i))))
+    return writers
+
+
+def _measure(engine: str, loop: str, tunnels: int, port: int) -> dict:
+    parent, child = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=_serve_proxy, args=(port, engine, loop, child), daemon=True)
+    proc.start()
+
+    def snapshot() -> dict:
+        parent.send('snapshot')
+        return parent.recv()
+
+    async def main():
+        echo = await asyncio.start_server(_echo, '127.0.0.1', 0, backlog=4096)
+        dst = echo.sockets[0].getsockname()
+        for _ in range(100):
+            try:
+                (await _open_tunnel(port, dst)).close()
+                break
+            except OSError:
+                await asyncio.sleep(0.05)
+
+        for writer in await _open_tunnels(port, dst, min(tunnels, 1000)):
+            writer.close()
+            await writer.wait_closed()
+        await asyncio.sleep(1)
+        before = snapshot()
+        writers = await _open_tunnels(port, dst, tunnels)
+        await asyncio.sleep(1)
+        after = snapshot()
+        for writer in writers:
+            writer.close()
+        await asyncio.gather(*(writer.wait_closed() for writer in writers), return_exceptions=True)
+        await asyncio.sleep(1)
+        echo.close()
+        return before, after
+
+    try:
+        before, after = asyncio.run(main())
+    finally:
+        proc.terminate()
+        proc.join()
+    return {
+        'engine': engine,
+        'loop': loop,
+        'tunnels': tunnels,
+        'traced_per_tunnel': (after['traced'] - before['traced']) / tunnels,
+        'rss_per_tunnel': (after['rss'] - before['rss']) / tunnels,
+    }
+
+
+@_typer.command()
+def main(
+    tunnels: int = typer.Option(2000,
+                                '--tunnels',
+                                help='空闲隧道数量'),
+    engines: str = typer.Option('buffered,stream,splice',
+                                '--engines',
+                                help='测试的转发引擎, 以逗号分隔'),
+    loop: EventLoop = typer.Option(EventLoop.ASYNCIO,
+                                   '--loop',
+                                   help='代理使用的事件循环'),
+    port: int = typer.Option(7960,
+                             '--port',
+                             help='代理监听端口'),
+    output: str = typer.Option('',
+                               '--output',
+                               help='保存 JSON 结果的文件'),
+):
+    # 每个隧道在本进程与代理进程中各占用 2 个文件描述符
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    results = []
+    for engine in engines.split(','):
+        result = _measure(engine.strip(), loop.value, tunnels, port)
+        results.append(result)
+        print(
+            f'{result["engine"]:>10}: {result["traced_per_tunnel"] / 1024:6.2f} KiB traced, '
+            f'{result["rss_per_tunnel"] / 1024:6.2f} KiB RSS per tunnel',
+            file=sys.stderr
+        )
+        time.sleep(0.5)
+
+    report = json.dumps({'results': results})
+    if output:
+        with open(output, 'w') as f:
+            f.write(report)
+    print(report)
+
+
+if __name__ == '__main__':
+    _typer()
@@ -0,0 +1,118 @@
+"""转发引擎吞吐量基准测试
+
+比较 stream(receive_and_forward)、buffered(BufferedProtocol) 与 splice(2) 三种转发引擎,
+源服务器通过 SOCKS5 CONNECT 隧道向客户端发送固定大小的数据, 统计吞吐量.
+
+    PYTHONPATH=. python benchmarks/bench_relay.py --size 1024 --rounds 3
+"""
+import json
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from typing import List
+
+import socks
+import typer
+
+from pyproxy.const import RelayEngine
+
+_typer = typer.Typer()
+
+SOURCE_ADDR = ('127.0.0.1', 31400)
+CHUNK = 2**18
+
+
+def _source_server(sock: socket.socket, size: int):
+    payload = memoryview(bytes(CHUNK))
+    while True:
+        conn, _ = sock.accept()
+        with conn:
+            remain = size
+            while remain > 0:
+                n = min(remain, CHUNK)
+                conn.sendall(payload[:n])
+                remain -= n
+
+
+def _wait_listening(port: int):
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'proxy on port {port} not ready')
+
+
+def _download(port: int, size: int) -> float:
+    s = socks.socksocket()
+    s.set_proxy(socks.SOCKS5, '127.0.0.1', port)
+    s.connect(SOURCE_ADDR)
+    buf = bytearray(CHUNK)
+    received = 0
+    start = time.perf_counter()
+    while True:
+        n = s.recv_into(buf)
+        if not n:
+            break
+        received += n
+    elapsed = time.perf_counter() - start
+    s.close()
+    assert received == size, (received, size)
+    return elapsed
+
+
+@_typer.command()
+def main(
+    size: int = typer.Option(512,
+                             '--size',
+                             help='每轮传输的数据量, 单位 MiB'),
+    rounds: int = typer.Option(3,
+                               '--rounds',
+                               help='每种引擎的测试轮数'),
+    port: int = typer.Option(7900,
+                             '--port',
+                             help='代理监听端口'),
+):
+    total = size * 2**20
+    server = socket.create_server(SOURCE_ADDR, reuse_port=True)
+    threading.Thread(target=_source_server, args=(server, total), daemon=True).start()
+
+    results = []
+    for engine in RelayEngine:
+        args = [
+            sys.executable,
+            '-m',
+            'pyproxy.console',
+            '--host',
+            '127.0.0.1',
+            '--port',
+            str(port),
+            '--proxy_port',
+            str(port),
+            '--log_level',
+            '40',
+            '--relay',
+            engine.value,
+        ]
+        proc = subprocess.Popen(args)
+        try:
+            _wait_listening(port)
+            elapsed: List[float] = [_download(port, total) for _ in range(rounds)]
+        finally:
+            proc.terminate()
+            proc.wait()
+
+        best = min(elapsed)
+        result = {'engine': engine.value, 'size': total, 'best': best, 'mib_per_sec': size / best}
+        results.append(result)
+        print(f'{engine.value:>10}: {size / best:10.1f} MiB/s  (best of {rounds}, {best:.3f}s)', file=sys.stderr)
+
+    print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    _typer()
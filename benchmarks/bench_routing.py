@@ -0,0 +1,115 @@
+"""路由规则基准测试
+
+生成指定数量的随机规则(80% 域名后缀, 15% IPv4 地址段, 5% IPv6 地址段), 测试编译耗时、内存占用,
+以及命中/未命中域名规则、IPv4/IPv6 地址在不使用缓存(match)与命中决策缓存(route)时的每秒查找次数.
+
+    PYTHONPATH=. python benchmarks/bench_routing.py --rules 500000 --number 200000
+"""
+import json
+import random
+import socket
+import string
+import sys
+import time
+import tracemalloc
+
+from typing import Callable, Dict, List
+
+import typer
+
+from pyproxy.const import RouteAction
+from pyproxy.routing import Router, RuleSet
+
+_typer = typer.Typer()
+
+ACTIONS = [action.value for action in RouteAction]
+TLDS = ['com', 'net', 'org', 'cn', 'io', 'co.uk']
+
+
+def _label(rng: random.Random) -> str:
+    return ''.join(rng.choices(string.ascii_lowercase + string.digits, k=rng.randint(3, 12)))
+
+
+def _generate(count: int, rng: random.Random) -> List[str]:
+    lines = []
+    for i in range(count):
+        kind = i % 20
+        action = rng.choice(ACTIONS)
+        if kind < 16:
+            domain = '.'.join([_label(rng) for _ in range(rng.randint(1, 2))] + [rng.choice(TLDS)])
+            lines.append(f'domain-suffix,{domain},{action}')
+        elif kind < 19:
+            prefixlen = rng.randint(8, 32)
+            network = rng.getrandbits(32) >> (32 - prefixlen) << (32 - prefixlen)
+            lines.append(f'ip-cidr,{socket.inet_ntoa(network.to_bytes(4, "big"))}/{prefixlen},{action}')
+        else:
+            prefixlen = rng.randint(16, 64)
+            network = rng.getrandbits(128) >> (128 - prefixlen) << (128 - prefixlen)
+            addr = socket.inet_ntop(socket.AF_INET6, network.to_bytes(16, 'big'))
+            lines.append(f'ip-cidr6,{addr}/{prefixlen},{action}')
+    return lines
+
+
+def _targets(lines: List[str], number: int, rng: random.Random) -> Dict[str, List[str]]:
+    domains = [line.split(',')[1] for line in lines if line.startswith('domain-suffix')]
+    return {
+        # 规则域名的子域名, 需要逐级查找后缀
+        'domain-hit': [f'www.{_label(rng)}.{rng.choice(domains)}' for _ in range(number)],
+        'domain-miss': [f'{_label(rng)}.{_label(rng)}.example' for _ in range(number)],
+        'ipv4': [socket.inet_ntoa(rng.getrandbits(32).to_bytes(4, 'big')) for _ in range(number)],
+        'ipv6': [socket.inet_ntop(socket.AF_INET6, rng.getrandbits(128).to_bytes(16, 'big')) for _ in range(number)],
+    }
+
+
+def _timeit(func: Callable[[str], object], targets: List[str]) -> float:
+    start = time.perf_counter()
+    for target in targets:
+        func(target)
+    return time.perf_counter() - start
+
+
+@_typer.command()
+def main(
+    rules: int = typer.Option(500000,
+                              '--rules',
+                              help='规则数量'),
+    number: int = typer.Option(200000,
+                               '--number',
+                               help='每种目标地址的查找次数'),
+    seed: int = typer.Option(0,
+                             '--seed',
+                             help='随机数种子'),
+):
+    rng = random.Random(seed)
+    lines = _generate(rules, rng)
+
+    start = time.perf_counter()
+    rule_set = RuleSet.parse(lines)
+    compile_seconds = time.perf_counter() - start
+    tracemalloc.start()
+    traced = RuleSet.parse(lines)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del traced
+    print(f'{len(rule_set)} rules, compile {compile_seconds:.2f}s, {memory / 2**20:.1f} MiB', file=sys.stderr)
+
+    results: List[dict] = [{'case': 'compile', 'rules': len(rule_set), 'seconds': compile_seconds, 'bytes': memory}]
+    router = Router(rule_set)
+    for name, targets in _targets(lines, number, rng).items():
+        # 缓存命中: 只查找少量热点地址
+        hot = targets[:min(len(targets), Router.CACHE_SIZE // 4)]
+        hot_targets = [rng.choice(hot) for _ in range(number)]
+        for target in hot:
+            router.route(target)
+        cases = {'match': (rule_set.match, targets), 'route-cached': (router.route, hot_targets)}
+        for mode, (func, workload) in cases.items():
+            elapsed = _timeit(func, workload)
+            result = {'case': name, 'mode': mode, 'rules': len(rule_set), 'lookups_per_sec': number / elapsed}
+            results.append(result)
+            print(f'{name:>12} {mode:>12}: {result["lookups_per_sec"]:12.0f} lookups/s', file=sys.stderr)
+
+    print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    _typer()
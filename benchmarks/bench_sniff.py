@@ -0,0 +1,78 @@
+"""嗅探解析基准测试
+
+测试每个连接嗅探域名的解析开销: 完整的 TLS ClientHello、分两段到达的 ClientHello(每段解析一次)、
+HTTP 请求, 以及需要立即放弃的其他协议(SSH 等服务器先发送数据的协议不会进入解析).
+
+    PYTHONPATH=. python benchmarks/bench_sniff.py --number 200000
+"""
+import json
+import ssl
+import sys
+import time
+
+from typing import Callable, Dict, List
+
+import typer
+
+from pyproxy.sniff import sniff_host
+
+_typer = typer.Typer()
+
+
+def _client_hello(server_hostname: str) -> bytes:
+    context = ssl.create_default_context()
+    incoming, outgoing = ssl.MemoryBIO(), ssl.MemoryBIO()
+    tls = context.wrap_bio(incoming, outgoing, server_hostname=server_hostname)
+    try:
+        tls.do_handshake()
+    except ssl.SSLWantReadError:
+        pass
+    return outgoing.read()
+
+
+def _split(data: bytes) -> Callable[[], object]:
+    first, buffer = data[:len(data) // 2], bytearray(data)
+
+    def run():
+        sniff_host(first)
+        return sniff_host(buffer)
+
+    return run
+
+
+@_typer.command()
+def main(number: int = typer.Option(200000,
+                                    '--number',
+                                    help='每种数据的解析次数'),
+         ):
+    hello = _client_hello('www.example.com')
+    request = (b'GET /static/app.js HTTP/1.1\r\n'
+               b'Host: www.example.com\r\n'
+               b'User-Agent: Mozilla/5.0 (X11; Linux x86_64)\r\n'
+               b'Accept: */*\r\n'
+               b'Accept-Encoding: gzip, deflate\r\n'
+               b'\r\n')
+    cases: Dict[str, Callable[[], object]] = {
+        'tls': lambda: sniff_host(hello),
+        'tls-split': _split(hello),
+        'http': lambda: sniff_host(request),
+        'other': lambda: sniff_host(b'\x00\x00\x00\x2c\x0a\x15' + bytes(40)),
+    }
+    sizes = {'tls': len(hello), 'tls-split': len(hello), 'http': len(request), 'other': 46}
+
+    results: List[dict] = []
+    for name, func in cases.items():
+        assert func() != '', name
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        result = {'case': name, 'size': sizes[name], 'ns_per_op': elapsed / number * 1e9}
+        results.append(result)
+        print(f'{name:>10}: {result["ns_per_op"]:8.0f} ns/op ({sizes[name]} bytes)', file=sys.stderr)
+
+    print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    _typer()
@@ -0,0 +1,104 @@
+"""SOCKS5 地址解析基准测试
+
+比较原先按切片复制头部与消息体的解析方式与 Socks5ProxyParser.parse,
+分别测试 IPv4/IPv6/HOST 地址的首次解析(缓存未命中)、重复头部(缓存命中)与不合法的数据报.
+
+    PYTHONPATH=. python benchmarks/bench_socks5_parser.py --number 200000 --payload 1400
+"""
+import json
+import logging
+import os
+import socket
+import struct
+import sys
+import time
+
+from typing import Callable, Dict, List
+
+import typer
+
+from pyproxy.utils import Socks5ProxyParser
+
+_typer = typer.Typer()
+
+logger = logging.getLogger(__name__)
+
+HEADERS: Dict[str, bytes] = {
+    'ipv4': b'\x00\x00\x00\x01' + socket.inet_aton('192.168.1.1') + struct.pack('>H', 53),
+    'ipv6': b'\x00\x00\x00\x04' + socket.inet_pton(socket.AF_INET6, '2001:db8::8:1') + struct.pack('>H', 443),
+    'host': b'\x00\x00\x00\x03\x0fwww.example.com' + struct.pack('>H', 8080),
+}
+
+# 截断的 HOST 地址, 模拟扫描或攻击时的不合法数据报
+MALFORMED = b'\x00\x00\x00\x03\x40www.example.com'
+
+
+def _legacy_unpack(data: bytes):
+    """原先的实现: 复制头部与消息体, 任何异常都记录完整的调用栈"""
+    dst = ('', 0)
+    message = b''
+    header = b''
+    try:
+        atyp = data[3]
+        if atyp == 1:
+            dst = (socket.inet_ntop(socket.AF_INET, data[4:8]), int.from_bytes(data[8:10], 'big'))
+            header, message = data[:10], data[10:]
+        elif atyp == 4:
+            dst = (socket.inet_ntop(socket.AF_INET6, data[4:20]), int.from_bytes(data[20:22], 'big'))
+            header, message = data[:22], data[22:]
+        elif atyp == 3:
+            length = data[4]
+            dst = (data[5:5 + length].decode(), struct.unpack('>H', data[5 + length:7 + length])[0])
+            header, message = data[:7 + length], data[7 + length:]
+    except Exception as e:
+        logger.exception(e)
+    return dst, header, message
+
+
+def _parse(data: bytes):
+    result = Socks5ProxyParser.parse(data)
+    if result is None:
+        return None
+    return result[0], memoryview(data)[result[1]:]
+
+
+def _parse_cold(data: bytes):
+    Socks5ProxyParser._cache.clear()
+    return _parse(data)
+
+
+def _timeit(func: Callable[[bytes], object], data: bytes, number: int) -> float:
+    start = time.perf_counter()
+    for _ in range(number):
+        func(data)
+    return time.perf_counter() - start
+
+
+@_typer.command()
+def main(
+    number: int = typer.Option(200000,
+                               '--number',
+                               help='每种数据报的解析次数'),
+    payload: int = typer.Option(1400,
+                                '--payload',
+                                help='消息体大小, 单位字节'),
+):
+    # 与默认配置一致, 异常日志输出到 stderr 会掩盖解析本身的开销, 这里丢弃输出
+    logging.basicConfig(stream=open(os.devnull, 'w'), level=logging.INFO)
+
+    results: List[dict] = []
+    datagrams = {name: header + bytes(payload) for name, header in HEADERS.items()}
+    datagrams['malformed'] = MALFORMED
+    for name, data in datagrams.items():
+        cases = {'legacy': _legacy_unpack, 'parse-cold': _parse_cold, 'parse': _parse}
+        for parser, func in cases.items():
+            elapsed = _timeit(func, data, number)
+            result = {'address': name, 'parser': parser, 'size': len(data), 'ns_per_op': elapsed / number * 1e9}
+            results.append(result)
+            print(f'{name:>10} {parser:>10}: {result["ns_per_op"]:10.0f} ns/op', file=sys.stderr)
+
+    print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    _typer()
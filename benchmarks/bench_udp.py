@@ -0,0 +1,134 @@
+"""SOCKS5 UDP 转发吞吐量基准测试
+
+启动代理与 UDP echo 服务器子进程, 客户端通过 UDP ASSOCIATE 建立关联后保持 window 个数据报在途,
+统计每秒往返的数据报数量(pps).
+
+    PYTHONPATH=. python benchmarks/bench_udp.py --duration 5 --window 64 --size 64
+"""
+import json
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+import typer
+
+_typer = typer.Typer()
+
+ECHO_ADDR = ('127.0.0.1', 31402)
+
+_ECHO_SERVER = f'''
+import socket
+sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+sock.bind({ECHO_ADDR!r})
+while True:
+    data, addr = sock.recvfrom(65536)
+    sock.sendto(data, addr)
+'''
+
+
+def _wait_listening(port: int) -> socket.socket:
+    for _ in range(100):
+        try:
+            return socket.create_connection(('127.0.0.1', port), timeout=1)
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'proxy on port {port} not ready')
+
+
+def _associate(control: socket.socket):
+    control.sendall(b'\x05\x01\x00')
+    assert control.recv(2) == b'\x05\x00'
+    control.sendall(b'\x05\x03\x00\x01' + bytes(6))
+    reply = control.recv(10)
+    assert reply[1] == 0, reply
+    return socket.inet_ntoa(reply[4:8]), struct.unpack('>H', reply[8:10])[0]
+
+
+def _run(relay_addr, duration: float, window: int, size: int) -> dict:
+    header = b'\x00\x00\x00\x01' + socket.inet_aton(ECHO_ADDR[0]) + struct.pack('>H', ECHO_ADDR[1])
+    packet = header + bytes(size)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect(relay_addr)
+    sock.settimeout(0.5)
+
+    sent = received = lost = 0
+    # 建立关联, 并预热
+    for _ in range(10):
+        sock.send(packet)
+        try:
+            sock.recv(65536)
+        except socket.timeout:
+            pass
+
+    start = time.perf_counter()
+    deadline = start + duration
+    for _ in range(window):
+        sock.send(packet)
+        sent += 1
+    while time.perf_counter() < deadline:
+        try:
+            data = sock.recv(65536)
+        except socket.timeout:
+            # 丢包时补发, 保持在途数量
+            lost += 1
+            sock.send(packet)
+            sent += 1
+            continue
+        assert data == packet
+        received += 1
+        sock.send(packet)
+        sent += 1
+    elapsed = time.perf_counter() - start
+    sock.close()
+    return {'pps': received / elapsed, 'sent': sent, 'received': received, 'timeouts': lost}
+
+
+@_typer.command()
+def main(
+    duration: float = typer.Option(5,
+                                   '--duration',
+                                   help='测试时长, 单位秒'),
+    window: int = typer.Option(64,
+                               '--window',
+                               help='在途数据报数量'),
+    size: int = typer.Option(64,
+                             '--size',
+                             help='数据报负载大小, 单位字节'),
+    port: int = typer.Option(7901,
+                             '--port',
+                             help='代理监听端口'),
+):
+    echo = subprocess.Popen([sys.executable, '-c', _ECHO_SERVER])
+    proxy = subprocess.Popen([
+        sys.executable,
+        '-m',
+        'pyproxy.console',
+        '--host',
+        '127.0.0.1',
+        '--port',
+        str(port),
+        '--proxy_port',
+        str(port),
+        '--log_level',
+        '40',
+    ])
+    try:
+        control = _wait_listening(port)
+        relay_addr = _associate(control)
+        result = {'window': window, 'size': size, **_run(relay_addr, duration, window, size)}
+        control.close()
+    finally:
+        proxy.terminate()
+        echo.terminate()
+        proxy.wait()
+        echo.wait()
+
+    print(f'{result["pps"]:10.0f} pps  (window {window}, payload {size} bytes, timeouts {result["timeouts"]})',
+          file=sys.stderr)
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    _typer()
@@ -0,0 +1,125 @@
+"""UDP 关联超时检查基准测试
+
+模拟大量 UDP 关联, 在第一个超时周期内逐步建立, 之后每秒有一部分关联收到数据报,
+比较原先每秒全量扫描活跃时间表的方式与时间轮, 统计每秒超时检查的 CPU 时间与每次记录活跃时间的开销.
+时间由模拟时钟推进, 不实际等待.
+
+    PYTHONPATH=. python benchmarks/bench_udp_expiry.py --associations 100000 --seconds 120
+"""
+import json
+import random
+import sys
+import time
+
+from typing import Callable, Dict, List, Tuple
+
+import typer
+
+from pyproxy.timerwheel import TimerWheel
+
+_typer = typer.Typer()
+
+_Addr = Tuple[str, int]
+
+
+class _LegacyExpiry:
+    """原先的实现: 每个数据报调用 time.time(), 每秒复制并遍历全部关联"""
+
+    def __init__(self, timeout: float, on_expire: Callable[[_Addr], None]):
+        self.timeout = timeout
+        self._on_expire = on_expire
+        self._last_activity: Dict[_Addr, float] = {}
+
+    def touch(self, addr: _Addr, now: float):
+        time.time()
+        self._last_activity[addr] = now
+
+    def advance(self, now: float):
+        for addr in list(self._last_activity.keys()):
+            if self._last_activity[addr] + self.timeout >= now:
+                continue
+            del self._last_activity[addr]
+            self._on_expire(addr)
+
+
+class _WheelExpiry:
+
+    def __init__(self, timeout: float, on_expire: Callable[[_Addr], None]):
+        self._wheel: TimerWheel[_Addr] = TimerWheel(timeout, on_expire)
+
+    def touch(self, addr: _Addr, now: float):
+        self._wheel.add(addr)
+
+    def advance(self, now: float):
+        self._wheel.advance(now)
+
+
+def _simulate(factory, associations: int, seconds: int, active: float, timeout: float) -> dict:
+    rnd = random.Random(0)
+    addrs = [(f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}', 10000 + i % 50000) for i in range(associations)]
+    expired: List[_Addr] = []
+    expiry = factory(timeout, expired.append)
+    # 预热: 在第一个超时周期内逐步建立全部关联
+    warmup = int(timeout)
+    per_second = -(-associations // warmup)
+    for now in range(warmup):
+        for addr in addrs[now * per_second:(now + 1) * per_second]:
+            expiry.touch(addr, now)
+        expiry.advance(now)
+
+    tick_costs: List[float] = []
+    touch_cost = 0.0
+    touches = 0
+    for now in range(warmup, warmup + seconds):
+        # 每秒有 active 比例的关联收到数据报, 超时的关联重新建立
+        batch = rnd.sample(addrs, int(associations * active))
+        start = time.perf_counter()
+        for addr in batch:
+            expiry.touch(addr, now)
+        touch_cost += time.perf_counter() - start
+        touches += len(batch)
+
+        start = time.perf_counter()
+        expiry.advance(now)
+        tick_costs.append(time.perf_counter() - start)
+
+    tick_costs.sort()
+    return {
+        'tick_ms_mean': sum(tick_costs) / len(tick_costs) * 1e3,
+        'tick_ms_p99': tick_costs[int(len(tick_costs) * 0.99)] * 1e3,
+        'tick_ms_max': tick_costs[-1] * 1e3,
+        'touch_ns': touch_cost / touches * 1e9,
+        'expired': len(expired),
+    }
+
+
+@_typer.command()
+def main(
+    associations: int = typer.Option(100000,
+                                     '--associations',
+                                     help='UDP 关联数量'),
+    seconds: int = typer.Option(120,
+                                '--seconds',
+                                help='模拟运行的秒数'),
+    active: float = typer.Option(0.1,
+                                 '--active',
+                                 help='每秒收到数据报的关联比例'),
+    timeout: float = typer.Option(60,
+                                  '--timeout',
+                                  help='UDP 关联空闲超时时间, 单位秒'),
+):
+    results = []
+    for name, factory in (('full-scan', _LegacyExpiry), ('timer-wheel', _WheelExpiry)):
+        result = {'expiry': name, 'associations': associations, **_simulate(factory, associations, seconds, active, timeout)}
+        results.append(result)
+        print(
+            f'{name:>12}: tick mean {result["tick_ms_mean"]:8.2f} ms, p99 {result["tick_ms_p99"]:8.2f} ms, '
+            f'max {result["tick_ms_max"]:8.2f} ms, touch {result["touch_ns"]:6.0f} ns, expired {result["expired"]}',
+            file=sys.stderr
+        )
+
+    print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    _typer()
@@ -0,0 +1,94 @@
+import json
+import logging
+import queue
+import sys
+
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import IO, Optional, Tuple
+
+
+class _JsonFormatter(logging.Formatter):
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'time': self.formatTime(record), **record.access}  # type: ignore
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _QueueHandler(QueueHandler):
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 记录不跨进程传递, 格式化留给监听线程
+        return record
+
+
+class _BatchStreamHandler(logging.StreamHandler):
+    """队列中还有待写入的记录时不刷新, 连续的记录合并为一次写入"""
+
+    def __init__(self, stream: IO[str], pending: queue.SimpleQueue):
+        super().__init__(stream)
+        self._pending = pending
+
+    def flush(self):
+        if self._pending.empty():
+            super().flush()
+
+
+class AccessLog:
+    """访问日志, 每个连接或 UDP 关联结束时记录一条 JSON
+
+    record 只把日志记录放入队列, 由 QueueListener 的线程格式化并写入, 事件循环不等待磁盘 I/O.
+    path 为 '-' 时写入标准输出.
+    """
+
+    def __init__(self, path: str):
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._stream: IO[str] = sys.stdout if path == '-' else open(path, 'a', encoding='utf-8')
+        handler = _BatchStreamHandler(self._stream, self._queue)
+        handler.setFormatter(_JsonFormatter())
+        self._listener = QueueListener(self._queue, handler)
+        # 独立的 logger, 不传播到 root logger
+        self._logger = logging.Logger('pyproxy.access')
+        self._logger.addHandler(_QueueHandler(self._queue))
+        self._listener.start()
+
+    def record(
+        self,
+        client: Optional[Tuple[str, int]],
+        target: Optional[Tuple[str, int]],
+        cmd: str,
+        bytes_in: int,
+        bytes_out: int,
+        duration: float,
+        reason: str,
+        user: Optional[str] = None,
+        host: Optional[str] = None,
+    ):
+        """bytes_in 为从客户端读取的字节数, bytes_out 为从目标服务器读取的字节数, user 为通过认证的用户名,
+        host 为目标为 IP 时嗅探到的域名
+        """
+        access = {
+            'client': f'{client[0]}:{client[1]}' if client else None,
+            'user': user,
+            'target': f'{target[0]}:{target[1]}' if target else None,
+            'host': host,
+            'cmd': cmd,
+            'bytes_in': bytes_in,
+            'bytes_out': bytes_out,
+            'duration': round(duration, 6),
+            'reason': reason,
+        }
+        self._logger.info('access', extra={'access': access})
+
+    def close(self):
+        self._listener.stop()
+        self._stream.flush()
+        if self._stream is not sys.stdout:
+            self._stream.close()
+
+
+_access_log: ContextVar[Optional[AccessLog]] = ContextVar('access_log', default=None)
+
+
+def get_access_log() -> Optional[AccessLog]:
+    return _access_log.get()
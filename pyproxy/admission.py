@@ -0,0 +1,128 @@
+import asyncio
+import logging
+
+from contextvars import ContextVar
+from typing import Callable, Dict, Optional
+
+from pyproxy import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class LoopLagMonitor:
+    """每 interval 秒调度一次回调, 实际执行时间与预期的差值即事件循环延迟
+
+    lag 取本次采样与上次衰减值中的较大者, 负载下降后逐步回落, 避免准入状态频繁切换.
+    """
+
+    DECAY = 0.8
+
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.lag = 0.0
+        self._expected = 0.0
+        self._handle: Optional[asyncio.TimerHandle] = None
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self._expected = loop.time() + self.interval
+        self._handle = loop.call_at(self._expected, self._on_tick, loop)
+
+    def _on_tick(self, loop: asyncio.AbstractEventLoop):
+        now = loop.time()
+        self.lag = max(now - self._expected, self.lag * self.DECAY)
+        self._expected = now + self.interval
+        self._handle = loop.call_at(self._expected, self._on_tick, loop)
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+
+class AdmissionControl:
+    """客户端连接的准入控制, 0 表示不限制
+
+    - max_connections: 全局并发连接数上限
+    - max_connections_per_ip: 每个客户端 IP 的并发连接数上限
+    - max_loop_lag: 事件循环延迟超过该值(秒)时拒绝新连接
+    """
+
+    def __init__(self, max_connections: int = 0, max_connections_per_ip: int = 0, max_loop_lag: float = 0):
+        self.max_connections = max_connections
+        self.max_connections_per_ip = max_connections_per_ip
+        self.max_loop_lag = max_loop_lag
+        self.connections = 0
+        self._ips: Dict[str, int] = {}
+        self.monitor = LoopLagMonitor()
+
+    def admit(self, ip: str) -> bool:
+        """允许时计入连接数, 连接结束后需要调用 release"""
+        if self.max_connections and self.connections >= self.max_connections:
+            metrics.ADMISSION_REJECTED_MAX_CONNECTIONS.inc()
+            return False
+        count = self._ips.get(ip, 0)
+        if self.max_connections_per_ip and count >= self.max_connections_per_ip:
+            metrics.ADMISSION_REJECTED_MAX_CONNECTIONS_PER_IP.inc()
+            return False
+        if self.max_loop_lag and self.monitor.lag > self.max_loop_lag:
+            metrics.ADMISSION_REJECTED_OVERLOAD.inc()
+            return False
+        self.connections += 1
+        self._ips[ip] = count + 1
+        return True
+
+    def release(self, ip: str):
+        self.connections -= 1
+        count = self._ips[ip] - 1
+        if count:
+            self._ips[ip] = count
+        else:
+            del self._ips[ip]
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self.monitor.start(loop)
+
+    def close(self):
+        self.monitor.stop()
+
+
+_admission: ContextVar[AdmissionControl] = ContextVar('admission')
+
+
+def get_admission() -> AdmissionControl:
+    admission = _admission.get(None)
+    if admission is None:
+        admission = AdmissionControl()
+        _admission.set(admission)
+    return admission
+
+
+class IdleTimer:
+    """空闲超时, 每 timeout 秒比较一次 activity 的返回值, 没有变化时调用 on_idle
+
+    转发路径只需要累加字节数, 不记录时间戳. 空闲的连接在 timeout 到 2 * timeout 秒之间关闭.
+    """
+
+    __slots__ = ('timeout', '_activity', '_on_idle', '_last', '_loop', '_handle')
+
+    def __init__(self, timeout: float, activity: Callable[[], int], on_idle: Callable[[], None]):
+        self.timeout = timeout
+        self._activity = activity
+        self._on_idle = on_idle
+        self._last = activity()
+        self._loop = asyncio.get_running_loop()
+        self._handle: Optional[asyncio.TimerHandle] = self._loop.call_later(timeout, self._on_tick)
+
+    def _on_tick(self):
+        current = self._activity()
+        if current == self._last:
+            self._handle = None
+            self._on_idle()
+            return
+        self._last = current
+        self._handle = self._loop.call_later(self.timeout, self._on_tick)
+
+    def cancel(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
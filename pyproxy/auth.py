@@ -0,0 +1,215 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import importlib
+import logging
+import os
+import secrets
+import sys
+import threading
+
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+
+from pyproxy import metrics
+
+logger = logging.getLogger(__name__)
+
+ALGORITHM = 'pbkdf2_sha256'
+ITERATIONS = 200000
+
+
+def hash_password(password: str, iterations: int = ITERATIONS, salt: Optional[bytes] = None) -> str:
+    salt = salt or secrets.token_bytes(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+    return f'{ALGORITHM}${iterations}${base64.b64encode(salt).decode()}${base64.b64encode(digest).decode()}'
+
+
+def check_password(password: str, encoded: str) -> bool:
+    try:
+        algorithm, iterations, salt, expected = encoded.split('$')
+        if algorithm != ALGORITHM:
+            return False
+        digest = hashlib.pbkdf2_hmac('sha256', password.encode(), base64.b64decode(salt), int(iterations))
+        return hmac.compare_digest(digest, base64.b64decode(expected))
+    except ValueError:
+        return False
+
+
+class AuthBackend:
+    """认证后端, verify 可能很慢(哈希计算、网络请求), 在线程池中调用"""
+
+    def verify(self, username: str, password: str) -> bool:
+        raise NotImplementedError
+
+
+class FileBackend(AuthBackend):
+    """从凭据文件读取用户, 文件修改后自动重新读取
+
+    每行一个用户, 密码以加盐的 PBKDF2-SHA256 哈希保存, # 开头为注释:
+
+        alice:pbkdf2_sha256$200000$<salt>$<hash>
+
+    哈希通过 `python -m pyproxy.auth <password>` 生成.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._users: Dict[str, str] = {}
+        self._mtime = 0.0
+        self._lock = threading.Lock()
+        # 不存在的用户也计算一次哈希, 不通过响应时间暴露用户是否存在
+        self._dummy = hash_password(secrets.token_hex(8))
+        self._load()
+
+    def _load(self):
+        mtime = os.stat(self.path).st_mtime
+        if mtime == self._mtime:
+            return
+        users = {}
+        with open(self.path, encoding='utf-8') as f:
+            for lineno, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                username, sep, encoded = line.partition(':')
+                if not sep or not encoded.startswith(ALGORITHM + '$'):
+                    raise ValueError(f'invalid credential at line {lineno} of {self.path}')
+                users[username] = encoded
+        self._users, self._mtime = users, mtime
+        logger.info(f'loaded {len(users)} users from {self.path}')
+
+    def verify(self, username: str, password: str) -> bool:
+        with self._lock:
+            try:
+                self._load()
+            except (OSError, ValueError) as e:
+                logger.error(f'reload credentials failed, keep current users: {e!r}')
+        encoded = self._users.get(username)
+        if encoded is None:
+            check_password(password, self._dummy)
+            return False
+        return check_password(password, encoded)
+
+
+def load_backend(spec: str) -> AuthBackend:
+    """按 module:attr 加载自定义认证后端, attr 为不需要参数的类或工厂函数"""
+    module, _, attr = spec.partition(':')
+    if not attr:
+        raise ValueError(f'invalid auth backend: {spec}, expected module:attr')
+    return getattr(importlib.import_module(module), attr)()
+
+
+_CacheValue = Tuple[float, bool]
+
+
+class Authenticator:
+    """带缓存的认证
+
+    - 后端在线程池中调用, 不阻塞事件循环
+    - 认证结果按用户名与密码的摘要缓存, 缓存中不保存明文密码, 容量有上限, 超出时按 LRU 淘汰
+    - 失败的结果缓存 negative_ttl 秒, 重复的错误密码不会重复计算哈希
+    - 同一凭据的并发认证合并为一次
+
+    SOCKS5 UDP 数据报本身不携带凭据, 只转发已通过认证的 UDP ASSOCIATE 控制连接所在 IP 的数据报.
+    """
+
+    def __init__(self, backend: AuthBackend, maxsize: int = 4096, ttl: float = 300, negative_ttl: float = 5):
+        self.backend = backend
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._cache: 'OrderedDict[bytes, _CacheValue]' = OrderedDict()
+        self._inflight: Dict[bytes, asyncio.Future] = {}
+        self._udp_clients: Dict[str, int] = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    async def authenticate(self, username: str, password: str) -> bool:
+        loop = asyncio.get_running_loop()
+        key = hashlib.sha256(f'{len(username)}:{username}{password}'.encode()).digest()
+        cached = self._cache.get(key)
+        if cached is not None:
+            expire, ok = cached
+            if expire > loop.time():
+                self.hits += 1
+                self._cache.move_to_end(key)
+                (metrics.AUTH_SUCCESS if ok else metrics.AUTH_FAILURE).inc()
+                return ok
+            del self._cache[key]
+
+        fut = self._inflight.get(key)
+        if fut is None:
+            self.misses += 1
+            fut = loop.create_task(self._verify(key, username, password))
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda _: self._inflight.pop(key, None))
+        ok = await asyncio.shield(fut)
+        (metrics.AUTH_SUCCESS if ok else metrics.AUTH_FAILURE).inc()
+        return ok
+
+    async def _verify(self, key: bytes, username: str, password: str) -> bool:
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            ok = bool(await loop.run_in_executor(None, self.backend.verify, username, password))
+        except Exception as e:
+            # 后端异常时认证失败, 不缓存结果
+            logger.warning(f'[Authenticator] verify {username!r} failed: {e!r}')
+            return False
+        finally:
+            metrics.AUTH_SECONDS_ALL.observe(loop.time() - start)
+        ttl = self.ttl if ok else self.negative_ttl
+        if ttl > 0 and self.maxsize > 0:
+            self._cache[key] = (loop.time() + ttl, ok)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return ok
+
+    def allow_udp(self, ip: str):
+        self._udp_clients[ip] = self._udp_clients.get(ip, 0) + 1
+
+    def disallow_udp(self, ip: str):
+        count = self._udp_clients.get(ip, 0) - 1
+        if count > 0:
+            self._udp_clients[ip] = count
+        else:
+            self._udp_clients.pop(ip, None)
+
+    def udp_allowed(self, ip: str) -> bool:
+        return ip in self._udp_clients
+
+    def clear(self):
+        self._cache.clear()
+
+
+_authenticator: ContextVar[Optional[Authenticator]] = ContextVar('authenticator', default=None)
+
+
+def get_authenticator() -> Optional[Authenticator]:
+    return _authenticator.get()
+
+
+def parse_basic_auth(value: bytes) -> Optional[Tuple[str, str]]:
+    """解析 Proxy-Authorization: Basic 首部, 格式不正确时返回 None"""
+    scheme, _, token = value.strip().partition(b' ')
+    if scheme.lower() != b'basic':
+        return None
+    try:
+        decoded = base64.b64decode(token.strip(), validate=True).decode()
+    except (ValueError, UnicodeDecodeError):
+        return None
+    username, sep, password = decoded.partition(':')
+    if not sep:
+        return None
+    return username, password
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('usage: python -m pyproxy.auth <password>', file=sys.stderr)
+        sys.exit(2)
+    print(hash_password(sys.argv[1]))
@@ -0,0 +1,75 @@
+from typing import Dict, List
+
+MIN_READ_SIZE = 2**12
+MAX_READ_SIZE = 2**18
+INITIAL_READ_SIZE = 2**14
+
+
+class ReadSize:
+    """按最近的读取量调整单次读取的大小
+
+    读满时加倍, 连续 SHRINK_AFTER 次读取不足四分之一时减半, 大小保持为 2 的幂.
+    交互式的隧道(ssh 等)很快缩小到 MIN_READ_SIZE, 大量下载增长到 MAX_READ_SIZE, 减少读取次数.
+    """
+
+    __slots__ = ('size', '_small')
+
+    SHRINK_AFTER = 4
+
+    def __init__(self, size: int = INITIAL_READ_SIZE):
+        self.size = size
+        self._small = 0
+
+    def update(self, nbytes: int):
+        size = self.size
+        if nbytes >= size:
+            self._small = 0
+            if size < MAX_READ_SIZE:
+                self.size = size << 1
+        elif nbytes <= size >> 2 and size > MIN_READ_SIZE:
+            self._small += 1
+            if self._small >= self.SHRINK_AFTER:
+                self._small = 0
+                self.size = size >> 1
+        else:
+            self._small = 0
+
+
+class BufferPool:
+    """按大小分级的读缓冲区池
+
+    连接只在读取时从池中取出缓冲区, 数据写入对端后归还, 空闲的隧道不占用缓冲区.
+    每一级保留的缓冲区总大小不超过 limit, 超出时交给垃圾回收.
+    list 的 append/pop 是原子操作, 多个线程中的事件循环共用同一个池也不需要加锁.
+    """
+
+    def __init__(self, limit: int = 2**22):
+        self.limit = limit
+        self._free: Dict[int, List[bytearray]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def acquire(self, size: int) -> bytearray:
+        try:
+            buffer = self._free[size].pop()
+        except (KeyError, IndexError):
+            self.misses += 1
+            return bytearray(size)
+        self.hits += 1
+        return buffer
+
+    def release(self, buffer: bytearray):
+        size = len(buffer)
+        free = self._free.setdefault(size, [])
+        if (len(free) + 1) * size <= self.limit:
+            free.append(buffer)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(size * len(free) for size, free in list(self._free.items()))
+
+    def clear(self):
+        self._free.clear()
+
+
+BUFFER_POOL = BufferPool()
@@ -0,0 +1,137 @@
+import asyncio
+import itertools
+import logging
+import socket
+
+from typing import List, Optional, Set, Tuple
+
+from pyproxy import metrics
+from pyproxy.resolver import get_resolver
+from pyproxy.settings import _settings
+from pyproxy.sockopts import get_socket_options
+
+logger = logging.getLogger(__name__)
+
+_Stream = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+
+async def open_connection(
+    host: str,
+    port: int,
+    *,
+    delay: Optional[float] = None,
+    timeout: Optional[float] = None,
+) -> _Stream:
+    """连接目标服务器
+
+    域名解析出多个地址时按 Happy Eyeballs(RFC 8305) 交替 IPv6/IPv4 地址, 每隔 delay 秒发起一次新的连接,
+    先建立的连接胜出. timeout 为包含域名解析在内的总超时时间.
+    """
+    settings = _settings.get(None)
+    if delay is None:
+        delay = settings.happy_eyeballs_delay if settings else 0.25
+    if timeout is None:
+        timeout = settings.connect_timeout if settings else 10
+
+    async def connect():
+        addrs = interleave(await get_resolver().resolve(host))
+        if len(addrs) == 1:
+            return await connect_addr(addrs[0], port)
+        return await _happy_eyeballs(addrs, port, delay)
+
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    try:
+        stream = await asyncio.wait_for(connect(), timeout)
+    except (OSError, asyncio.TimeoutError):
+        metrics.UPSTREAM_CONNECT_ERRORS_ALL.inc()
+        raise
+    metrics.UPSTREAM_CONNECT_SECONDS_ALL.observe(loop.time() - start)
+    return stream
+
+
+async def connect_addr(addr: str, port: int) -> _Stream:
+    """连接一个 IP 地址, 按 SocketOptions 设置 socket 参数
+
+    缓冲区大小与 TCP Fast Open 需要在 connect 之前设置, 这时自行创建 socket.
+    """
+    options = get_socket_options()
+    if options.pre_connect:
+        loop = asyncio.get_running_loop()
+        sock = options.create_connection_socket(socket.AF_INET6 if ':' in addr else socket.AF_INET)
+        try:
+            await loop.sock_connect(sock, (addr, port))
+        except BaseException:
+            sock.close()
+            raise
+        reader, writer = await asyncio.open_connection(sock=sock)
+    else:
+        reader, writer = await asyncio.open_connection(addr, port)
+    options.apply(writer.get_extra_info('socket'))
+    return reader, writer
+
+
+def interleave(addrs: List[str]) -> List[str]:
+    """按 RFC 8305 交替排列两种地址族, 首个地址的地址族优先"""
+    v6 = [addr for addr in addrs if ':' in addr]
+    v4 = [addr for addr in addrs if ':' not in addr]
+    if not v6 or not v4:
+        return addrs
+
+    first, second = (v6, v4) if ':' in addrs[0] else (v4, v6)
+    return [addr for pair in itertools.zip_longest(first, second) for addr in pair if addr is not None]
+
+
+def _close_loser(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is None:
+        task.result()[1].close()
+
+
+async def _happy_eyeballs(addrs: List[str], port: int, delay: float) -> _Stream:
+    attempts = iter(addrs)
+    pending: Set[asyncio.Task] = set()
+    exceptions: List[OSError] = []
+    winner: Optional[_Stream] = None
+
+    try:
+        while winner is None:
+            addr = next(attempts, None)
+            if addr is not None:
+                pending.add(asyncio.ensure_future(connect_addr(addr, port)))
+            if not pending:
+                break
+
+            # 还有未尝试的地址时最多等待 delay 秒, 任一连接失败则立即尝试下一个地址
+            done, pending = await asyncio.wait(
+                pending,
+                timeout=delay if addr is not None else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for task in done:
+                exc = task.exception()
+                if exc is None:
+                    if winner is None:
+                        winner = task.result()
+                    else:
+                        task.result()[1].close()
+                elif isinstance(exc, OSError):
+                    logger.debug(f'happy eyeballs attempt failed: {exc!r}')
+                    exceptions.append(exc)
+                else:
+                    raise exc
+    except BaseException:
+        if winner is not None:
+            winner[1].close()
+        raise
+    finally:
+        # 取消时已经建立的连接由回调关闭, 回调在任务结束后执行
+        for task in pending:
+            task.cancel()
+            task.add_done_callback(_close_loser)
+
+    if winner is not None:
+        return winner
+
+    if len({e.errno for e in exceptions}) == 1:
+        raise exceptions[0]
+    raise OSError(f'Multiple exceptions: {", ".join(str(e) for e in exceptions)}')
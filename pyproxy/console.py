@@ -1,17 +1,33 @@
 import asyncio
 import logging
+import socket
 import urllib.request
 
-from typing import Optional
+from typing import List, Optional
 
 import typer
 
 import pyproxy
 
+from pyproxy import metrics
+from pyproxy.accesslog import AccessLog, _access_log
+from pyproxy.admission import AdmissionControl, _admission
+from pyproxy.auth import Authenticator, FileBackend, _authenticator, load_backend
+from pyproxy.buffers import BUFFER_POOL
+from pyproxy.const import EventLoop, RelayEngine, TransparentMode, UpstreamStrategy
+from pyproxy.lifecycle import HandoffServer, Lifecycle, _lifecycle, confirm_takeover, take_over
+from pyproxy.pool import ConnectionPool, _pool
 from pyproxy.protocols.socks5 import SocksProtocol
-from pyproxy.protocols.udp import UdpProtocol
+from pyproxy.protocols.transparent import TransparentUdpServer, transparent_socket
+from pyproxy.protocols.udp import UdpAssociationTable, UdpServer, _udp_associations
+from pyproxy.ratelimit import RateLimiter, _rate_limiter
+from pyproxy.resolver import Resolver, _resolver
+from pyproxy.routing import Router, _router
 from pyproxy.settings import _settings
-from pyproxy.utils import initialize
+from pyproxy.sockopts import TCP_DEFER_ACCEPT, SocketOptions, _socket_options
+from pyproxy.upstream import UpstreamGroup, _upstream
+from pyproxy.utils import initialize, install_event_loop
+from pyproxy.workers import Supervisor, get_release_bus
 
 _typer = typer.Typer()
 logger = logging.getLogger(__name__)
@@ -19,34 +35,151 @@ logger = logging.getLogger(__name__)
 
 async def start_server(host: str, port: int, **kwargs):
     token = initialize(host=host, port=port, **kwargs)
+    settings = _settings.get()
+    resolver = Resolver(settings.dns_cache_size, settings.dns_cache_ttl, settings.dns_negative_ttl)
+    _resolver.set(resolver)
+    pool = ConnectionPool(
+        settings.http_pool_max_idle,
+        settings.http_pool_max_age,
+        settings.http_pool_idle_timeout,
+        settings.http_pool_max_per_host,
+    )
+    _pool.set(pool)
+    socket_options = SocketOptions.from_settings(settings)
+    _socket_options.set(socket_options)
+    udp_associations = UdpAssociationTable(settings.udp_keep_alive_timeout)
+    _udp_associations.set(udp_associations)
+    _rate_limiter.set(
+        RateLimiter(settings.rate_limit_connection, settings.rate_limit_ip, settings.rate_limit_global)
+    )
+    # 同一进程中可能运行多个服务, 各自注册采集函数, 停止时取消注册
+    unregister = [
+        metrics.UDP_ASSOCIATIONS.add_function(lambda: len(udp_associations)),
+        metrics.DNS_LOOKUPS.labels('hit').add_function(lambda: resolver.hits),
+        metrics.DNS_LOOKUPS.labels('miss').add_function(lambda: resolver.misses),
+        metrics.DNS_LOOKUPS.labels('coalesced').add_function(lambda: resolver.coalesced),
+    ]
+    # 缓冲区池由进程中的所有服务共用
+    metrics.RELAY_BUFFER_POOL.set_function(lambda: BUFFER_POOL.nbytes)
+    upstream = None
+    if settings.upstream:
+        upstream = UpstreamGroup.from_urls(
+            settings.upstream, settings.upstream_strategy, settings.upstream_warm, settings.upstream_check_interval
+        )
+        upstream.start()
+    _upstream.set(upstream)
+    authenticator = None
+    if settings.auth_backend or settings.auth_file:
+        backend = load_backend(settings.auth_backend) if settings.auth_backend else FileBackend(settings.auth_file)
+        authenticator = Authenticator(backend, settings.auth_cache_size, settings.auth_cache_ttl)
+        unregister.append(metrics.AUTH_CACHE.labels('hit').add_function(lambda: authenticator.hits))  # type: ignore
+        unregister.append(metrics.AUTH_CACHE.labels('miss').add_function(lambda: authenticator.misses))  # type: ignore
+    _authenticator.set(authenticator)
+    router = Router.from_file(settings.rules) if settings.rules else None
+    _router.set(router)
+    access_log = AccessLog(settings.access_log) if settings.access_log else None
+    _access_log.set(access_log)
+    metrics_server = None
+    if settings.metrics_port > 0:
+        metrics_server = await metrics.start_metrics_server(settings.metrics_host, settings.metrics_port)
+    # 回复给客户端的地址需要是 IPv4 地址
+    settings.proxy_addr = (await resolver.resolve(settings.proxy_addr, socket.AF_INET))[0]
 
     loop = asyncio.get_event_loop()
-    kws = {
-        'reuse_port': True,
-        'reuse_address': True,
-    }
+    lifecycle = Lifecycle(settings.drain_timeout)
+    _lifecycle.set(lifecycle)
+    lifecycle.install_signal_handlers(loop)
+    if router is not None:
+        router.install_signal_handler(loop)
+        if settings.rules_reload_interval > 0:
+            router.watch(settings.rules_reload_interval)
+        unregister.append(metrics.ROUTE_RULES.add_function(lambda: len(router.rules)))  # type: ignore
+    admission = AdmissionControl(settings.max_connections, settings.max_connections_per_ip, settings.max_loop_lag)
+    _admission.set(admission)
+    admission.start(loop)
+    unregister.append(metrics.EVENT_LOOP_LAG.add_function(lambda: admission.monitor.lag))
+
+    bus = get_release_bus()
+    if bus is not None:
+        bus.listen(loop)
+
+    # 从旧进程接管监听 socket: [TCP, UDP]
+    inherited = await take_over(settings.handoff_path) if settings.handoff_path else None
+    if inherited is not None:
+        (tcp_sock, udp_sock), channel = inherited
+        udp_server = await UdpServer.create(host, port, udp_sock)
+        # 接管的 socket 已经在监听, 新进程的设置可能与旧进程不同, 在 start_server 重新 listen 之前设置
+        socket_options.apply_listen(tcp_sock)
+        server = await asyncio.start_server(SocksProtocol.handler, sock=tcp_sock, backlog=socket_options.backlog)
+        confirm_takeover(channel)
+        logger.info(f'took over listening sockets on {host}:{port}')
+    else:
+        udp_server = await UdpServer.create(host, port)
+        infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)
+        family, _, _, _, sockaddr = infos[0]
+        tcp_sock = socket_options.create_listen_socket(family, sockaddr)
+        server = await asyncio.start_server(SocksProtocol.handler, sock=tcp_sock, backlog=socket_options.backlog)
+        logger.info(f'listening on {host}:{port}')
 
-    udp_waiter = loop.create_future()
-    asyncio.ensure_future(start_udp_server(udp_waiter, host, port))
+    # 透明代理的监听 socket 不参与交接, 新进程重新绑定
+    transparent_server = None
+    transparent_udp_server = None
+    if settings.transparent_port > 0:
+        mode = settings.transparent_mode
+        sock = await transparent_socket(host, settings.transparent_port, socket.SOCK_STREAM, mode)
+        socket_options.apply_listen(sock)
+        # SMTP、SSH 等由服务器先发送数据的协议, 客户端连接后不会发送数据
+        if TCP_DEFER_ACCEPT is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, TCP_DEFER_ACCEPT, 0)
+        transparent_server = await asyncio.start_server(
+            SocksProtocol.transparent_handler, sock=sock, backlog=socket_options.backlog
+        )
+        if mode == TransparentMode.TPROXY:
+            transparent_udp_server = await TransparentUdpServer.create(host, settings.transparent_port)
+        logger.info(f'transparent proxy ({mode.value}) listening on {host}:{settings.transparent_port}')
+
+    handoff = None
+    if settings.handoff_path:
+        handoff = HandoffServer(
+            settings.handoff_path, [server.sockets[0].fileno(), udp_server.sock.fileno()], lifecycle.handoff
+        )
+        await handoff.start()
 
-    server = await asyncio.start_server(SocksProtocol.handler, host, port, **kws)
-    logger.info(f'listening on {host}:{port}')
     try:
-        async with server:
-            await server.serve_forever()
-    except Exception:
-        pass
+        await lifecycle.wait_shutdown()
+        # 停止接受新连接, 交接后 accept 队列中的连接由新进程处理
+        server.close()
+        transparent_server and transparent_server.close()  # type: ignore
+        if lifecycle.handed_off:
+            udp_server.pause_reading()
+        await lifecycle.drain()
     finally:
+        server.close()
+        transparent_server and transparent_server.close()  # type: ignore
+        handoff and handoff.close()  # type: ignore
+        admission.close()
+        udp_server.close()
+        transparent_udp_server and transparent_udp_server.close()  # type: ignore
+        if metrics_server is not None:
+            metrics_server.close()
+        pool.close()
+        upstream and upstream.close()  # type: ignore
+        router and router.close()  # type: ignore
+        udp_associations.close()
+        if access_log is not None:
+            access_log.close()
+        for remove in unregister:
+            remove()
         _settings.reset(token)
-    # TODO: 支持暂停或关闭服务
+        logger.info('server stopped')
 
 
-async def start_udp_server(waiter: asyncio.Future, host: str, port: int):
-    loop = asyncio.get_event_loop()
-    transport, _ = await loop.create_datagram_endpoint(UdpProtocol, local_addr=(host, port), reuse_port=True)
-    await waiter
-    transport.close()
-    logger.info("udp transport closed")
+def _run_worker(index: int, host: str, port: int, **kwargs):
+    # 每个 worker 的指标独立, 分别监听 metrics_port + index
+    if kwargs.get('metrics_port'):
+        kwargs['metrics_port'] += index
+    asyncio.run(start_server(host, port, **kwargs))
+    logger.info(f'worker {index} stopped')
 
 
 def version_callback(value: bool):
@@ -86,6 +219,218 @@ def run(
                                    '--proxy_port',
                                    envvar='proxy_port',
                                    help='客户端访问的目标端口'),
+    relay: RelayEngine = typer.Option(
+        RelayEngine.BUFFERED.value,
+        '--relay',
+        envvar='relay',
+        help=(
+            '转发引擎, buffered: 基于 BufferedProtocol 的零拷贝转发, stream: 基于 StreamReader/StreamWriter, '
+            'splice: CONNECT 隧道使用 Linux splice(2) 在内核中转发'
+        )
+    ),
+    transparent_port: int = typer.Option(0,
+                                         '--transparent_port',
+                                         envvar='transparent_port',
+                                         help='透明代理监听端口, 接收 iptables REDIRECT/TPROXY 转发的连接, 0 表示不启用'),
+    transparent_mode: TransparentMode = typer.Option(
+        TransparentMode.REDIRECT.value,
+        '--transparent_mode',
+        envvar='transparent_mode',
+        help=(
+            '透明代理模式, redirect: 通过 SO_ORIGINAL_DST 获取原始目标地址, 只转发 TCP, '
+            'tproxy: 同时转发 TCP 与 UDP, 需要 CAP_NET_ADMIN'
+        )
+    ),
+    sniff: bool = typer.Option(False,
+                               '--sniff',
+                               envvar='sniff',
+                               help='目标为 IP 时从客户端的第一段数据中读取 TLS SNI 或 HTTP Host, 用于路由规则与访问日志'),
+    sniff_timeout: float = typer.Option(0.1,
+                                        '--sniff_timeout',
+                                        envvar='sniff_timeout',
+                                        help='嗅探等待客户端数据的时间, 单位秒, 服务器先发送数据的协议在超时后才连接目标服务器'),
+    tcp_nodelay: bool = typer.Option(True,
+                                     '--tcp_nodelay/--no_tcp_nodelay',
+                                     envvar='tcp_nodelay',
+                                     help='客户端与目标服务器连接关闭 Nagle 算法'),
+    tcp_sndbuf: int = typer.Option(0,
+                                   '--tcp_sndbuf',
+                                   envvar='tcp_sndbuf',
+                                   help='TCP 发送缓冲区大小, 单位字节, 0 表示使用系统默认值'),
+    tcp_rcvbuf: int = typer.Option(0,
+                                   '--tcp_rcvbuf',
+                                   envvar='tcp_rcvbuf',
+                                   help='TCP 接收缓冲区大小, 单位字节, 0 表示使用系统默认值'),
+    tcp_keepalive_idle: int = typer.Option(60,
+                                           '--tcp_keepalive_idle',
+                                           envvar='tcp_keepalive_idle',
+                                           help='连接空闲多久后发送 TCP keepalive 探测, 单位秒, 0 表示不开启'),
+    tcp_keepalive_interval: int = typer.Option(10,
+                                               '--tcp_keepalive_interval',
+                                               envvar='tcp_keepalive_interval',
+                                               help='TCP keepalive 探测间隔, 单位秒'),
+    tcp_keepalive_count: int = typer.Option(5,
+                                            '--tcp_keepalive_count',
+                                            envvar='tcp_keepalive_count',
+                                            help='TCP keepalive 探测失败多少次后关闭连接'),
+    tcp_fastopen: int = typer.Option(0,
+                                     '--tcp_fastopen',
+                                     envvar='tcp_fastopen',
+                                     help='监听 socket 的 TCP Fast Open 队列长度, 0 表示不开启'),
+    tcp_fastopen_connect: bool = typer.Option(False,
+                                              '--tcp_fastopen_connect',
+                                              envvar='tcp_fastopen_connect',
+                                              help='连接目标服务器时使用 TCP Fast Open'),
+    tcp_defer_accept: int = typer.Option(0,
+                                         '--tcp_defer_accept',
+                                         envvar='tcp_defer_accept',
+                                         help='客户端发送数据后才完成 accept 的等待时间, 单位秒, 0 表示不开启'),
+    tcp_quickack: bool = typer.Option(False,
+                                      '--tcp_quickack',
+                                      envvar='tcp_quickack',
+                                      help='连接建立时关闭延迟确认'),
+    tcp_backlog: int = typer.Option(1024,
+                                    '--tcp_backlog',
+                                    envvar='tcp_backlog',
+                                    help='监听队列长度, 受 net.core.somaxconn 限制'),
+    dns_cache_size: int = typer.Option(4096,
+                                       '--dns_cache_size',
+                                       envvar='dns_cache_size',
+                                       help='DNS 缓存容量'),
+    dns_cache_ttl: float = typer.Option(60,
+                                        '--dns_cache_ttl',
+                                        envvar='dns_cache_ttl',
+                                        help='DNS 缓存时间, 单位秒'),
+    connect_timeout: float = typer.Option(10,
+                                          '--connect_timeout',
+                                          envvar='connect_timeout',
+                                          help='连接目标服务器的总超时时间, 单位秒'),
+    happy_eyeballs_delay: float = typer.Option(0.25,
+                                               '--happy_eyeballs_delay',
+                                               envvar='happy_eyeballs_delay',
+                                               help='目标服务器有多个地址时, 发起下一个连接前的等待时间, 单位秒'),
+    http_pool_max_idle: int = typer.Option(8,
+                                           '--http_pool_max_idle',
+                                           envvar='http_pool_max_idle',
+                                           help='HTTP 代理每个目标服务器保留的最大空闲连接数'),
+    http_pool_max_age: float = typer.Option(60,
+                                            '--http_pool_max_age',
+                                            envvar='http_pool_max_age',
+                                            help='HTTP 代理上游连接的最长使用时间, 单位秒'),
+    http_pool_max_per_host: int = typer.Option(64,
+                                               '--http_pool_max_per_host',
+                                               envvar='http_pool_max_per_host',
+                                               help='HTTP 代理每个目标服务器的最大连接数'),
+    rate_limit_connection: int = typer.Option(0,
+                                              '--rate_limit_connection',
+                                              envvar='rate_limit_connection',
+                                              help='每个客户端连接的转发带宽上限, 单位字节/秒, 0 表示不限制'),
+    rate_limit_ip: int = typer.Option(0,
+                                      '--rate_limit_ip',
+                                      envvar='rate_limit_ip',
+                                      help='每个客户端 IP 的转发带宽上限, 单位字节/秒, 0 表示不限制'),
+    rate_limit_global: int = typer.Option(0,
+                                          '--rate_limit_global',
+                                          envvar='rate_limit_global',
+                                          help='全局转发带宽上限, 单位字节/秒, 0 表示不限制'),
+    access_log: str = typer.Option('',
+                                   '--access_log',
+                                   envvar='access_log',
+                                   help='访问日志文件路径, 每个连接结束时记录一条 JSON, "-" 表示标准输出, 为空时不记录'),
+    upstream: List[str] = typer.Option([],
+                                       '--upstream',
+                                       envvar='upstream',
+                                       help=('上级代理, 可以指定多个, 格式为 socks5://[user:pass@]host:port 或 '
+                                             'http://[user:pass@]host:port, TCP 连接经由上级代理建立. '
+                                             '末尾的 #name 为代理名称, 路由规则可以用 proxy:name 指定上级代理')),
+    upstream_strategy: UpstreamStrategy = typer.Option(
+        UpstreamStrategy.LEAST_CONN.value,
+        '--upstream_strategy',
+        envvar='upstream_strategy',
+        help='上级代理选择策略, least_conn: 连接数最少, latency: 按握手延迟加权'
+    ),
+    upstream_warm: int = typer.Option(0,
+                                      '--upstream_warm',
+                                      envvar='upstream_warm',
+                                      help='每个上级代理保持的预热连接数, 预热连接已完成认证'),
+    upstream_check_interval: float = typer.Option(10,
+                                                  '--upstream_check_interval',
+                                                  envvar='upstream_check_interval',
+                                                  help='上级代理健康检查间隔, 单位秒'),
+    auth_file: str = typer.Option('',
+                                  '--auth_file',
+                                  envvar='auth_file',
+                                  help=('用户名密码认证的凭据文件, 每行为 用户名:PBKDF2 哈希, '
+                                        '哈希通过 python -m pyproxy.auth <password> 生成, 为空时不认证')),
+    auth_backend: str = typer.Option('',
+                                     '--auth_backend',
+                                     envvar='auth_backend',
+                                     help='自定义认证后端, 格式为 module:attr, attr 为不需要参数的类或工厂函数, 优先于 auth_file'),
+    auth_cache_size: int = typer.Option(4096,
+                                        '--auth_cache_size',
+                                        envvar='auth_cache_size',
+                                        help='认证结果缓存容量'),
+    auth_cache_ttl: float = typer.Option(300,
+                                         '--auth_cache_ttl',
+                                         envvar='auth_cache_ttl',
+                                         help='认证成功的结果缓存时间, 单位秒'),
+    rules: str = typer.Option('',
+                              '--rules',
+                              envvar='rules',
+                              help=('路由规则文件, 按目标地址选择 direct: 直连, proxy: 经由上级代理, reject: 拒绝, '
+                                    '收到 SIGHUP 时重新加载, 为空时全部经由上级代理')),
+    rules_reload_interval: float = typer.Option(0,
+                                                '--rules_reload_interval',
+                                                envvar='rules_reload_interval',
+                                                help='检查路由规则文件修改时间的间隔, 单位秒, 0 表示只在收到 SIGHUP 时重新加载'),
+    max_connections: int = typer.Option(0,
+                                        '--max_connections',
+                                        envvar='max_connections',
+                                        help='并发客户端连接数上限, 超出时直接关闭新连接, 0 表示不限制'),
+    max_connections_per_ip: int = typer.Option(0,
+                                               '--max_connections_per_ip',
+                                               envvar='max_connections_per_ip',
+                                               help='每个客户端 IP 的并发连接数上限, 0 表示不限制'),
+    max_loop_lag: float = typer.Option(0,
+                                       '--max_loop_lag',
+                                       envvar='max_loop_lag',
+                                       help='事件循环延迟超过该值时拒绝新连接, 单位秒, 0 表示不限制'),
+    handshake_timeout: float = typer.Option(30,
+                                            '--handshake_timeout',
+                                            envvar='handshake_timeout',
+                                            help='客户端完成握手(包括连接目标服务器)的超时时间, 单位秒, 0 表示不限制'),
+    idle_timeout: float = typer.Option(0,
+                                       '--idle_timeout',
+                                       envvar='idle_timeout',
+                                       help='转发阶段没有数据收发时关闭连接的时间, 单位秒, 0 表示不限制'),
+    drain_timeout: float = typer.Option(30,
+                                        '--drain_timeout',
+                                        envvar='drain_timeout',
+                                        help='收到 SIGTERM 后等待现有连接结束的时间, 单位秒, 超时后关闭剩余连接'),
+    handoff_path: str = typer.Option('',
+                                     '--handoff_path',
+                                     envvar='handoff_path',
+                                     help=('AF_UNIX socket 路径, 新进程启动时从该路径接管旧进程的监听 socket, '
+                                           '旧进程随后停止接受连接并等待现有连接结束, 仅支持单进程模式')),
+    metrics_host: str = typer.Option('127.0.0.1',
+                                     '--metrics_host',
+                                     envvar='metrics_host',
+                                     help='Prometheus 指标服务监听地址'),
+    metrics_port: int = typer.Option(0,
+                                     '--metrics_port',
+                                     envvar='metrics_port',
+                                     help='Prometheus 指标服务监听端口, 0 表示不启用, 多进程模式下 worker 依次使用后续端口'),
+    loop: EventLoop = typer.Option(
+        EventLoop.AUTO.value,
+        '--loop',
+        envvar='loop',
+        help='事件循环实现, auto: uvloop 可用时使用 uvloop, 否则使用 asyncio'
+    ),
+    workers: int = typer.Option(1,
+                                '--workers',
+                                envvar='workers',
+                                min=1,
+                                help='worker 进程数量, 大于 1 时以多进程模式运行并通过 SO_REUSEPORT 共享端口'),
     version: Optional[bool] = typer.Option(None,
                                            "--version",
                                            callback=version_callback),
@@ -98,9 +443,62 @@ def run(
         "system_proxies": urllib.request.getproxies(),
         "proxy_addr": proxy_addr,
         "proxy_port": proxy_port,
+        "relay": relay,
+        "transparent_port": transparent_port,
+        "transparent_mode": transparent_mode,
+        "sniff": sniff,
+        "sniff_timeout": sniff_timeout,
+        "tcp_nodelay": tcp_nodelay,
+        "tcp_sndbuf": tcp_sndbuf,
+        "tcp_rcvbuf": tcp_rcvbuf,
+        "tcp_keepalive_idle": tcp_keepalive_idle,
+        "tcp_keepalive_interval": tcp_keepalive_interval,
+        "tcp_keepalive_count": tcp_keepalive_count,
+        "tcp_fastopen": tcp_fastopen,
+        "tcp_fastopen_connect": tcp_fastopen_connect,
+        "tcp_defer_accept": tcp_defer_accept,
+        "tcp_quickack": tcp_quickack,
+        "tcp_backlog": tcp_backlog,
+        "dns_cache_size": dns_cache_size,
+        "dns_cache_ttl": dns_cache_ttl,
+        "connect_timeout": connect_timeout,
+        "happy_eyeballs_delay": happy_eyeballs_delay,
+        "http_pool_max_idle": http_pool_max_idle,
+        "http_pool_max_age": http_pool_max_age,
+        "http_pool_max_per_host": http_pool_max_per_host,
+        "rate_limit_connection": rate_limit_connection,
+        "rate_limit_ip": rate_limit_ip,
+        "rate_limit_global": rate_limit_global,
+        "access_log": access_log,
+        "upstream": upstream,
+        "upstream_strategy": upstream_strategy,
+        "upstream_warm": upstream_warm,
+        "upstream_check_interval": upstream_check_interval,
+        "auth_file": auth_file,
+        "auth_backend": auth_backend,
+        "auth_cache_size": auth_cache_size,
+        "auth_cache_ttl": auth_cache_ttl,
+        "rules": rules,
+        "rules_reload_interval": rules_reload_interval,
+        "max_connections": max_connections,
+        "max_connections_per_ip": max_connections_per_ip,
+        "max_loop_lag": max_loop_lag,
+        "handshake_timeout": handshake_timeout,
+        "idle_timeout": idle_timeout,
+        "drain_timeout": drain_timeout,
+        "metrics_host": metrics_host,
+        "metrics_port": metrics_port,
     }
 
-    asyncio.run(start_server(host, port, **kwargs))
+    logger.info(f'event loop: {install_event_loop(loop).value}')
+
+    if workers > 1:
+        if handoff_path:
+            logger.warning('handoff_path is ignored in multi-worker mode')
+        Supervisor(workers, lambda index: _run_worker(index, host, port, **kwargs)).run()
+        return
+
+    asyncio.run(start_server(host, port, handoff_path=handoff_path, **kwargs))
 
 
 def main():
@@ -1,4 +1,4 @@
-from enum import IntEnum
+from enum import Enum, IntEnum
 
 
 class Socks5CMD(IntEnum):
@@ -13,6 +13,26 @@ class Socks5ATYP(IntEnum):
     IPV6 = 4
 
 
+class Socks5REP(IntEnum):
+
+    SUCCEEDED = 0
+    GENERAL_FAILURE = 1
+    NOT_ALLOWED = 2
+    NETWORK_UNREACHABLE = 3
+    HOST_UNREACHABLE = 4
+    CONNECTION_REFUSED = 5
+    TTL_EXPIRED = 6
+    COMMAND_NOT_SUPPORTED = 7
+    ADDRESS_TYPE_NOT_SUPPORTED = 8
+
+
+class Socks5AuthMethod(IntEnum):
+
+    NO_AUTH = 0
+    USERNAME_PASSWORD = 2
+    NO_ACCEPTABLE = 0xFF
+
+
 class ProxyCMD(IntEnum):
 
     SOCKS_CONNECT = 1
@@ -20,8 +40,68 @@ class ProxyCMD(IntEnum):
     SOCKS_UDP = 3
     HTTP = 4
     HTTPS = 5
+    TRANSPARENT = 6
+
+
+class RelayEngine(str, Enum):
+
+    BUFFERED = 'buffered'
+    STREAM = 'stream'
+    SPLICE = 'splice'
+
+
+class UpstreamStrategy(str, Enum):
+
+    LEAST_CONN = 'least_conn'
+    LATENCY = 'latency'
+
+
+class RouteAction(str, Enum):
+
+    DIRECT = 'direct'
+    PROXY = 'proxy'
+    REJECT = 'reject'
+
+
+class TransparentMode(str, Enum):
+
+    REDIRECT = 'redirect'
+    TPROXY = 'tproxy'
+
+
+class EventLoop(str, Enum):
+
+    AUTO = 'auto'
+    ASYNCIO = 'asyncio'
+    UVLOOP = 'uvloop'
 
 
 HTTP_PROXY_CONNECT_RESPONSE = (b'HTTP/1.0 200 Connection Established\r\n'
                                b'Connection: close\r\n'
                                b'\r\n')
+
+HTTP_PROXY_AUTH_REQUIRED_RESPONSE = (b'HTTP/1.1 407 Proxy Authentication Required\r\n'
+                                     b'Proxy-Authenticate: Basic realm="pyproxy"\r\n'
+                                     b'Content-Length: 0\r\n'
+                                     b'Connection: close\r\n'
+                                     b'\r\n')
+
+HTTP_PROXY_FORBIDDEN_RESPONSE = (b'HTTP/1.1 403 Forbidden\r\n'
+                                 b'Content-Length: 0\r\n'
+                                 b'Connection: close\r\n'
+                                 b'\r\n')
+
+HTTP_PROXY_BAD_GATEWAY_RESPONSE = (b'HTTP/1.1 502 Bad Gateway\r\n'
+                                   b'Content-Length: 0\r\n'
+                                   b'Connection: close\r\n'
+                                   b'\r\n')
+
+HTTP_PROXY_GATEWAY_TIMEOUT_RESPONSE = (b'HTTP/1.1 504 Gateway Timeout\r\n'
+                                       b'Content-Length: 0\r\n'
+                                       b'Connection: close\r\n'
+                                       b'\r\n')
+
+HTTP_PROXY_BAD_REQUEST_RESPONSE = (b'HTTP/1.1 400 Bad Request\r\n'
+                                   b'Content-Length: 0\r\n'
+                                   b'Connection: close\r\n'
+                                   b'\r\n')
@@ -4,3 +4,17 @@ class ConnectError(Exception):
 
 class ForwardError(Exception):
     pass
+
+
+class HttpParseError(Exception):
+    pass
+
+
+class UpstreamError(OSError):
+    """上级代理返回的目标服务器错误, 上级代理本身可用"""
+    pass
+
+
+class RouteRejected(PermissionError):
+    """目标地址被路由规则拒绝"""
+    pass
@@ -0,0 +1,383 @@
+import abc
+import asyncio
+
+from typing import List, Optional, Tuple
+
+from pyproxy import metrics
+from pyproxy.errors import HttpParseError
+from pyproxy.ratelimit import Throttle
+
+CRLF = b'\r\n'
+HEAD_END = b'\r\n\r\n'
+READ_SIZE = 2**16
+MAX_HEAD_SIZE = 2**16
+MAX_LINE_SIZE = 2**13
+# 逐跳首部(RFC 9110 7.6.1), 不转发给目标服务器, Connection 中列出的首部同样去掉
+HOP_BY_HOP_HEADERS = (b'connection', b'proxy-connection', b'keep-alive', b'te', b'proxy-authorization')
+# 决定消息边界的首部由代理按原样转发消息体, 即使被 Connection 列出也保留, 避免与目标服务器对消息长度的理解不一致
+_FRAMING_HEADERS = (b'host', b'content-length', b'transfer-encoding')
+
+
+class HttpStream:
+    """在 StreamReader 之上维护一个前置缓冲区
+
+    握手阶段多读的数据先放入缓冲区, 后续读取优先从缓冲区消费, 剩余数据可通过 leftover 交给转发.
+    缓冲区只记录已消费的偏移量, 数据不足时才与新读取的数据拼接.
+    设置 throttle 时 read 超出限速后等待令牌恢复, 期间 StreamReader 缓冲区写满会暂停读取 socket.
+    nbytes 为读取的字节数, 设置 counter 时同时计入指标.
+    """
+
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        buffer: bytes = b'',
+        throttle: Optional[Throttle] = None,
+        counter: Optional[metrics.Value] = None,
+    ):
+        self.reader = reader
+        self.throttle = throttle
+        self.counter = counter
+        self.nbytes = 0
+        self._buffer = buffer
+        self._pos = 0
+
+    async def readuntil(self, separator: bytes = CRLF, limit: int = MAX_LINE_SIZE) -> bytes:
+        """读取到 separator 为止(包含 separator), 连接在此之前关闭时抛出 IncompleteReadError"""
+        buffer, pos = self._buffer, self._pos
+        idx = buffer.find(separator, pos)
+        if idx < 0:
+            # 数据不足时在可变缓冲区中追加, 避免每次拼接都复制已读取的数据
+            pending = bytearray(buffer[pos:])
+            while idx < 0:
+                if len(pending) > limit:
+                    raise HttpParseError(f'line too long: {len(pending)} bytes')
+                chunk = await self.reader.read(READ_SIZE)
+                if not chunk:
+                    self._buffer, self._pos = b'', 0
+                    raise asyncio.IncompleteReadError(bytes(pending), None)
+                # 只需要从上次未匹配的位置继续查找
+                start = max(0, len(pending) - len(separator) + 1)
+                pending += chunk
+                idx = pending.find(separator, start)
+            buffer, pos = bytes(pending), 0
+
+        end = idx + len(separator)
+        self._buffer, self._pos = buffer, end
+        self.nbytes += end - pos
+        if self.counter is not None:
+            self.counter.inc(end - pos)
+        return buffer[pos:end]
+
+    async def read(self, n: int = READ_SIZE) -> bytes:
+        if self._pos < len(self._buffer):
+            data = self._buffer[self._pos:self._pos + n]
+            self._pos += len(data)
+        else:
+            data = await self.reader.read(n)
+        self.nbytes += len(data)
+        if self.counter is not None:
+            self.counter.inc(len(data))
+        if self.throttle is not None and data:
+            delay = self.throttle.consume(len(data))
+            if delay > 0:
+                await asyncio.sleep(delay)
+        return data
+
+    def leftover(self) -> bytes:
+        data = self._buffer[self._pos:]
+        self._buffer, self._pos = b'', 0
+        return data
+
+
+class HttpMessage(abc.ABC):
+    """HTTP/1.x 请求或响应的起始行与首部
+
+    只记录起始行各字段的偏移量, 首部按需在小写化的请求头中查找, 不为每个首部创建对象.
+    """
+
+    def __init__(self, raw: bytes):
+        self.raw = raw
+        self._lower: Optional[bytes] = None
+        self._line_end = raw.find(CRLF)
+        self._sp1 = raw.find(b' ', 0, self._line_end)
+        self._sp2 = raw.find(b' ', self._sp1 + 1, self._line_end)
+        if self._line_end < 0 or self._sp1 <= 0 or self._sp2 < 0:
+            raise HttpParseError(f'invalid start line: {raw[:self._line_end]!r}')
+
+    def get_header(self, name: bytes) -> Optional[bytes]:
+        """查找首部, name 需为小写"""
+        if self._lower is None:
+            self._lower = self.raw.lower()
+        idx = self._lower.find(CRLF + name + b':', self._line_end)
+        if idx < 0:
+            return None
+        start = idx + len(name) + 3
+        return self.raw[start:self._lower.index(CRLF, start)].strip()
+
+    def get_headers(self, name: bytes) -> List[bytes]:
+        """查找所有同名首部, name 需为小写"""
+        if self._lower is None:
+            self._lower = self.raw.lower()
+        values = []
+        idx = self._lower.find(CRLF + name + b':', self._line_end)
+        while idx >= 0:
+            start = idx + len(name) + 3
+            end = self._lower.index(CRLF, start)
+            values.append(self.raw[start:end].strip())
+            idx = self._lower.find(CRLF + name + b':', end)
+        return values
+
+    def without_header(self, name: bytes):
+        """去掉首部(包括重复的首部)后的消息, name 需为小写, 没有该首部时返回自身"""
+        if self._lower is None:
+            self._lower = self.raw.lower()
+        start = self._lower.find(CRLF + name + b':', self._line_end)
+        if start < 0:
+            return self
+        end = self._lower.index(CRLF, start + 2)
+        return type(self)(self.raw[:start] + self.raw[end:]).without_header(name)
+
+    def with_header(self, name: bytes, value: bytes):
+        """在首部末尾追加一个首部"""
+        end = len(self.raw) - len(CRLF)
+        return type(self)(b''.join((self.raw[:end], name, b': ', value, CRLF, self.raw[end:])))
+
+    def without_hop_by_hop(self):
+        """去掉逐跳首部后的消息, 协议升级请求保留 Upgrade 首部与 Connection: upgrade"""
+        tokens = {t.strip() for value in self.get_headers(b'connection') for t in value.lower().split(b',')}
+        upgrade = b'upgrade' in tokens and self.get_header(b'upgrade') is not None
+        message = self
+        for name in tokens.union(HOP_BY_HOP_HEADERS):
+            if name and name not in _FRAMING_HEADERS and not (upgrade and name == b'upgrade'):
+                message = message.without_header(name)
+        if upgrade:
+            message = message.with_header(b'Connection', b'upgrade')
+        return message
+
+    @property
+    @abc.abstractmethod
+    def version(self) -> bytes:
+        pass
+
+    @property
+    def transfer_codings(self) -> List[bytes]:
+        """所有 Transfer-Encoding 首部中的传输编码, 按出现顺序排列"""
+        codings = []
+        for value in self.get_headers(b'transfer-encoding'):
+            codings += [t.strip() for t in value.lower().split(b',') if t.strip()]
+        return codings
+
+    @property
+    def chunked(self) -> bool:
+        """最后一个传输编码为 chunked 时按分块读取消息体(RFC 9112 6.3)"""
+        codings = self.transfer_codings
+        return bool(codings) and codings[-1] == b'chunked'
+
+    @property
+    def content_length(self) -> Optional[int]:
+        """多个 Content-Length(包括逗号分隔的列表)的值相同时视为一个, 不同时抛出 HttpParseError"""
+        values = self.get_headers(b'content-length')
+        if not values:
+            return None
+        lengths = set()
+        for value in values:
+            for item in value.split(b','):
+                try:
+                    length = int(item)
+                except ValueError:
+                    raise HttpParseError(f'invalid content-length: {value!r}')
+                if length < 0:
+                    raise HttpParseError(f'invalid content-length: {value!r}')
+                lengths.add(length)
+        if len(lengths) > 1:
+            raise HttpParseError(f'conflicting content-length: {values!r}')
+        return lengths.pop()
+
+    @property
+    def keep_alive(self) -> bool:
+        connection = self.get_header(b'connection') or self.get_header(b'proxy-connection')
+        tokens = [t.strip() for t in connection.lower().split(b',')] if connection else []
+        if b'close' in tokens:
+            return False
+        if self.version == b'HTTP/1.0':
+            return b'keep-alive' in tokens
+        return True
+
+
+class HttpRequest(HttpMessage):
+
+    @property
+    def method(self) -> bytes:
+        return self.raw[:self._sp1]
+
+    @property
+    def target(self) -> bytes:
+        return self.raw[self._sp1 + 1:self._sp2]
+
+    @property
+    def version(self) -> bytes:
+        return self.raw[self._sp2 + 1:self._line_end]
+
+    @property
+    def has_body(self) -> bool:
+        return self.chunked or bool(self.content_length)
+
+    def check_framing(self):
+        """检查请求的消息长度(RFC 9112 6.1, 6.3)
+
+        同时存在 Transfer-Encoding 与 Content-Length、Content-Length 不一致或 Transfer-Encoding 不以 chunked 结尾时,
+        代理与目标服务器可能对请求边界理解不同(请求走私), 抛出 HttpParseError, 由调用方返回 400.
+        """
+        if self.get_header(b'transfer-encoding') is not None:
+            if self.get_header(b'content-length') is not None:
+                raise HttpParseError('both transfer-encoding and content-length')
+            # 所有 Transfer-Encoding 首部合并后, chunked 必须是最后一个且只出现一次
+            codings = self.transfer_codings
+            if not codings or codings[-1] != b'chunked' or codings.count(b'chunked') > 1:
+                raise HttpParseError(f'invalid transfer-encoding: {codings!r}')
+        else:
+            # Content-Length 不一致时抛出 HttpParseError
+            self.content_length
+
+    def origin_form(self) -> bytes:
+        """发送给目标服务器的请求头, 去掉逐跳首部, absolute-form 的请求目标改写为 origin-form"""
+        request = self.without_hop_by_hop()
+        target = request.target
+        scheme = target.find(b'://')
+        if scheme < 0:
+            return request.raw
+        path = target.find(b'/', scheme + 3)
+        raw = request.raw
+        return b''.join((raw[:request._sp1 + 1], target[path:] if path >= 0 else b'/', raw[request._sp2:]))
+
+    def address(self, default_port: int = 80) -> Tuple[str, int]:
+        """目标服务器地址
+
+        CONNECT 请求使用 authority-form 的请求目标, 其他请求优先使用 absolute-form 中的 authority, 其次使用 Host 首部.
+        """
+        target = self.target
+        if self.method == b'CONNECT':
+            authority = target
+        elif b'://' in target:
+            authority = target.split(b'://', 1)[1].split(b'/', 1)[0]
+        else:
+            authority = self.get_header(b'host') or b''
+        if not authority:
+            raise HttpParseError(f'no target address: {target!r}')
+        return parse_authority(authority, default_port)
+
+
+class HttpResponse(HttpMessage):
+
+    @property
+    def version(self) -> bytes:
+        return self.raw[:self._sp1]
+
+    @property
+    def status(self) -> int:
+        try:
+            return int(self.raw[self._sp1 + 1:self._sp2])
+        except ValueError:
+            raise HttpParseError(f'invalid status: {self.raw[:self._line_end]!r}')
+
+    def has_body(self, request_method: bytes) -> bool:
+        status = self.status
+        if request_method == b'HEAD' or 100 <= status < 200 or status in (204, 304):
+            return False
+        return True
+
+
+def parse_authority(authority: bytes, default_port: int = 80) -> Tuple[str, int]:
+    """解析 `host`, `host:port`, `[ipv6]:port`"""
+    if authority.startswith(b'['):
+        host, _, rest = authority[1:].partition(b']')
+        port = rest[1:] if rest.startswith(b':') else b''
+    elif authority.count(b':') == 1:
+        host, _, port = authority.partition(b':')
+    else:
+        host, port = authority, b''
+    try:
+        return host.decode(), int(port) if port else default_port
+    except (UnicodeDecodeError, ValueError):
+        raise HttpParseError(f'invalid authority: {authority!r}')
+
+
+async def read_request(stream: HttpStream) -> Optional[HttpRequest]:
+    """读取一个请求头, 客户端在请求之间关闭连接时返回 None"""
+    try:
+        raw = await stream.readuntil(HEAD_END, MAX_HEAD_SIZE)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise
+        return None
+    request = HttpRequest(raw)
+    request.check_framing()
+    return request
+
+
+async def read_response(stream: HttpStream) -> HttpResponse:
+    """读取一个响应头, 同时存在 Transfer-Encoding 与 Content-Length 时以前者为准, 去掉 Content-Length 后转发"""
+    response = HttpResponse(await stream.readuntil(HEAD_END, MAX_HEAD_SIZE))
+    if response.get_header(b'transfer-encoding') is not None:
+        return response.without_header(b'content-length')
+    return response
+
+
+async def relay_body(stream: HttpStream, writer: asyncio.StreamWriter, message: HttpMessage, has_body: bool) -> bool:
+    """按照 HTTP/1.1 的消息长度规则转发消息体
+
+    返回 False 表示消息体以连接关闭为结束, 连接不可复用.
+    """
+    if not has_body:
+        return True
+
+    if message.chunked:
+        await _relay_chunked(stream, writer)
+        return True
+
+    length = message.content_length
+    if length is not None:
+        await _relay_exactly(stream, writer, length)
+        return True
+
+    if isinstance(message, HttpRequest):
+        # 请求没有长度信息时视为没有消息体
+        return True
+
+    while True:
+        data = await stream.read(READ_SIZE)
+        if not data:
+            return False
+        writer.write(data)
+        await writer.drain()
+
+
+async def _relay_exactly(stream: HttpStream, writer: asyncio.StreamWriter, length: int):
+    while length > 0:
+        data = await stream.read(min(length, READ_SIZE))
+        if not data:
+            raise asyncio.IncompleteReadError(b'', length)
+        length -= len(data)
+        writer.write(data)
+        await writer.drain()
+
+
+async def _relay_chunked(stream: HttpStream, writer: asyncio.StreamWriter):
+    while True:
+        line = await stream.readuntil(CRLF)
+        writer.write(line)
+        try:
+            size = int(line.split(b';', 1)[0].strip(), 16)
+        except ValueError:
+            raise HttpParseError(f'invalid chunk size: {line!r}')
+
+        if size == 0:
+            # trailer 以空行结束
+            while True:
+                line = await stream.readuntil(CRLF)
+                writer.write(line)
+                if line == CRLF:
+                    await writer.drain()
+                    return
+
+        await _relay_exactly(stream, writer, size + len(CRLF))
@@ -0,0 +1,207 @@
+import array
+import asyncio
+import logging
+import os
+import signal
+import socket
+
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class Lifecycle:
+    """服务生命周期, 记录进行中的客户端连接
+
+    shutdown 后停止接受新连接, drain 等待现有连接结束, 超时后取消剩余连接.
+    空闲的 HTTP keep-alive 连接在 drain 开始时直接关闭. 再次调用 shutdown 时不再等待.
+    """
+
+    def __init__(self, drain_timeout: float = 30):
+        self.drain_timeout = drain_timeout
+        self.draining = False
+        # 监听 socket 已交给新进程
+        self.handed_off = False
+        self._connections: Dict[object, asyncio.Task] = {}
+        self._shutdown = asyncio.Event()
+        self._drained: Optional[asyncio.Future] = None
+
+    def __len__(self):
+        return len(self._connections)
+
+    def install_signal_handlers(self, loop: asyncio.AbstractEventLoop):
+        """SIGTERM/SIGINT 触发 shutdown, 只能在主线程中设置"""
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(signum, self.shutdown)
+            except (RuntimeError, ValueError, NotImplementedError) as e:
+                logger.debug(f'install signal handler failed: {e!r}')
+                return
+
+    def track(self, connection: object, task: asyncio.Task):
+        self._connections[connection] = task
+
+    def discard(self, connection: object):
+        self._connections.pop(connection, None)
+        if not self._connections and self._drained is not None and not self._drained.done():
+            self._drained.set_result(None)
+
+    def shutdown(self):
+        if self._shutdown.is_set():
+            logger.info(f'shutdown requested again, closing {len(self._connections)} connections')
+            self.cancel_all()
+            return
+        self._shutdown.set()
+
+    def handoff(self):
+        self.handed_off = True
+        self.shutdown()
+
+    async def wait_shutdown(self):
+        await self._shutdown.wait()
+
+    async def drain(self):
+        self.draining = True
+        for connection, task in list(self._connections.items()):
+            if getattr(connection, 'idle', False):
+                task.cancel()
+        if not self._connections:
+            return
+
+        logger.info(f'draining {len(self._connections)} connections, timeout {self.drain_timeout}s')
+        self._drained = asyncio.get_running_loop().create_future()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._drained), self.drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f'drain timeout, closing {len(self._connections)} connections')
+            self.cancel_all()
+
+    def cancel_all(self):
+        for task in list(self._connections.values()):
+            task.cancel()
+
+
+_lifecycle: ContextVar[Lifecycle] = ContextVar('lifecycle')
+
+
+def get_lifecycle() -> Lifecycle:
+    lifecycle = _lifecycle.get(None)
+    if lifecycle is None:
+        lifecycle = Lifecycle()
+        _lifecycle.set(lifecycle)
+    return lifecycle
+
+
+class HandoffServer:
+    """通过 AF_UNIX socket 把监听 socket 交给新进程
+
+    新进程连接 path 后收到监听 socket 的文件描述符(SCM_RIGHTS), 开始服务后回复 ok,
+    旧进程随后调用 on_handoff 停止接受连接并等待现有连接结束.
+    两个进程共享同一个监听 socket, 交接期间新连接留在 accept 队列中, 不会被拒绝.
+    新进程没有回复 ok 时旧进程继续服务.
+    """
+
+    ACK = b'ok'
+
+    def __init__(self, path: str, fds: Sequence[int], on_handoff: Callable[[], None], timeout: float = 10):
+        self.path = path
+        self._fds = list(fds)
+        self._on_handoff = on_handoff
+        self._timeout = timeout
+        self._sock: Optional[socket.socket] = None
+        self._inode = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        # 新进程接管后由新进程重新监听 path, 旧的 socket 文件直接替换
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.bind(self.path)
+        sock.listen(1)
+        self._sock = sock
+        self._inode = os.stat(self.path).st_ino
+        self._task = asyncio.ensure_future(self._serve())
+        logger.info(f'handoff listening on {self.path}')
+
+    async def _serve(self):
+        loop = asyncio.get_running_loop()
+        assert self._sock
+        while True:
+            conn, _ = await loop.sock_accept(self._sock)
+            with conn:
+                try:
+                    _send_fds(conn, b'pyproxy', self._fds)
+                    ack = await asyncio.wait_for(loop.sock_recv(conn, len(self.ACK)), self._timeout)
+                except (OSError, asyncio.TimeoutError) as e:
+                    logger.warning(f'[HandoffServer] handoff failed: {e!r}')
+                    continue
+            if ack == self.ACK:
+                logger.info('listening sockets handed off to new process')
+                self._on_handoff()
+                return
+            logger.warning('[HandoffServer] new process did not take over, keep serving')
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            # path 可能已被新进程替换
+            try:
+                if os.stat(self.path).st_ino == self._inode:
+                    os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+
+def _send_fds(sock: socket.socket, message: bytes, fds: List[int]):
+    """socket.send_fds 需要 Python 3.9+, 使用 SCM_RIGHTS 辅助数据发送文件描述符"""
+    sock.sendmsg([message], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+
+
+def _recv_fds(sock: socket.socket, bufsize: int, maxfds: int) -> List[int]:
+    fds = array.array('i')
+    _, ancdata, _, _ = sock.recvmsg(bufsize, socket.CMSG_LEN(maxfds * fds.itemsize))
+    for level, type_, data in ancdata:
+        if level == socket.SOL_SOCKET and type_ == socket.SCM_RIGHTS:
+            # 丢弃末尾不完整的部分
+            fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+    return list(fds)
+
+
+def _receive_fds(path: str, timeout: float) -> Tuple[List[socket.socket], socket.socket]:
+    channel = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        channel.settimeout(timeout)
+        channel.connect(path)
+        fds = _recv_fds(channel, 64, 8)
+    except BaseException:
+        channel.close()
+        raise
+    return [socket.socket(fileno=fd) for fd in fds], channel
+
+
+async def take_over(path: str, timeout: float = 10) -> Optional[Tuple[List[socket.socket], socket.socket]]:
+    """从旧进程接收监听 socket, 返回 socket 列表与用于回复的连接, 没有旧进程时返回 None
+
+    开始服务后需要通过 confirm_takeover 通知旧进程.
+    """
+    if not os.path.exists(path):
+        return None
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(None, _receive_fds, path, timeout)
+    except OSError as e:
+        logger.info(f'no process to take over on {path}: {e!r}')
+        return None
+
+
+def confirm_takeover(channel: socket.socket):
+    try:
+        channel.sendall(HandoffServer.ACK)
+    finally:
+        channel.close()
@@ -0,0 +1,316 @@
+import asyncio
+import bisect
+import logging
+import math
+
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from pyproxy.const import ProxyCMD, RouteAction
+
+logger = logging.getLogger(__name__)
+
+# 延迟类指标的默认分桶, 单位秒
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    """指标基类, labels 返回的子指标应在初始化时获取并保存, 记录时不再创建对象
+
+    每个进程运行一个事件循环, 记录指标不加锁.
+    """
+
+    TYPE = ''
+    # 文本格式 0.0.4 中 HELP/TYPE 使用的名称需要与样本名称一致, counter 带有 _total 后缀
+    SUFFIX = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), registry: 'Registry' = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], Any] = {}
+        (registry or REGISTRY).register(self)
+
+    def labels(self, *values: str):
+        assert len(values) == len(self.labelnames)
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self) -> Iterator[Tuple[str, Tuple[str, ...], float]]:
+        raise NotImplementedError
+
+    def collect(self) -> List[str]:
+        name = self.name + self.SUFFIX
+        lines = [f'# HELP {name} {self.documentation}', f'# TYPE {name} {self.TYPE}']
+        for suffix, labels, value in self._samples():
+            names = self.labelnames + (('le', ) if len(labels) > len(self.labelnames) else ())
+            lines.append(f'{self.name}{suffix}{_format_labels(names, labels)} {_format_value(value)}')
+        return lines
+
+
+class Value:
+    """aggregate 合并多个服务注册的 function 的返回值"""
+
+    def __init__(self, aggregate: Callable[[Iterable[float]], float] = sum):
+        self.value = 0.0
+        self._functions: List[Callable[[], float]] = []
+        self._aggregate = aggregate
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+    def set_function(self, function: Callable[[], float]):
+        """在采集时调用 function 获取当前值, 用于连接数、缓存大小等已有的状态, 替换已注册的 function"""
+        self._functions = [function]
+
+    def add_function(self, function: Callable[[], float]) -> Callable[[], None]:
+        """同一进程中的多个服务各自注册 function, 采集时合并, 返回取消注册的函数"""
+        self._functions.append(function)
+
+        def remove():
+            if function in self._functions:
+                self._functions.remove(function)
+
+        return remove
+
+    def get(self) -> float:
+        # 其他线程中的服务可能同时注册或取消注册
+        functions = list(self._functions)
+        if functions:
+            return self._aggregate(f() for f in functions)
+        return self.value
+
+
+class Counter(_Metric):
+    TYPE = 'counter'
+    SUFFIX = '_total'
+
+    def _new_child(self):
+        return Value()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def _samples(self):
+        for labels, child in self._children.items():
+            yield '_total', labels, child.get()
+
+
+class Gauge(_Metric):
+    """aggregate 为多个服务注册 function 时的合并方式, 默认求和"""
+
+    TYPE = 'gauge'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        registry: 'Registry' = None,
+        aggregate: Callable[[Iterable[float]], float] = sum,
+    ):
+        self.aggregate = aggregate
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return Value(self.aggregate)
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self.labels().dec(amount)
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def set_function(self, function: Callable[[], float]):
+        self.labels().set_function(function)
+
+    def add_function(self, function: Callable[[], float]) -> Callable[[], None]:
+        return self.labels().add_function(function)
+
+    def _samples(self):
+        for labels, child in self._children.items():
+            yield '', labels, child.get()
+
+
+class HistogramValue:
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Histogram(_Metric):
+    TYPE = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+        registry: 'Registry' = None,
+    ):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _samples(self):
+        for labels, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf, ), child.counts):
+                cumulative += count
+                yield '_bucket', labels + (_format_value(bound), ), cumulative
+            yield '_count', labels, cumulative
+            yield '_sum', labels, child.sum
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric):
+        assert metric.name not in self._metrics, metric.name
+        self._metrics[metric.name] = metric
+
+    def get(self, name: str) -> Optional[_Metric]:
+        return self._metrics.get(name)
+
+    def render(self) -> bytes:
+        """Prometheus 文本格式"""
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.collect())
+        lines.append('')
+        return '\n'.join(lines).encode()
+
+
+REGISTRY = Registry()
+
+CONNECTIONS = Counter('pyproxy_connections', '已完成握手的客户端连接数', ['cmd'])
+CONNECTIONS_ACTIVE = Gauge('pyproxy_connections_active', '当前的客户端连接数', ['cmd'])
+HANDSHAKE_SECONDS = Histogram('pyproxy_handshake_seconds', '客户端握手耗时, 包含连接目标服务器')
+HANDSHAKE_ERRORS = Counter('pyproxy_handshake_errors', '握手失败的客户端连接数')
+UPSTREAM_CONNECT_SECONDS = Histogram('pyproxy_upstream_connect_seconds', '连接目标服务器的耗时, 包含域名解析')
+UPSTREAM_CONNECT_ERRORS = Counter('pyproxy_upstream_connect_errors', '连接目标服务器失败的次数')
+DNS_SECONDS = Histogram('pyproxy_dns_seconds', '域名解析耗时, 不包含命中缓存的请求')
+DNS_LOOKUPS = Counter('pyproxy_dns_lookups', '域名解析请求数, hit: 命中缓存, miss: 实际解析, coalesced: 合并到进行中的解析', ['result'])
+RELAY_BYTES = Counter('pyproxy_relay_bytes', '转发的字节数, upstream 为客户端到目标服务器', ['direction'])
+RELAY_BUFFER_POOL = Gauge('pyproxy_relay_buffer_pool_bytes', '转发缓冲区池中空闲缓冲区的总大小')
+UDP_ASSOCIATIONS = Gauge('pyproxy_udp_associations', '当前的 UDP 关联数')
+UDP_DATAGRAMS = Counter('pyproxy_udp_datagrams', '转发的 UDP 数据报数量', ['direction'])
+UDP_DROPPED = Counter('pyproxy_udp_dropped', '丢弃的 UDP 数据报数量', ['reason'])
+ADMISSION_REJECTED = Counter('pyproxy_admission_rejected', '准入控制拒绝的客户端连接数', ['reason'])
+TIMEOUTS = Counter('pyproxy_timeouts', '因超时关闭的客户端连接数, handshake: 握手超时, idle: 转发空闲超时', ['kind'])
+PARENT_PROXY_ACTIVE = Gauge('pyproxy_parent_proxy_active', '经由上级代理的连接数', ['proxy'])
+PARENT_PROXY_HEALTHY = Gauge('pyproxy_parent_proxy_healthy', '上级代理是否可用', ['proxy'], aggregate=min)
+AUTH = Counter('pyproxy_auth', '认证请求数', ['result'])
+AUTH_SECONDS = Histogram('pyproxy_auth_seconds', '认证后端耗时, 不包含命中缓存的请求')
+AUTH_CACHE = Counter('pyproxy_auth_cache', '认证缓存查找次数', ['result'])
+ROUTE_DECISIONS = Counter('pyproxy_route_decisions', '路由决策次数', ['action'])
+ROUTE_RULES = Gauge('pyproxy_route_rules', '已加载的路由规则数')
+SNIFF = Counter('pyproxy_sniff', '目标为 IP 的连接嗅探域名的次数, found: 读取到域名, none: 没有域名或超时', ['result'])
+EVENT_LOOP_LAG = Gauge('pyproxy_event_loop_lag_seconds', '事件循环调度延迟, 多个服务时取最大值', aggregate=max)
+
+# 热路径直接使用的子指标
+CONNECTIONS_BY_CMD = {cmd: CONNECTIONS.labels(cmd.name.lower()) for cmd in ProxyCMD}
+CONNECTIONS_ACTIVE_BY_CMD = {cmd: CONNECTIONS_ACTIVE.labels(cmd.name.lower()) for cmd in ProxyCMD}
+RELAY_BYTES_UPSTREAM = RELAY_BYTES.labels('upstream')
+RELAY_BYTES_DOWNSTREAM = RELAY_BYTES.labels('downstream')
+UDP_DATAGRAMS_UPSTREAM = UDP_DATAGRAMS.labels('upstream')
+UDP_DATAGRAMS_DOWNSTREAM = UDP_DATAGRAMS.labels('downstream')
+UDP_DROPPED_INVALID = UDP_DROPPED.labels('invalid')
+UDP_DROPPED_THROTTLED = UDP_DROPPED.labels('throttled')
+UDP_DROPPED_BUFFER_FULL = UDP_DROPPED.labels('buffer_full')
+UDP_DROPPED_REJECTED = UDP_DROPPED.labels('rejected')
+HANDSHAKE_SECONDS_ALL = HANDSHAKE_SECONDS.labels()
+HANDSHAKE_ERRORS_ALL = HANDSHAKE_ERRORS.labels()
+UPSTREAM_CONNECT_SECONDS_ALL = UPSTREAM_CONNECT_SECONDS.labels()
+UPSTREAM_CONNECT_ERRORS_ALL = UPSTREAM_CONNECT_ERRORS.labels()
+DNS_SECONDS_ALL = DNS_SECONDS.labels()
+ADMISSION_REJECTED_MAX_CONNECTIONS = ADMISSION_REJECTED.labels('max_connections')
+ADMISSION_REJECTED_MAX_CONNECTIONS_PER_IP = ADMISSION_REJECTED.labels('max_connections_per_ip')
+ADMISSION_REJECTED_OVERLOAD = ADMISSION_REJECTED.labels('overload')
+HANDSHAKE_TIMEOUTS = TIMEOUTS.labels('handshake')
+IDLE_TIMEOUTS = TIMEOUTS.labels('idle')
+AUTH_SUCCESS = AUTH.labels('success')
+AUTH_FAILURE = AUTH.labels('failure')
+AUTH_SECONDS_ALL = AUTH_SECONDS.labels()
+UDP_DROPPED_UNAUTHORIZED = UDP_DROPPED.labels('unauthorized')
+ROUTE_DECISIONS_BY_ACTION = {action: ROUTE_DECISIONS.labels(action.value) for action in RouteAction}
+SNIFF_FOUND = SNIFF.labels('found')
+SNIFF_NONE = SNIFF.labels('none')
+
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        # 忽略其余请求头
+        while (await reader.readline()).strip():
+            pass
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+            body = REGISTRY.render()
+            status = b'200 OK'
+        else:
+            body = b'not found\n'
+            status = b'404 Not Found'
+        writer.write(b'HTTP/1.0 ' + status + b'\r\n'
+                     b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                     b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                     b'Connection: close\r\n\r\n' + body)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+        logger.debug(f'[metrics] {e!r}')
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host: str, port: int) -> asyncio.AbstractServer:
+    """在独立端口提供 /metrics"""
+    # 监听 socket 交接期间新旧进程同时监听指标端口
+    server = await asyncio.start_server(_handle, host, port, reuse_address=True, reuse_port=True)
+    logger.info(f'metrics listening on {host}:{port}')
+    return server
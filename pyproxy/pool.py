@@ -0,0 +1,203 @@
+import asyncio
+import logging
+
+from collections import defaultdict, deque
+from contextvars import ContextVar
+from typing import Deque, Dict, Optional, Tuple
+
+from pyproxy.routing import route
+from pyproxy.upstream import UpstreamProxy, connect
+
+logger = logging.getLogger(__name__)
+
+_Key = Tuple[str, int]
+
+
+class PooledConnection:
+    """连接池中的上游连接"""
+
+    def __init__(
+        self,
+        key: _Key,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        created: float,
+        parent: Optional[UpstreamProxy] = None,
+    ):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.created = created
+        self.last_used = created
+        self.reused = False
+        # 经由的上级代理
+        self.parent = parent
+
+    def __repr__(self):
+        return f'<PooledConnection {self.key[0]}:{self.key[1]} reused={self.reused}>'
+
+    @property
+    def closed(self) -> bool:
+        # 空闲期间对端关闭连接时 reader 会收到 EOF
+        return self.writer.transport.is_closing() or self.reader.at_eof() or self.reader.exception() is not None
+
+    def close(self):
+        self.writer.close()
+        if self.parent is not None:
+            self.parent.release()
+            self.parent = None
+
+
+class ConnectionPool:
+    """按 (host, port) 维护上游连接的连接池
+
+    - max_idle: 每个目标服务器最多保留的空闲连接数
+    - max_age: 连接建立后的最长使用时间
+    - idle_timeout: 空闲连接的最长保留时间
+    - max_per_host: 每个目标服务器的最大连接数(包含使用中和空闲的连接), 超出时等待其他连接释放
+    """
+
+    def __init__(self, max_idle: int = 8, max_age: float = 60, idle_timeout: float = 15, max_per_host: int = 64):
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self.idle_timeout = idle_timeout
+        self.max_per_host = max_per_host
+
+        self._idle: Dict[_Key, Deque[PooledConnection]] = defaultdict(deque)
+        self._connections: Dict[_Key, int] = defaultdict(int)
+        self._waiters: Dict[_Key, Deque[asyncio.Future]] = defaultdict(deque)
+        self._sweeper: Optional[asyncio.TimerHandle] = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def idle_count(self, host: str, port: int) -> int:
+        idle = self._idle.get((host, port))
+        return len(idle) if idle else 0
+
+    async def acquire(self, host: str, port: int) -> PooledConnection:
+        key = (host, port)
+        # 规则重新加载后, 已被拒绝的目标服务器不再复用空闲连接
+        action = route(host)
+        loop = asyncio.get_running_loop()
+        while True:
+            conn = self._pop_idle(key, loop.time())
+            if conn is not None:
+                self.hits += 1
+                conn.reused = True
+                return conn
+
+            if self._connections[key] < self.max_per_host:
+                break
+
+            waiter = loop.create_future()
+            self._waiters[key].append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # 已被唤醒但随后被取消, 唤醒下一个等待者
+                if waiter.done() and not waiter.cancelled():
+                    self._wakeup(key)
+                raise
+
+        self.misses += 1
+        self._connections[key] += 1
+        try:
+            reader, writer, parent = await connect(host, port, action)
+        except BaseException:
+            self._discard(key)
+            raise
+        return PooledConnection(key, reader, writer, loop.time(), parent)
+
+    def release(self, conn: PooledConnection, reusable: bool = True):
+        """归还连接, reusable 为 False 或连接已不可用时关闭连接"""
+        key = conn.key
+        now = asyncio.get_running_loop().time()
+        idle = self._idle[key]
+        if reusable and self._usable(conn, now) and len(idle) < self.max_idle:
+            conn.last_used = now
+            idle.append(conn)
+            self._schedule_sweep()
+        else:
+            conn.close()
+            self._discard(key)
+            if not idle:
+                del self._idle[key]
+        self._wakeup(key)
+
+    def detach(self, conn: PooledConnection):
+        """连接不再归连接池管理, 例如协议升级后转为隧道"""
+        self._discard(conn.key)
+        self._wakeup(conn.key)
+
+    def close(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        for key, idle in list(self._idle.items()):
+            while idle:
+                idle.pop().close()
+                self._discard(key)
+        self._idle.clear()
+
+    def _usable(self, conn: PooledConnection, now: float) -> bool:
+        return not conn.closed and now - conn.created < self.max_age
+
+    def _pop_idle(self, key: _Key, now: float) -> Optional[PooledConnection]:
+        idle = self._idle.get(key)
+        while idle:
+            # 后进先出, 优先复用最近使用过的连接
+            conn = idle.pop()
+            if self._usable(conn, now) and now - conn.last_used < self.idle_timeout:
+                return conn
+            conn.close()
+            self._discard(key)
+        return None
+
+    def _discard(self, key: _Key):
+        self._connections[key] -= 1
+        if self._connections[key] <= 0:
+            del self._connections[key]
+
+    def _wakeup(self, key: _Key):
+        waiters = self._waiters.get(key)
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+        if waiters is not None and not waiters:
+            del self._waiters[key]
+
+    def _schedule_sweep(self):
+        if self._sweeper is None:
+            loop = asyncio.get_running_loop()
+            self._sweeper = loop.call_later(self.idle_timeout, self._sweep)
+
+    def _sweep(self):
+        """定期关闭超时的空闲连接"""
+        self._sweeper = None
+        now = asyncio.get_running_loop().time()
+        for key, idle in list(self._idle.items()):
+            for conn in list(idle):
+                if not self._usable(conn, now) or now - conn.last_used >= self.idle_timeout:
+                    idle.remove(conn)
+                    conn.close()
+                    self._discard(key)
+            if not idle:
+                del self._idle[key]
+            self._wakeup(key)
+
+        if self._idle:
+            self._schedule_sweep()
+
+
+_pool: ContextVar[ConnectionPool] = ContextVar('pool')
+
+
+def get_pool() -> ConnectionPool:
+    pool = _pool.get(None)
+    if pool is None:
+        pool = ConnectionPool()
+        _pool.set(pool)
+    return pool
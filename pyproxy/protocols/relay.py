@@ -0,0 +1,186 @@
+import asyncio
+import logging
+
+from typing import Optional, Tuple
+
+from pyproxy import metrics
+from pyproxy.buffers import BUFFER_POOL, ReadSize
+from pyproxy.ratelimit import Throttle
+from pyproxy.utils import take_buffered
+
+logger = logging.getLogger(__name__)
+
+_Streams = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+
+# 暂停读取的原因: 对端写缓冲区已满或超出限速
+PAUSED_BY_PEER = 1
+PAUSED_BY_THROTTLE = 2
+
+
+class RelayProtocol(asyncio.BufferedProtocol):
+    """隧道的一端, 将本端 transport 读到的数据直接写入对端 transport"""
+
+    __slots__ = (
+        '_tunnel',
+        '_counter',
+        'nbytes',
+        '_size',
+        '_buffer',
+        'transport',
+        'peer',
+        'eof',
+        '_paused',
+        '_resume_handle',
+    )
+
+    def __init__(self, tunnel: 'Tunnel', counter: metrics.Value):
+        self._tunnel = tunnel
+        self._counter = counter
+        self.nbytes = 0
+        # 读取时才从缓冲区池取出缓冲区, 空闲时不持有
+        self._size = ReadSize()
+        self._buffer: Optional[bytearray] = None
+        self.transport: Optional[asyncio.Transport] = None
+        self.peer: Optional['RelayProtocol'] = None
+        self.eof = False
+        self._paused = 0
+        self._resume_handle: Optional[asyncio.TimerHandle] = None
+
+    def connection_made(self, transport: asyncio.BaseTransport):
+        self.transport = transport  # type: ignore
+
+    def get_buffer(self, sizehint: int) -> bytearray:
+        if self._buffer is None:
+            self._buffer = BUFFER_POOL.acquire(self._size.size)
+        return self._buffer
+
+    def buffer_updated(self, nbytes: int):
+        assert self.peer and self.peer.transport and self._buffer is not None
+        buffer, self._buffer = self._buffer, None
+        transport = self.peer.transport
+        transport.write(memoryview(buffer)[:nbytes])
+        self.nbytes += nbytes
+        self._counter.inc(nbytes)
+        self._size.update(nbytes)
+        # 未能一次写完时 transport 可能持有缓冲区的引用, 不能归还给缓冲区池
+        if not transport.get_write_buffer_size():
+            BUFFER_POOL.release(buffer)
+
+        throttle = self._tunnel.throttle
+        if throttle is not None:
+            delay = throttle.consume(nbytes)
+            if delay > 0 and self._resume_handle is None:
+                self.pause(PAUSED_BY_THROTTLE)
+                loop = asyncio.get_running_loop()
+                self._resume_handle = loop.call_later(delay, self._on_throttle_expired)
+
+    def _on_throttle_expired(self):
+        self._resume_handle = None
+        self.resume(PAUSED_BY_THROTTLE)
+
+    def pause(self, reason: int):
+        if not self._paused and not self.eof and self.transport and not self.transport.is_closing():
+            self.transport.pause_reading()
+        self._paused |= reason
+
+    def resume(self, reason: int):
+        self._paused &= ~reason
+        if not self._paused and not self.eof and self.transport and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def eof_received(self) -> bool:
+        assert self.peer and self.peer.transport
+        self.eof = True
+        # 半关闭: 将 EOF 传递给对端, 另一个方向继续转发
+        transport = self.peer.transport
+        if not transport.is_closing() and transport.can_write_eof():
+            transport.write_eof()
+        if self.peer.eof:
+            self._tunnel.close()
+        return True
+
+    def pause_writing(self):
+        # 本端写缓冲区已满, 暂停读取对端
+        assert self.peer
+        self.peer.pause(PAUSED_BY_PEER)
+
+    def resume_writing(self):
+        assert self.peer
+        self.peer.resume(PAUSED_BY_PEER)
+
+    def connection_lost(self, exc: Optional[Exception]):
+        if exc is not None:
+            logger.debug('[RelayProtocol] connection lost: %r', exc)
+        if self._resume_handle is not None:
+            self._resume_handle.cancel()
+            self._resume_handle = None
+        if self._buffer is not None:
+            BUFFER_POOL.release(self._buffer)
+            self._buffer = None
+        self._tunnel.close()
+
+
+class Tunnel:
+    """基于 BufferedProtocol 的双向转发
+
+    握手完成后接管客户端与目标服务器的 transport, 读取数据时从缓冲区池取出缓冲区, 直接写入对端后归还,
+    每个方向的读取大小按最近的读取量调整(见 ReadSize).
+    通过 pause_reading/resume_reading 做流量控制, 设置 throttle 时超出限速的一端暂停读取直到令牌恢复.
+    """
+
+    __slots__ = ('_streams', 'throttle', '_waiter', '_client_protocol', '_target_protocol')
+
+    def __init__(
+        self,
+        client: _Streams,
+        target: _Streams,
+        throttle: Optional[Throttle] = None,
+    ):
+        self._streams: Optional[Tuple[_Streams, _Streams]] = (client, target)
+        self.throttle = throttle
+        self._waiter: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._client_protocol = RelayProtocol(self, metrics.RELAY_BYTES_UPSTREAM)
+        self._target_protocol = RelayProtocol(self, metrics.RELAY_BYTES_DOWNSTREAM)
+        self._client_protocol.peer = self._target_protocol
+        self._target_protocol.peer = self._client_protocol
+
+    def start(self):
+        assert self._streams
+        (client, target), self._streams = self._streams, None
+        pairs = ((self._client_protocol, client), (self._target_protocol, target))
+        for protocol, (_, writer) in pairs:
+            protocol.transport = writer.transport  # type: ignore
+
+        for protocol, (_, writer) in pairs:
+            if writer.transport.is_closing():
+                self.close()
+                return
+
+        for protocol, (reader, writer) in pairs:
+            # 握手阶段 StreamReader 中可能已缓存了部分数据, 需要先转发给对端
+            pending = take_buffered(reader)
+            writer.transport.set_protocol(protocol)
+            if pending:
+                protocol.peer.transport.write(pending)  # type: ignore
+
+            if reader.at_eof():
+                protocol.eof_received()
+            elif not writer.transport.is_reading():  # type: ignore
+                writer.transport.resume_reading()  # type: ignore
+
+    @property
+    def nbytes(self) -> Tuple[int, int]:
+        """(客户端发送的字节数, 目标服务器发送的字节数)"""
+        return self._client_protocol.nbytes, self._target_protocol.nbytes
+
+    async def wait_closed(self):
+        await self._waiter
+
+    def close(self):
+        for protocol in (self._client_protocol, self._target_protocol):
+            if protocol.transport and not protocol.transport.is_closing():
+                protocol.transport.close()
+
+        if not self._waiter.done():
+            self._waiter.set_result(None)
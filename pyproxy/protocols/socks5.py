@@ -1,18 +1,47 @@
 import asyncio
+import errno
 import logging
 import socket
 import struct
 import traceback
-import urllib.parse
 
 from typing import Optional, Tuple, Union
 
-from pyproxy import settings
-from pyproxy.const import HTTP_PROXY_CONNECT_RESPONSE, ProxyCMD, Socks5CMD
-from pyproxy.errors import ConnectError
-from pyproxy.protocols.udp import UdpProtocol
+from pyproxy import metrics, settings
+from pyproxy.accesslog import AccessLog, get_access_log
+from pyproxy.admission import IdleTimer, get_admission
+from pyproxy.auth import get_authenticator, parse_basic_auth
+from pyproxy.buffers import ReadSize
+from pyproxy.const import (
+    HTTP_PROXY_AUTH_REQUIRED_RESPONSE,
+    HTTP_PROXY_BAD_GATEWAY_RESPONSE,
+    HTTP_PROXY_BAD_REQUEST_RESPONSE,
+    HTTP_PROXY_CONNECT_RESPONSE,
+    HTTP_PROXY_FORBIDDEN_RESPONSE,
+    HTTP_PROXY_GATEWAY_TIMEOUT_RESPONSE,
+    ProxyCMD,
+    RelayEngine,
+    Socks5ATYP,
+    Socks5AuthMethod,
+    Socks5CMD,
+    Socks5REP,
+)
+from pyproxy.errors import ConnectError, HttpParseError, RouteRejected
+from pyproxy.http import HttpRequest, HttpResponse, HttpStream, read_request, read_response, relay_body
+from pyproxy.lifecycle import get_lifecycle
+from pyproxy.pool import ConnectionPool, PooledConnection, get_pool
+from pyproxy.protocols.relay import Tunnel
+from pyproxy.protocols.splice import SplicePump
+from pyproxy.protocols.transparent import check_destination, original_dst
+from pyproxy.protocols.udp import get_udp_associations
+from pyproxy.ratelimit import get_rate_limiter
+from pyproxy.routing import Action, has_domain_rules, route
 from pyproxy.settings import _settings
-from pyproxy.utils import Socks5ProxyParser, release_udp_transport
+from pyproxy.sniff import sniff
+from pyproxy.sockopts import get_socket_options
+from pyproxy.upstream import UpstreamProxy, connect
+from pyproxy.utils import Socks5ProxyParser
+from pyproxy.workers import get_release_bus
 
 logger = logging.getLogger(__name__)
 
@@ -21,158 +50,426 @@ class SocksProtocol(asyncio.protocols.Protocol):
 
     READ_LIMIT = 2**16
 
+    # 空闲的长连接隧道数量可能很多, 连接状态不使用 __dict__
+    __slots__ = (
+        '_debug',
+        'client',
+        '_raddr',
+        'target',
+        '_cmd',
+        '_socks_dst',
+        '_dst',
+        '_http_stream',
+        '_http_request',
+        '_throttle',
+        '_bytes_in',
+        '_bytes_out',
+        'idle',
+        '_relay',
+        '_upstream',
+        '_timeout',
+        '_parent',
+        '_user',
+        '_host',
+    )
+
     def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         raddr = writer.transport.get_extra_info('peername')
-        logger.debug(f'accept from: {raddr!r}')
+        # 日志级别在连接建立时确定, 转发过程中不再重复检查
+        self._debug = logger.isEnabledFor(logging.DEBUG)
+        self._debug and logger.debug('accept from: %r', raddr)  # type: ignore
 
         self.client = (reader, writer)
+        self._raddr = raddr
         self.target: Tuple[asyncio.StreamReader, asyncio.StreamWriter] | None = None
-        self._finish: asyncio.Event = asyncio.Event()
         self._cmd: Optional[ProxyCMD] = None
         self._socks_dst: Optional[Tuple[Union[bytes, str], int]] = None
         self._dst: Tuple[str, int] | None = None
+        self._http_stream: Optional[HttpStream] = None
+        self._http_request: Optional[HttpRequest] = None
+        self._throttle = get_rate_limiter().open(raddr[0] if raddr else '')
+        # 访问日志: 从客户端读取与从目标服务器读取的字节数
+        self._bytes_in = 0
+        self._bytes_out = 0
+        # 等待下一个 HTTP 请求的 keep-alive 连接, 停止服务时直接关闭
+        self.idle = False
+        # 进行中的转发, 用于空闲超时判断
+        self._relay: Optional[Union[Tunnel, SplicePump]] = None
+        self._upstream: Optional[HttpStream] = None
+        self._timeout: Optional[str] = None
+        # 经由的上级代理, 连接结束时释放
+        self._parent: Optional[UpstreamProxy] = None
+        # 通过认证的用户名
+        self._user: Optional[str] = None
+        # 目标为 IP 时嗅探到的域名
+        self._host: Optional[str] = None
 
     @staticmethod
     async def handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        await SocksProtocol.serve(reader, writer)
+
+    @staticmethod
+    async def transparent_handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """iptables REDIRECT/TPROXY 转发的连接, 没有握手, 直接连接原始目标地址"""
+        await SocksProtocol.serve(reader, writer, ProxyCMD.TRANSPARENT)
+
+    @staticmethod
+    async def serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, cmd: Optional[ProxyCMD] = None):
+        raddr = writer.transport.get_extra_info('peername')
+        ip = raddr[0] if raddr else ''
+        admission = get_admission()
+        if not admission.admit(ip):
+            # 超出限制时不读取任何数据, 直接释放文件描述符
+            writer.transport.abort()
+            return
+
+        get_socket_options().apply(writer.get_extra_info('socket'))
         proxy = SocksProtocol(reader, writer)
-        await proxy.run()
+        proxy._cmd = cmd
+        lifecycle = get_lifecycle()
+        lifecycle.track(proxy, asyncio.current_task())  # type: ignore
+        try:
+            await proxy.run()
+        except asyncio.CancelledError:
+            # 停止服务或超时取消的连接, 连接已在 run 中关闭, 不再向上传递
+            pass
+        finally:
+            lifecycle.discard(proxy)
+            admission.release(ip)
 
     async def run(self):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        settings = _settings.get()
+        task = asyncio.current_task()
+        assert task
+        active: Optional[metrics.Value] = None
+        idle_timer: Optional[IdleTimer] = None
+        reason = 'closed'
         try:
-            await self.accept()
+            timer = None
+            if settings.handshake_timeout > 0:
+                timer = loop.call_later(settings.handshake_timeout, self.on_timeout, task, 'handshake_timeout')
+            try:
+                await self.accept()
+            except BaseException:
+                metrics.HANDSHAKE_ERRORS_ALL.inc()
+                reason = 'handshake_error'
+                raise
+            finally:
+                timer and timer.cancel()  # type: ignore
+            metrics.HANDSHAKE_SECONDS_ALL.observe(loop.time() - start)
+            if self._cmd is not None:
+                metrics.CONNECTIONS_BY_CMD[self._cmd].inc()
+                active = metrics.CONNECTIONS_ACTIVE_BY_CMD[self._cmd]
+                active.inc()
+            # UDP 关联的空闲超时由 UDP 关联表判断
+            if settings.idle_timeout > 0 and self._cmd != ProxyCMD.SOCKS_UDP:
+                idle_timer = IdleTimer(
+                    settings.idle_timeout, self.activity, lambda: self.on_timeout(task, 'idle_timeout')
+                )
             await self.forward()
+        except asyncio.CancelledError:
+            reason = self._timeout or 'cancelled'
+            raise
         except Exception:
+            if reason == 'closed':
+                reason = 'error'
             logger.warning(traceback.format_exc())
         finally:
+            idle_timer and idle_timer.cancel()  # type: ignore
+            if active is not None:
+                active.dec()
             await self.close()
+            access_log = get_access_log()
+            if access_log is not None:
+                self.log_access(access_log, loop.time() - start, reason)
+
+    def on_timeout(self, task: asyncio.Task, reason: str):
+        self._timeout = reason
+        if reason == 'handshake_timeout':
+            metrics.HANDSHAKE_TIMEOUTS.inc()
+        else:
+            metrics.IDLE_TIMEOUTS.inc()
+        task.cancel()
+
+    def activity(self) -> int:
+        """已转发的字节数, 转发过程中单调递增"""
+        n = self._bytes_in + self._bytes_out
+        if self._http_stream is not None:
+            n += self._http_stream.nbytes
+        if self._upstream is not None:
+            n += self._upstream.nbytes
+        if self._relay is not None:
+            n += sum(self._relay.nbytes)
+        return n
 
     async def close(self):
         self.client and self.client[1] and self.client[1].close()  #type: ignore
         self.target and self.target[1] and self.target[1].close()  #type: ignore
+        self._throttle and self._throttle.close()  #type: ignore
+        if self._parent is not None:
+            self._parent.release()
+            self._parent = None
+
+    async def open_connection(
+        self,
+        host: str,
+        port: int,
+        action: Optional[Action] = None,
+    ) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """连接目标服务器, 配置了上级代理时经由上级代理, action 为已经得到的路由决策"""
+        reader, writer, self._parent = await connect(host, port, action)
+        return reader, writer
+
+    async def sniff_host(self) -> Optional[str]:
+        """从客户端数据中读取域名, 记录在访问日志中"""
+        self._host = await sniff(self.client[0], _settings.get().sniff_timeout)
+        if self._host is None:
+            metrics.SNIFF_NONE.inc()
+        else:
+            metrics.SNIFF_FOUND.inc()
+        return self._host
+
+    async def sniff_and_connect(self, dst: Tuple[str, int]) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """连接目标 IP, 开启嗅探时先按客户端数据中的域名选择路由
 
-    async def output(self, message: bytes, writer: asyncio.StreamWriter, isReceive: bool):
+        连接的仍是原来的 IP, 域名只用于路由规则与访问日志. 目标 IP 同样检查路由规则, 任一被拒绝时拒绝连接,
+        否则使用域名的路由决策. 嗅探读到的数据留在客户端的缓冲区中, 由转发引擎发送.
+        """
+        try:
+            action = route(dst[0])
+            if _settings.get().sniff:
+                host = await self.sniff_host()
+                if host is not None:
+                    action = route(host)
+            return await self.open_connection(*dst, action)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise ConnectError(f'open connection to {dst} fail: {e!r}') from e
+
+    def log_access(self, access_log: AccessLog, duration: float, reason: str):
+        bytes_in = self._bytes_in
+        if self._http_stream is not None:
+            bytes_in += self._http_stream.nbytes
+        cmd = self._cmd.name.lower() if self._cmd is not None else 'unknown'
+        access_log.record(
+            self._raddr, self._dst, cmd, bytes_in, self._bytes_out, duration, reason, self._user, self._host
+        )
+
+    def trace(self, message: bytes, writer: asyncio.StreamWriter, isReceive: bool):
+        """输出收发的数据, 调用方先检查 self._debug, 未开启调试时不格式化"""
         isReceiveChar = '<' if isReceive else '>'
         peername = writer.transport.get_extra_info('peername')
-        prefix = f'{peername}{isReceiveChar}'
-        logger.debug(f'[Output] {prefix!r} {message!r}')
+        logger.debug('[Output] %r %r', f'{peername}{isReceiveChar}', message)
 
     async def accept(self):
         """根据请求信息, 连接目标服务器, 并返回连接对象"""
+        if self._cmd == ProxyCMD.TRANSPARENT:
+            await self.transparent_proxy()
+            return
+
         reader, writer = self.client
         data = await reader.read(self.READ_LIMIT)
         if not data:
             raise ConnectError()
 
-        await self.output(data, writer, True)
+        self._debug and self.trace(data, writer, True)  # type: ignore
 
-        if data and b'HTTP' in data:
+        # socks5 握手以版本号 5 开头, 其他情况按 HTTP 代理处理
+        if data[0] != 5:
             await self.http_proxy(data)
             return
 
-        # TODO: 支持认证
-        if data[1] != 1:
-            raise ConnectError('只接受匿名代理')
+        await self.socks_proxy(data)
 
-        await self.socks_proxy()
+    async def transparent_proxy(self):
+        """目标地址取自内核记录的原始目标地址, 客户端数据原样转发"""
+        settings = _settings.get()
+        dst = original_dst(self.client[1].get_extra_info('socket'), settings.transparent_mode)
+        check_destination(dst, settings.transparent_port)
+        self._dst = dst
+        self.target = await self.sniff_and_connect(dst)
+        self._debug and logger.debug('transparent target: %s,  dst: %s', self.target, dst)  # type: ignore
 
     async def http_proxy(self, data: bytes):
-        self._cmd = ProxyCMD.HTTP
-
         _, writer = self.client
+        # 请求头可能分多次到达, 首次读取的数据作为缓冲区继续读取
+        stream = HttpStream(self.client[0], data, self._throttle, metrics.RELAY_BYTES_UPSTREAM)
+        try:
+            request = await read_request(stream)
+        except HttpParseError:
+            writer.write(HTTP_PROXY_BAD_REQUEST_RESPONSE)
+            await writer.drain()
+            raise
+        if request is None:
+            raise ConnectError()
+        request = await self.http_authenticate(request)
+
         # HTTPS 代理
-        if data.startswith(b'CONNECT'):
+        if request.method == b'CONNECT':
             self._cmd = ProxyCMD.HTTPS
-            lines = data.split(b' ')
-            # TODO ipv6 support
-            host, port = lines[1].split(b':')
-            raddr = (host.decode(), int(port))
+            raddr = request.address(443)
+            self._dst = raddr
 
-            target = await asyncio.open_connection(*raddr)
+            target = await self.http_open_connection(raddr)
             self.target = target
-            if not all(target):
-                logger.debug(f'open connection to {raddr} fail')
-                return None
-            logger.debug('open connection success')
-
             resp = HTTP_PROXY_CONNECT_RESPONSE
-            logger.debug(f'write connect response: \n{resp!r}')
             writer.write(resp)
+            # 客户端可能在收到响应前就发送了隧道数据(如 TLS ClientHello)
+            leftover = stream.leftover()
+            if leftover:
+                target[1].write(leftover)
+            self._bytes_in += stream.nbytes + len(leftover)
             await writer.drain()
-            await self.output(resp, writer, False)
-            logger.debug('write connect response success.')
-
-            self.target = target
+            self._debug and self.trace(resp, writer, False)  # type: ignore
         else:
             self._cmd = ProxyCMD.HTTP
-            headers = {}
-            items, body = data.split(b'\r\n\r\n')
-            headerlines = items.split(b'\r\n')
-            method, addr, version = headerlines[0].split(b' ')
-            for headerline in headerlines[1:]:
-                if not headerline or b':' not in headerline:
-                    continue
-                k, v = headerline.split(b': ', 1)
-                headers[k] = v
-
-            u = urllib.parse.urlparse(addr)
-            # TODO: ipv6
-
-            _addr = u.netloc.split(b':')
-            if len(_addr) == 1:
-                raddr = (_addr[0].decode(), 80)
-            else:
-                raddr = (_addr[0].decode(), int(_addr[1]))
+            # 普通 HTTP 请求在 forward 阶段逐个转发, 第一个请求已经读取
+            self._http_stream = stream
+            self._http_request = request
+
+    async def http_authenticate(self, request: HttpRequest) -> HttpRequest:
+        """配置了认证时检查 Proxy-Authorization, 返回去掉该首部的请求, 失败时返回 407"""
+        authenticator = get_authenticator()
+        if authenticator is None:
+            return request
+        value = request.get_header(b'proxy-authorization')
+        credentials = parse_basic_auth(value) if value else None
+        if credentials is None or not await authenticator.authenticate(*credentials):
+            _, writer = self.client
+            writer.write(HTTP_PROXY_AUTH_REQUIRED_RESPONSE)
+            await writer.drain()
+            raise ConnectError(f'proxy authentication failed: {credentials and credentials[0]!r}')
+        self._user = credentials[0]
+        # 凭据不转发给目标服务器
+        return request.without_header(b'proxy-authorization')
 
-            logger.debug(f'{method!r}, {addr!r}, {version!r}, {headers!r}, {raddr!r}, {body!r}')
+    async def http_open_connection(self, raddr: Tuple[str, int]) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """连接目标服务器, 失败时向客户端返回 502/504"""
+        try:
+            return await self.open_connection(*raddr)
+        except (OSError, asyncio.TimeoutError) as e:
+            await self.http_connect_failed(raddr, e)
+            raise ConnectError(f'open connection to {raddr} fail: {e!r}') from e
 
-            target = await asyncio.open_connection(*raddr)
-            target[1].write(data)
-            await target[1].drain()
-            await self.output(data, target[1], False)
-            self.target = target
+    async def http_connect_failed(self, raddr: Tuple[str, int], exc: BaseException):
+        _, writer = self.client
+        if isinstance(exc, RouteRejected):
+            writer.write(HTTP_PROXY_FORBIDDEN_RESPONSE)
+        elif isinstance(exc, (socket.timeout, asyncio.TimeoutError)):
+            writer.write(HTTP_PROXY_GATEWAY_TIMEOUT_RESPONSE)
+        else:
+            writer.write(HTTP_PROXY_BAD_GATEWAY_RESPONSE)
+        await writer.drain()
 
-    async def socks_proxy(self):
+    async def socks_proxy(self, data: bytes):
         reader, writer = self.client
 
-        # 不需要任何认证
-        ver = b'\x05'
-        method = b'\x00'
-        reply = ver + method
+        # VER NMETHODS METHODS, 配置了认证时只接受用户名密码认证
+        authenticator = get_authenticator()
+        method = Socks5AuthMethod.NO_AUTH if authenticator is None else Socks5AuthMethod.USERNAME_PASSWORD
+        methods = data[2:2 + data[1]] if len(data) > 1 else b''
+        if method not in methods:
+            writer.write(bytes((5, Socks5AuthMethod.NO_ACCEPTABLE)))
+            await writer.drain()
+            raise ConnectError(f'no acceptable authentication method: {methods!r}')
+        reply = bytes((5, method))
         writer.write(reply)
         await writer.drain()
-        await self.output(reply, writer, False)
+        self._debug and self.trace(reply, writer, False)  # type: ignore
+
+        if authenticator is not None:
+            # RFC 1929: VER ULEN UNAME PLEN PASSWD
+            ver, ulen = await reader.readexactly(2)
+            username = (await reader.readexactly(ulen)).decode(errors='replace')
+            plen = (await reader.readexactly(1))[0]
+            password = (await reader.readexactly(plen)).decode(errors='replace')
+            ok = ver == 1 and await authenticator.authenticate(username, password)
+            writer.write(b'\x01\x00' if ok else b'\x01\x01')
+            await writer.drain()
+            if not ok:
+                raise ConnectError(f'authentication failed: {username!r}')
+            self._user = username
 
         data = await reader.read(self.READ_LIMIT)
-        await self.output(data, writer, True)
+        self._debug and self.trace(data, writer, True)  # type: ignore
+        self._bytes_in += len(data)
 
+        if len(data) < 4:
+            raise ConnectError(f'invalid socks5 request: {data!r}')
         cmd = data[1]
 
-        dst, _, _ = Socks5ProxyParser.unpack(data)
+        if data[3] not in (Socks5ATYP.IPV4, Socks5ATYP.HOST, Socks5ATYP.IPV6):
+            await self.allow_socks_proxy(writer, Socks5REP.ADDRESS_TYPE_NOT_SUPPORTED)
+            raise ConnectError(f'not support address type: {data[3]}')
+
+        result = Socks5ProxyParser.parse(data)
+        if result is None:
+            await self.allow_socks_proxy(writer, Socks5REP.GENERAL_FAILURE)
+            raise ConnectError(f'invalid socks5 request: {data!r}')
+        dst, _ = result
         self._dst = dst
 
         # 读取代理类型
         if cmd == Socks5CMD.CONNECT:
             self._cmd = ProxyCMD.SOCKS_CONNECT
-            target = await asyncio.open_connection(*dst)
+            if _settings.get().sniff and data[3] != Socks5ATYP.HOST and has_domain_rules():
+                # 客户端收到回复后才发送数据, 只有嗅探到的域名可能改变路由时才先回复成功, 连接失败时只能直接关闭连接
+                await self.allow_socks_proxy(writer)
+                self.target = await self.sniff_and_connect(dst)
+                return
+            try:
+                target = await self.open_connection(*dst)
+            except (OSError, asyncio.TimeoutError) as e:
+                await self.allow_socks_proxy(writer, self.socks_rep_from_exception(e))
+                raise ConnectError(f'open connection to {dst} fail: {e!r}') from e
             self.target = target
 
         elif cmd == Socks5CMD.BIND:
             self._cmd = ProxyCMD.SOCKS_BIND
+            await self.allow_socks_proxy(writer, Socks5REP.COMMAND_NOT_SUPPORTED)
             raise ConnectError("not support bind request")
 
         elif cmd == Socks5CMD.UDP:
             self._cmd = ProxyCMD.SOCKS_UDP
 
-        logger.debug(f"cmd: {self._cmd},  target: {self.target},  dst: {self._dst}")
+        else:
+            await self.allow_socks_proxy(writer, Socks5REP.COMMAND_NOT_SUPPORTED)
+            raise ConnectError(f'not support command: {cmd}')
+
+        self._debug and logger.debug('cmd: %s,  target: %s,  dst: %s', self._cmd, self.target, self._dst)  # type: ignore
         await self.allow_socks_proxy(writer)
+        if cmd == Socks5CMD.CONNECT and _settings.get().sniff and data[3] != Socks5ATYP.HOST:
+            # 嗅探到的域名不会改变路由, 连接目标服务器后只为访问日志读取域名
+            await self.sniff_host()
 
-    async def allow_socks_proxy(self, writer: asyncio.StreamWriter):
-        """允许客户端连接后, 根据代理设置封装回复
+    @staticmethod
+    def socks_rep_from_exception(exc: BaseException) -> Socks5REP:
+        """将连接目标服务器时的异常映射为 socks5 回复码"""
+        if isinstance(exc, RouteRejected):
+            return Socks5REP.NOT_ALLOWED
+        if isinstance(exc, socket.gaierror):
+            return Socks5REP.HOST_UNREACHABLE
+        if isinstance(exc, (socket.timeout, asyncio.TimeoutError)):
+            return Socks5REP.HOST_UNREACHABLE
+        if isinstance(exc, ConnectionRefusedError):
+            return Socks5REP.CONNECTION_REFUSED
+        if isinstance(exc, OSError):
+            if exc.errno == errno.ECONNREFUSED:
+                return Socks5REP.CONNECTION_REFUSED
+            if exc.errno == errno.ENETUNREACH:
+                return Socks5REP.NETWORK_UNREACHABLE
+            if exc.errno == errno.EHOSTUNREACH:
+                return Socks5REP.HOST_UNREACHABLE
+        return Socks5REP.GENERAL_FAILURE
+
+    async def allow_socks_proxy(self, writer: asyncio.StreamWriter, reply_code: Socks5REP = Socks5REP.SUCCEEDED):
+        """根据代理设置封装回复, reply_code 不为 0 时表示拒绝请求
         """
         settings = _settings.get()
         # TODO: ipv6、host
         ver = b'\x05'
-        rep = b'\x00'
+        rep = bytes((reply_code, ))
         rsv = b'\x00'
         atyp = b'\x01'
         # TODO: proxy_addr 允许使用域名
@@ -192,21 +489,177 @@ class SocksProtocol(asyncio.protocols.Protocol):
 
     async def forward(self):
         if self._cmd == ProxyCMD.SOCKS_UDP:
-            # 根据协议, TCP 连接断开时, 需要同步关闭 UDP 代理
-            await self.wait_closed()
+            # 多进程模式下 UDP 数据报可能由其他 worker 处理
+            bus = get_release_bus()
+            # 配置了认证时, 控制连接存在期间才转发该 IP 的数据报
+            authenticator = get_authenticator()
+            ip = self._raddr[0] if self._raddr else ''
+            if authenticator is not None:
+                authenticator.allow_udp(ip)
+                bus and bus.publish_udp_client(ip, True)  # type: ignore
+            try:
+                # 根据协议, TCP 连接断开时, 需要同步关闭 UDP 代理
+                await self.wait_closed()
+            finally:
+                if authenticator is not None:
+                    authenticator.disallow_udp(ip)
+                    bus and bus.publish_udp_client(ip, False)  # type: ignore
             assert self._dst
-            release_udp_transport(self._dst, UdpProtocol.MANAGER, UdpProtocol.LAST_ACTIVITY)
+            get_udp_associations().release(self._dst)
+            if bus is not None:
+                bus.publish(self._dst)
             return
 
+        if self._cmd == ProxyCMD.HTTP:
+            await self.http_forward()
+            return
+
+        await self.relay()
+
+    async def relay(self):
+        assert self.client and self.target
+
+        relay = _settings.get().relay
+        if relay == RelayEngine.SPLICE:
+            # CONNECT 隧道建立后数据不透明, 交由内核直接搬运
+            if self._cmd in (ProxyCMD.HTTPS, ProxyCMD.SOCKS_CONNECT,
+                             ProxyCMD.TRANSPARENT) and SplicePump.can_takeover(self.client, self.target):
+                pump = SplicePump(self.client, self.target, self._throttle)
+                self._relay = pump
+                try:
+                    await pump.start()
+                    await pump.wait_closed()
+                finally:
+                    pump.close()
+                    self._relay = None
+                    self.add_nbytes(*pump.nbytes)
+                return
+            relay = RelayEngine.BUFFERED
+
+        if relay == RelayEngine.BUFFERED:
+            tunnel = Tunnel(self.client, self.target, throttle=self._throttle)
+            self._relay = tunnel
+            try:
+                tunnel.start()
+                await tunnel.wait_closed()
+            finally:
+                tunnel.close()
+                self._relay = None
+                self.add_nbytes(*tunnel.nbytes)
+            return
+
+        # 目标服务器到客户端的方向在当前任务中转发, 只为另一个方向创建任务.
+        # 客户端方向先结束时关闭目标服务器连接(发送完已写入的数据), 当前任务随之读到 EOF
         client, target = self.client, self.target
-        assert client and target
+        upstream = asyncio.ensure_future(self.receive_and_forward(target, client))
+        upstream.add_done_callback(lambda _: target[1].close())
+        try:
+            await self.receive_and_forward(client, target)
+        finally:
+            upstream.done() or upstream.cancel()  # type:ignore
 
-        a: asyncio.Future = asyncio.ensure_future(self.receive_and_forward(client, target))
-        b: asyncio.Future = asyncio.ensure_future(self.receive_and_forward(target, client))
-        await self._finish.wait()
+    def add_nbytes(self, bytes_in: int, bytes_out: int):
+        self._bytes_in += bytes_in
+        self._bytes_out += bytes_out
 
-        a.done() or a.cancel()  # type:ignore
-        b.done() or b.cancel()  # type:ignore
+    async def http_forward(self):
+        """转发普通 HTTP 请求
+
+        按照 HTTP/1.1 的消息长度规则逐个转发请求与响应, 上游连接从连接池获取,
+        客户端与上游都保持连接时, 同一个客户端连接可以发送多个请求.
+        """
+        assert self._http_stream
+        stream = self._http_stream
+        _, writer = self.client
+        pool = get_pool()
+        lifecycle = get_lifecycle()
+        while True:
+            request, self._http_request = self._http_request, None
+            if request is None:
+                self.idle = True
+                try:
+                    request = await read_request(stream)
+                except HttpParseError:
+                    writer.write(HTTP_PROXY_BAD_REQUEST_RESPONSE)
+                    await writer.drain()
+                    raise
+                finally:
+                    self.idle = False
+                # 同一连接上的后续请求同样需要认证, 结果通常命中缓存
+                if request is not None:
+                    request = await self.http_authenticate(request)
+            if request is None:
+                return
+
+            raddr = request.address()
+            self._dst = raddr
+            self._debug and logger.debug(  # type: ignore
+                '%r, %r, %r, %r', request.method, request.target, request.version, raddr
+            )
+
+            conn, upstream, response = await self.http_roundtrip(pool, request, raddr)
+            try:
+                # 1xx 响应直接转发, 继续等待最终响应
+                while 100 <= response.status < 200 and response.status != 101:
+                    writer.write(response.raw)
+                    response = await read_response(upstream)
+
+                writer.write(response.raw)
+                if response.status == 101:
+                    # 协议升级后转为隧道, 连接不再归还连接池
+                    pool.detach(conn)
+                    self._parent, conn.parent = conn.parent, None
+                    self.target = (conn.reader, conn.writer)
+                    conn.writer.write(stream.leftover())
+                    writer.write(upstream.leftover())
+                    await self.relay()
+                    return
+
+                complete = await relay_body(upstream, writer, response, response.has_body(request.method))
+                await writer.drain()
+            except BaseException:
+                pool.release(conn, False)
+                raise
+            finally:
+                self._upstream = None
+                self._bytes_out += upstream.nbytes
+
+            keep_alive = complete and request.keep_alive and response.keep_alive
+            pool.release(conn, keep_alive and not upstream.leftover())
+            if not keep_alive or lifecycle.draining:
+                return
+
+    async def http_roundtrip(self, pool: ConnectionPool, request: HttpRequest,
+                             raddr: Tuple[str, int]) -> Tuple[PooledConnection, HttpStream, HttpResponse]:
+        """发送请求并读取响应头
+
+        复用的空闲连接可能已被上游关闭, 请求没有消息体时可以安全地换一个连接重试.
+        """
+        assert self._http_stream
+        while True:
+            try:
+                conn = await pool.acquire(*raddr)
+            except (OSError, asyncio.TimeoutError) as e:
+                await self.http_connect_failed(raddr, e)
+                raise
+
+            upstream = HttpStream(conn.reader, throttle=self._throttle, counter=metrics.RELAY_BYTES_DOWNSTREAM)
+            self._upstream = upstream
+            try:
+                conn.writer.write(request.origin_form())
+                await relay_body(self._http_stream, conn.writer, request, request.has_body)
+                response = await read_response(upstream)
+                return conn, upstream, response
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                pool.release(conn, False)
+                partial = isinstance(e, asyncio.IncompleteReadError) and e.partial
+                if conn.reused and not request.has_body and not partial:
+                    logger.debug(f'pooled connection {conn!r} closed by peer, retry')
+                    continue
+                raise
+            except BaseException:
+                pool.release(conn, False)
+                raise
 
     async def receive_and_forward(
         self,
@@ -215,23 +668,41 @@ class SocksProtocol(asyncio.protocols.Protocol):
         receiver: Tuple[asyncio.StreamReader,
                         asyncio.StreamWriter]
     ):
+        upstream = receiver is self.client
+        counter = metrics.RELAY_BYTES_UPSTREAM if upstream else metrics.RELAY_BYTES_DOWNSTREAM
+        debug = self._debug
+        reader, writer = receiver[0], sender[1]
+        transport = writer.transport
+        # 每个方向独立调整读取大小, StreamReader 中已缓存的多个数据段合并为一次写入
+        size = ReadSize()
         try:
-            while not self._finish.is_set():
-                data = await receiver[0].read(self.READ_LIMIT)
+            while True:
+                data = await reader.read(size.size)
                 if not data:
                     return
 
-                sender[1].write(data)
-                await sender[1].drain()
-                await self.output(data, sender[1], False)
+                nbytes = len(data)
+                size.update(nbytes)
+                counter.inc(nbytes)
+                if upstream:
+                    self._bytes_in += nbytes
+                else:
+                    self._bytes_out += nbytes
+                writer.write(data)
+                # 数据已全部写入 socket 时不需要等待
+                if transport.get_write_buffer_size() or transport.is_closing():
+                    await writer.drain()
+                if self._throttle is not None:
+                    # 超出限速时暂停读取, StreamReader 缓冲区写满后 transport 也会暂停读取
+                    delay = self._throttle.consume(nbytes)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                debug and self.trace(data, writer, False)  # type: ignore
         except ConnectionResetError:
-            logging.debug(traceback.format_exc())
+            debug and logger.debug(traceback.format_exc())  # type: ignore
         except Exception:
             logger.warning(traceback.format_exc())
         finally:
-            # _finish 可能由另一端关闭
-            if not self._finish.is_set():
-                self._finish.set()
-            raddr = sender[1].transport.get_extra_info('peername')
-            if raddr:
-                logger.debug(f'{raddr} lost connection.')
+            if debug:
+                raddr = sender[1].transport.get_extra_info('peername')
+                raddr and logger.debug('%r lost connection.', raddr)  # type: ignore
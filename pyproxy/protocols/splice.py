@@ -0,0 +1,276 @@
+import asyncio
+import logging
+import os
+import socket
+
+from typing import Callable, List, Optional, Tuple
+
+from pyproxy import metrics
+from pyproxy.ratelimit import Throttle
+from pyproxy.utils import take_buffered
+
+logger = logging.getLogger(__name__)
+
+SPLICE_SUPPORTED = hasattr(os, 'splice')
+
+
+class _SpliceDirection:
+    """单向的 splice 转发: src socket -> pipe -> dst socket"""
+
+    CHUNK = 2**16
+
+    __slots__ = (
+        '_loop',
+        '_src',
+        '_dst',
+        '_on_done',
+        '_counter',
+        '_throttle',
+        '_rpipe',
+        '_wpipe',
+        '_flags',
+        '_pending',
+        '_eof',
+        '_reading',
+        '_writing',
+        'done',
+        'nbytes',
+        '_resume_handle',
+    )
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        src: socket.socket,
+        dst: socket.socket,
+        on_done: Callable[['_SpliceDirection',
+                           Optional[Exception]],
+                          None],
+        counter: metrics.Value,
+        throttle: Optional[Throttle] = None,
+    ):
+        self._loop = loop
+        self._src = src
+        self._dst = dst
+        self._on_done = on_done
+        self._counter = counter
+        self._throttle = throttle
+        self._resume_handle: Optional[asyncio.TimerHandle] = None
+        self._rpipe, self._wpipe = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        self._flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        self._pending = 0
+        self._eof = False
+        self._reading = False
+        self._writing = False
+        self.done = False
+        self.nbytes = 0
+
+    def start(self, eof: bool = False):
+        if eof:
+            self._eof = True
+            self._finish()
+            return
+        self._add_reader()
+
+    def _add_reader(self):
+        if not self._reading and self._resume_handle is None:
+            self._reading = True
+            self._loop.add_reader(self._src.fileno(), self._on_readable)
+
+    def _remove_reader(self):
+        if self._reading:
+            self._reading = False
+            self._loop.remove_reader(self._src.fileno())
+
+    def _add_writer(self):
+        if not self._writing:
+            self._writing = True
+            self._loop.add_writer(self._dst.fileno(), self._on_writable)
+
+    def _remove_writer(self):
+        if self._writing:
+            self._writing = False
+            self._loop.remove_writer(self._dst.fileno())
+
+    def _on_readable(self):
+        try:
+            n = os.splice(self._src.fileno(), self._wpipe, self.CHUNK, flags=self._flags)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._fail(e)
+            return
+
+        if n == 0:
+            self._eof = True
+            self._remove_reader()
+            if not self._pending:
+                self._finish()
+            return
+
+        self._pending += n
+        if self._throttle is not None:
+            delay = self._throttle.consume(n)
+            if delay > 0:
+                # 超出限速, 暂停读取直到令牌恢复
+                self._remove_reader()
+                self._resume_handle = self._loop.call_later(delay, self._on_throttle_expired)
+        self._flush()
+
+    def _on_throttle_expired(self):
+        self._resume_handle = None
+        if not self._pending and not self.done:
+            self._add_reader()
+
+    def _on_writable(self):
+        self._flush()
+
+    def _flush(self):
+        while self._pending:
+            try:
+                n = os.splice(self._rpipe, self._dst.fileno(), self._pending, flags=self._flags)
+            except BlockingIOError:
+                # 对端写缓冲区已满, 暂停读取直到可写
+                self._remove_reader()
+                self._add_writer()
+                return
+            except OSError as e:
+                self._fail(e)
+                return
+            self._pending -= n
+            self.nbytes += n
+            self._counter.inc(n)
+
+        self._remove_writer()
+        if self._eof:
+            self._finish()
+        else:
+            self._add_reader()
+
+    def _finish(self):
+        # 半关闭: 将 EOF 传递给对端
+        try:
+            self._dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        self._complete(None)
+
+    def _fail(self, exc: Exception):
+        self._complete(exc)
+
+    def _complete(self, exc: Optional[Exception]):
+        if self.done:
+            return
+        self.done = True
+        self.close()
+        self._on_done(self, exc)
+
+    def close(self):
+        if self._resume_handle is not None:
+            self._resume_handle.cancel()
+            self._resume_handle = None
+        self._remove_reader()
+        self._remove_writer()
+        for fd in (self._rpipe, self._wpipe):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self._rpipe = self._wpipe = -1
+
+
+class SplicePump:
+    """基于 Linux splice(2) 的双向转发
+
+    握手完成后从 StreamWriter 的 transport 中接管 socket, 通过每个方向一对 pipe 在内核中搬运数据,
+    数据不进入用户态. 读写事件通过事件循环的 add_reader/add_writer 驱动.
+    """
+
+    __slots__ = ('client', 'target', 'throttle', '_loop', '_waiter', '_socks', '_directions')
+
+    def __init__(
+        self,
+        client: Tuple[asyncio.StreamReader,
+                      asyncio.StreamWriter],
+        target: Tuple[asyncio.StreamReader,
+                      asyncio.StreamWriter],
+        throttle: Optional[Throttle] = None,
+    ):
+        self.client = client
+        self.target = target
+        self.throttle = throttle
+        self._loop = asyncio.get_running_loop()
+        self._waiter: asyncio.Future = self._loop.create_future()
+        self._socks: List[socket.socket] = []
+        self._directions: List[_SpliceDirection] = []
+
+    @staticmethod
+    def can_takeover(*streams: Tuple[asyncio.StreamReader, asyncio.StreamWriter]) -> bool:
+        """transport 写缓冲区中仍有数据时无法安全地接管 socket"""
+        return all(
+            not writer.transport.is_closing() and not writer.transport.get_write_buffer_size()
+            for _, writer in streams
+        )
+
+    async def start(self):
+        pending: List[bytes] = []
+        eofs: List[bool] = []
+        for reader, writer in (self.client, self.target):
+            transport = writer.transport
+            transport.pause_reading()  # type: ignore
+            sock = transport.get_extra_info('socket')
+            dup = socket.socket(fileno=os.dup(sock.fileno()))
+            dup.setblocking(False)
+            self._socks.append(dup)
+
+            # 握手阶段 StreamReader 中可能已缓存了部分数据
+            pending.append(take_buffered(reader))
+            eofs.append(reader.at_eof())
+            transport.close()
+
+        client, target = self._socks
+        try:
+            if pending[0]:
+                await self._loop.sock_sendall(target, pending[0])
+            if pending[1]:
+                await self._loop.sock_sendall(client, pending[1])
+        except OSError:
+            self.close()
+            return
+
+        self._directions = [
+            _SpliceDirection(self._loop, client, target, self._on_direction_done, metrics.RELAY_BYTES_UPSTREAM,
+                             self.throttle),
+            _SpliceDirection(self._loop, target, client, self._on_direction_done, metrics.RELAY_BYTES_DOWNSTREAM,
+                             self.throttle),
+        ]
+        for direction, eof in zip(self._directions, eofs):
+            direction.start(eof)
+
+    def _on_direction_done(self, direction: _SpliceDirection, exc: Optional[Exception]):
+        if exc is not None:
+            logger.debug('[SplicePump] %r', exc)
+            self.close()
+        elif all(d.done for d in self._directions):
+            self.close()
+
+    @property
+    def nbytes(self) -> Tuple[int, int]:
+        """(客户端发送的字节数, 目标服务器发送的字节数)"""
+        if not self._directions:
+            return 0, 0
+        return self._directions[0].nbytes, self._directions[1].nbytes
+
+    async def wait_closed(self):
+        await self._waiter
+
+    def close(self):
+        for direction in self._directions:
+            direction.done = True
+            direction.close()
+        for sock in self._socks:
+            sock.close()
+        self._socks.clear()
+
+        if not self._waiter.done():
+            self._waiter.set_result(None)
@@ -0,0 +1,250 @@
+import asyncio
+import logging
+import socket
+import struct
+import sys
+
+from typing import Any, List, Optional, Tuple
+
+from pyproxy import metrics
+from pyproxy.const import TransparentMode
+from pyproxy.errors import ConnectError, RouteRejected
+from pyproxy.protocols.udp import BATCH_SIZE, MAX_DATAGRAM_SIZE, UdpAssociation, UdpServer
+from pyproxy.ratelimit import Throttle, get_rate_limiter
+from pyproxy.routing import route
+
+logger = logging.getLogger(__name__)
+
+# linux/netfilter_ipv4.h 与 linux/netfilter_ipv6/ip6_tables.h, socket 模块没有定义这些常量
+SO_ORIGINAL_DST = 80
+IP6T_SO_ORIGINAL_DST = 80
+IP_TRANSPARENT = getattr(socket, 'IP_TRANSPARENT', 19)
+IPV6_TRANSPARENT = 75
+# 辅助数据的类型与 setsockopt 的选项相同
+IP_RECVORIGDSTADDR = 20
+IPV6_RECVORIGDSTADDR = 74
+
+_SOCKADDR_IN_SIZE = 16
+_SOCKADDR_IN6_SIZE = 28
+_ANCDATA_SIZE = socket.CMSG_SPACE(_SOCKADDR_IN6_SIZE)
+
+
+def unmap(host: str) -> str:
+    """双栈 socket 上的 IPv4 地址形如 ::ffff:1.2.3.4, 转换为 IPv4 地址"""
+    if host.startswith('::ffff:') and '.' in host:
+        return host[7:]
+    return host
+
+
+def parse_sockaddr(data: bytes) -> Tuple[str, int]:
+    """解析内核返回的 sockaddr_in/sockaddr_in6, 地址族为本机字节序, 端口与地址为网络字节序"""
+    family = int.from_bytes(data[:2], sys.byteorder)
+    if family == socket.AF_INET and len(data) >= _SOCKADDR_IN_SIZE:
+        port, = struct.unpack('!H', data[2:4])
+        return socket.inet_ntop(socket.AF_INET, data[4:8]), port
+    if family == socket.AF_INET6 and len(data) >= _SOCKADDR_IN6_SIZE:
+        port, = struct.unpack('!H', data[2:4])
+        return unmap(socket.inet_ntop(socket.AF_INET6, data[8:24])), port
+    raise ValueError(f'unsupported sockaddr: {data!r}')
+
+
+def original_dst(sock: Any, mode: TransparentMode) -> Tuple[str, int]:
+    """透明代理连接的原始目标地址
+
+    - redirect: iptables REDIRECT 修改了目标地址, 通过 SO_ORIGINAL_DST 从 conntrack 查询
+    - tproxy: 连接保持原始目标地址, 即 socket 的本地地址
+    """
+    try:
+        if mode == TransparentMode.TPROXY:
+            host, port = sock.getsockname()[:2]
+            return unmap(host), port
+        # 双栈 socket 上的 IPv4 连接由 IPv4 的 conntrack 记录
+        if sock.family == socket.AF_INET6 and '.' not in sock.getsockname()[0]:
+            data = sock.getsockopt(socket.IPPROTO_IPV6, IP6T_SO_ORIGINAL_DST, _SOCKADDR_IN6_SIZE)
+        else:
+            data = sock.getsockopt(socket.SOL_IP, SO_ORIGINAL_DST, _SOCKADDR_IN_SIZE)
+        return parse_sockaddr(data)
+    except (OSError, ValueError) as e:
+        raise ConnectError(f'get original destination failed: {e!r}') from e
+
+
+def _orig_dst_from_ancdata(ancdata: List[Tuple[int, int, bytes]]) -> Optional[Tuple[str, int]]:
+    for level, type_, data in ancdata:
+        if (level, type_) in ((socket.SOL_IP, IP_RECVORIGDSTADDR), (socket.IPPROTO_IPV6, IPV6_RECVORIGDSTADDR)):
+            try:
+                return parse_sockaddr(data)
+            except ValueError:
+                return None
+    return None
+
+
+def _set_transparent(sock: socket.socket):
+    """需要 CAP_NET_ADMIN, 开启后可以接收与发送目标地址不属于本机的数据包"""
+    if sock.family == socket.AF_INET6:
+        sock.setsockopt(socket.IPPROTO_IPV6, IPV6_TRANSPARENT, 1)
+    sock.setsockopt(socket.SOL_IP, IP_TRANSPARENT, 1)
+
+
+async def transparent_socket(host: str, port: int, type_: int, mode: TransparentMode) -> socket.socket:
+    """创建透明代理的监听 socket, tproxy 模式在绑定前开启 IP_TRANSPARENT
+
+    iptables 配置示例, 透明代理端口为 7070:
+
+        # redirect
+        iptables -t nat -A PREROUTING -p tcp -j REDIRECT --to-ports 7070
+        # 本机发出的连接, 排除代理自身的连接以免循环
+        iptables -t nat -A OUTPUT -p tcp -m owner ! --uid-owner pyproxy -j REDIRECT --to-ports 7070
+
+        # tproxy
+        iptables -t mangle -A PREROUTING -p tcp -j TPROXY --on-port 7070 --tproxy-mark 1
+        iptables -t mangle -A PREROUTING -p udp -j TPROXY --on-port 7070 --tproxy-mark 1
+        ip rule add fwmark 1 lookup 100
+        ip route add local 0.0.0.0/0 dev lo table 100
+
+    可以在 network namespace 中验证: 客户端在独立的 namespace 中通过 veth 以代理所在的 namespace 为网关,
+    规则配置在代理所在 namespace 的 PREROUTING 链上.
+    """
+    loop = asyncio.get_running_loop()
+    infos = await loop.getaddrinfo(host, port, type=type_, flags=socket.AI_PASSIVE)
+    family, type_, proto, _, sockaddr = infos[0]
+    sock = socket.socket(family, type_, proto)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if mode == TransparentMode.TPROXY:
+            _set_transparent(sock)
+            if type_ == socket.SOCK_DGRAM:
+                sock.setsockopt(socket.SOL_IP, IP_RECVORIGDSTADDR, 1)
+                if family == socket.AF_INET6:
+                    sock.setsockopt(socket.IPPROTO_IPV6, IPV6_RECVORIGDSTADDR, 1)
+        sock.bind(sockaddr)
+        sock.setblocking(False)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+def check_destination(dst: Tuple[str, int], port: int):
+    """直接连接透明代理端口时原始目标地址就是代理自身, 转发会连接回自身.
+
+    tproxy 模式下代理自身可能绑定在任意本地地址上, 只比较端口, 透明代理端口应避开需要转发的端口.
+    """
+    if dst[1] == port:
+        raise ConnectError(f'not a redirected connection: {dst}')
+
+
+class TransparentUdpAssociation(UdpAssociation):
+    """一个 (客户端地址, 目标地址) 对应的 UDP 转发
+
+    回复通过绑定在目标地址上的透明 socket 发送, 客户端看到的来源地址就是目标服务器.
+    """
+
+    cmd = 'transparent_udp'
+
+    def __init__(
+        self,
+        server: UdpServer,
+        addr: Tuple[str, int],
+        dst: Tuple[str, int],
+        sock: socket.socket,
+        reply_sock: socket.socket,
+        throttle: Optional[Throttle] = None,
+    ):
+        super().__init__(server, addr, b'', sock, throttle, dst)
+        self.key = (addr, dst)
+        self._reply_sock = reply_sock
+
+    def __repr__(self):
+        return f'<TransparentUdpAssociation addr={self.addr} dst={self.dst}>'
+
+    def reply(self, data: memoryview):
+        try:
+            self._reply_sock.send(data)
+            metrics.UDP_DATAGRAMS_DOWNSTREAM.inc()
+        except BlockingIOError:
+            metrics.UDP_DROPPED_BUFFER_FULL.inc()
+        except OSError as e:
+            logger.warning(f'[TransparentUdpAssociation] send to {self.addr} failed: {e!r}')
+
+    def close(self, reason: str = 'closed'):
+        super().close(reason)
+        self._reply_sock.close()
+
+
+class TransparentUdpServer(UdpServer):
+    """iptables TPROXY 转发的 UDP 数据报
+
+    监听 socket 开启 IP_RECVORIGDSTADDR, 每个数据报的原始目标地址从辅助数据中读取.
+    目标地址都是 IP, 不需要解析域名, 新的关联同步建立. 透明代理没有认证信息, 只检查路由规则.
+    """
+
+    def __init__(self, sock: socket.socket):
+        super().__init__(sock)
+        self._port = sock.getsockname()[1]
+
+    @classmethod
+    async def create(cls, host: str, port: int, sock: Optional[socket.socket] = None) -> 'UdpServer':
+        if sock is None:
+            sock = await transparent_socket(host, port, socket.SOCK_DGRAM, TransparentMode.TPROXY)
+        return await super().create(host, port, sock)
+
+    def _on_readable(self):
+        for _ in range(BATCH_SIZE):
+            try:
+                data, ancdata, _, addr = self.sock.recvmsg(MAX_DATAGRAM_SIZE, _ANCDATA_SIZE)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                logger.warning(f'[TransparentUdpServer] error received: {e!r}')
+                return
+            dst = _orig_dst_from_ancdata(ancdata)
+            try:
+                if dst is None:
+                    raise ConnectError('missing original destination')
+                check_destination(dst, self._port)
+            except ConnectError as e:
+                logger.debug('drop datagram from %r: %r', addr, e)
+                metrics.UDP_DROPPED_INVALID.inc()
+                continue
+            self.forward(data, (unmap(addr[0]), addr[1]), dst)
+
+    def forward(self, data: bytes, addr: Tuple[str, int], dst: Tuple[str, int]):
+        key = (addr, dst)
+        association = self.table.get(key)
+        if association is not None:
+            self.table.touch(key)
+            association.send(data)
+            return
+
+        logger.debug('associate addr: %r, dst: %r, associations: %d', addr, dst, len(self.table))
+        try:
+            route(dst[0])
+        except RouteRejected:
+            logger.debug('drop datagram from %r to rejected %r', addr, dst)
+            metrics.UDP_DROPPED_REJECTED.inc()
+            return
+
+        family = socket.AF_INET6 if ':' in dst[0] else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        reply_sock = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            sock.setblocking(False)
+            sock.connect(dst)
+            # 同一目标地址的多个关联各自绑定, 需要 SO_REUSEADDR
+            reply_sock.setblocking(False)
+            reply_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            _set_transparent(reply_sock)
+            reply_sock.bind(dst)
+            reply_sock.connect(addr)
+        except OSError as e:
+            sock.close()
+            reply_sock.close()
+            logger.warning(f'associate {addr} to {dst} failed: {e!r}')
+            return
+
+        association = TransparentUdpAssociation(self, addr, dst, sock, reply_sock, get_rate_limiter().open(addr[0]))
+        self.table.add(association)
+        association.start(self._loop)
+        association.send(data)
@@ -1,113 +1,318 @@
 import asyncio
 import logging
-import time
+import socket
 
-from collections import defaultdict
-from typing import Dict, Tuple, Union
+from contextvars import ContextVar
+from typing import Dict, Hashable, Optional, Sequence, Tuple
 
-from pyproxy._types import UDP_MAPPING_TABLE_TYPE
+from pyproxy import metrics
+from pyproxy.accesslog import get_access_log
+from pyproxy.auth import get_authenticator
+from pyproxy.errors import RouteRejected
+from pyproxy.ratelimit import Throttle, get_rate_limiter
+from pyproxy.resolver import get_resolver
+from pyproxy.routing import route
 from pyproxy.settings import _settings
-from pyproxy.utils import Socks5ProxyParser, release_udp_transport
+from pyproxy.timerwheel import TimerWheel
+from pyproxy.utils import Socks5ProxyParser
 
 logger = logging.getLogger(__name__)
 
+# 单次可读事件最多连续读取的数据报数量, 避免一个繁忙的 socket 占用事件循环
+BATCH_SIZE = 64
+MAX_DATAGRAM_SIZE = 2**16
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
 
-class UdpForwardProtocol(asyncio.protocols.DatagramProtocol):
+
+class UdpAssociation:
+    """一个客户端地址对应的 UDP 转发, 持有连接到目标服务器的非阻塞 socket
+
+    目标服务器的回复读入预分配的缓冲区, 与 socks5 头部一起通过 sendmsg 发送给客户端, 不拼接数据.
+    """
+
+    # 访问日志中记录的命令
+    cmd = 'socks_udp'
 
     def __init__(
         self,
-        manager: UDP_MAPPING_TABLE_TYPE,
-        last_activity: Dict[Tuple[str,
-                                  int],
-                            Union[int,
-                                  float]],
+        server: 'UdpServer',
+        addr: Tuple[str, int],
         header: bytes,
-        dst_transport: asyncio.transports.DatagramTransport,
-        dst: Tuple[str,
-                   int]
+        sock: socket.socket,
+        throttle: Optional[Throttle] = None,
+        dst: Optional[Tuple[str, int]] = None,
     ):
-        self._header = header
-        self._dst_transport = dst_transport
-        self._dst = dst
-        self._last_activity = last_activity
-        self._manager = manager
-        logger.info(f"[UdpForwardProtocol] {dst}")
+        self.addr = addr
+        # 关联表中的键, socks5 按客户端地址区分关联
+        self.key: Hashable = addr
+        self.header = header
+        self.throttle = throttle
+        self.dst = dst
+        # 访问日志: 客户端发送与目标服务器回复的字节数
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._started = 0.0
+        self._server = server
+        self._sock = sock
+        self._buffer = bytearray(MAX_DATAGRAM_SIZE)
+        self._view = memoryview(self._buffer)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
 
     def __repr__(self):
-        return f'<UdpForwardProtocol dst={self._dst}>'
+        return f'<UdpAssociation addr={self.addr}>'
 
-    def connection_made(self, transport: asyncio.transports.DatagramTransport):  # type: ignore[override]
-        self.transport = transport
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self._started = loop.time()
+        loop.add_reader(self._sock.fileno(), self._on_readable)
 
-    def datagram_received(self, data: bytes, addr: Tuple[str, int]):
-        logger.debug(f'[UdpForwardProtocol] datagram_received, {addr!r}, {data!r}')
-        self.sendto(data, self._dst)
-
-    def sendto(self, data: bytes, addr: Tuple[str, int]):
-        self._dst_transport.sendto(self._header + data, addr)
-        self._last_activity[self._dst] = time.time()
-
-    def error_received(self, exc):
-        logger.warning(f'[UdpForwardProtocol] error received:{exc!r}\n\n')
-        release_udp_transport(self._dst, self._manager, self._last_activity)
-
-    def connection_lost(self, exc):
-        if exc is not None:
-            logger.warning(f'[UdpForwardProtocol] connection lost:{exc!r}\n\n')
-        logger.debug(f'[UdpForwardProtocol] connection lost: {self._dst}')
-        release_udp_transport(self._dst, self._manager, self._last_activity)
-
-
-class UdpProtocol(asyncio.DatagramProtocol):
-
-    KEEPALIVE_LOOP_WAIT = 1
-    MANAGER: Dict[Tuple[str, int], Tuple[asyncio.DatagramTransport, asyncio.BaseProtocol]] = {}
-    LAST_ACTIVITY: Dict[Tuple[str, int], float] = defaultdict(int)
-
-    def __init__(self):
-        self._manager: Dict[Tuple[str, int], Tuple[asyncio.BaseTransport, asyncio.BaseProtocol]] = {}
-        self._last_activity: Dict[Tuple[str, int], float] = defaultdict(int)
-        asyncio.ensure_future(self.keepalive_loop())
-
-    async def keepalive_loop(self):
-        # 释放超时连接
-        settings = _settings.get()
-        while True:
-            await asyncio.sleep(self.KEEPALIVE_LOOP_WAIT)
-            cur = time.time()
-            keys = list(self._last_activity.keys())
-            for dst in keys:
-                v = self._last_activity[dst]
-                if v + settings.udp_keep_alive_timeout >= cur:
-                    continue
-                release_udp_transport(dst, self.MANAGER, self.LAST_ACTIVITY)
-
-    def connection_made(self, transport: asyncio.transports.DatagramTransport):  # type: ignore[override]
-        self.transport = transport
-
-    def datagram_received(self, data, addr):
-        self._last_activity[addr] = time.time()
+    def send(self, message: bytes):
+        """转发客户端的数据报, 发送缓冲区已满时丢弃"""
+        # UDP 无法暂停对端发送, 超出限速的数据报直接丢弃
+        if self.throttle is not None and not self.throttle.try_consume(len(message)):
+            metrics.UDP_DROPPED_THROTTLED.inc()
+            return
+        try:
+            self._sock.send(message)
+            self.bytes_in += len(message)
+            metrics.UDP_DATAGRAMS_UPSTREAM.inc()
+        except BlockingIOError:
+            metrics.UDP_DROPPED_BUFFER_FULL.inc()
+        except OSError as e:
+            logger.warning(f'[UdpAssociation] send to target failed: {e!r}')
+            self._server.table.release(self.key, 'error')
+
+    def _on_readable(self):
+        for _ in range(BATCH_SIZE):
+            try:
+                n = self._sock.recv_into(self._buffer)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                # 例如目标端口不可达时收到的 ICMP 错误
+                logger.warning(f'[UdpAssociation] error received: {e!r}')
+                self._server.table.release(self.key, 'error')
+                return
+
+            if self.throttle is not None and not self.throttle.try_consume(n):
+                metrics.UDP_DROPPED_THROTTLED.inc()
+                continue
+            self.bytes_out += n
+            self.reply(self._view[:n])
+            self._server.table.touch(self.key)
+
+    def reply(self, data: memoryview):
+        """将目标服务器的回复发送给客户端"""
+        self._server.sendto((self.header, data), self.addr)
+
+    def close(self, reason: str = 'closed'):
+        if self._loop is not None and self._sock.fileno() >= 0:
+            self._loop.remove_reader(self._sock.fileno())
+        self._sock.close()
+        if self.throttle is not None:
+            self.throttle.close()
+            self.throttle = None
+        logger.debug('[UdpAssociation] closed: %s, %s', self.addr, reason)
+        access_log = get_access_log()
+        if access_log is not None and self._loop is not None:
+            duration = self._loop.time() - self._started
+            access_log.record(self.addr, self.dst, self.cmd, self.bytes_in, self.bytes_out, duration, reason)
+
+
+class UdpAssociationTable:
+    """UDP 关联表, 按关联的 key 索引, 是 UDP 关联状态的唯一持有者
+
+    空闲超时由时间轮判断, 转发数据报时只记录活跃时间. 时间轮每 resolution 秒推进一次, 没有关联时停止.
+    """
+
+    def __init__(self, timeout: float, resolution: float = 1.0):
+        self._associations: Dict[Hashable, UdpAssociation] = {}
+        self._wheel: TimerWheel[Hashable] = TimerWheel(timeout, self._expire, resolution)
+        self._handle: Optional[asyncio.TimerHandle] = None
+
+    def __len__(self):
+        return len(self._associations)
+
+    def __contains__(self, addr: Hashable) -> bool:
+        return addr in self._associations
+
+    def get(self, addr: Hashable) -> Optional[UdpAssociation]:
+        return self._associations.get(addr)
+
+    def add(self, association: UdpAssociation):
+        loop = asyncio.get_running_loop()
+        if self._handle is None:
+            self._wheel.advance(loop.time())
+            self._handle = loop.call_later(self._wheel.resolution, self._on_tick)
+        self.release(association.key, 'replaced')
+        self._associations[association.key] = association
+        self._wheel.add(association.key)
+
+    def touch(self, addr: Hashable):
+        self._wheel.touch(addr)
+
+    def release(self, addr: Hashable, reason: str = 'released'):
+        """reason 记录在访问日志中, 默认为 TCP 控制连接关闭时的释放"""
+        association = self._associations.pop(addr, None)
+        self._wheel.remove(addr)
+        if association is not None:
+            association.close(reason)
+
+    def _expire(self, addr: Hashable):
+        self.release(addr, 'idle_timeout')
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        for addr in list(self._associations):
+            self.release(addr, 'shutdown')
+
+    def _on_tick(self):
         loop = asyncio.get_running_loop()
-        loop.create_task(self.handle_datagram_received(data, addr))
+        self._wheel.advance(loop.time())
+        if self._associations:
+            self._handle = loop.call_later(self._wheel.resolution, self._on_tick)
+        else:
+            self._handle = None
 
-    async def handle_datagram_received(self, data: bytes, addr: Tuple[str, int]):
-        logger.info(f"manager: {len(self._manager)} {self._manager!r}")
-        dst, header, message = Socks5ProxyParser.unpack(data)
-        logger.info(f"addr: {addr!r}, dst: {dst!r}, header: {header!r}, message: {message!r}")
 
-        if dst is None or message is None:
-            self.transport.close()
+_udp_associations: ContextVar[UdpAssociationTable] = ContextVar('udp_associations')
+
+
+def get_udp_associations() -> UdpAssociationTable:
+    table = _udp_associations.get(None)
+    if table is None:
+        settings = _settings.get(None)
+        table = UdpAssociationTable(settings.udp_keep_alive_timeout if settings else 60)
+        _udp_associations.set(table)
+    return table
+
+
+class UdpServer:
+    """socks5 UDP 转发的监听端, 直接读写非阻塞 socket
+
+    - 每次可读事件连续读取最多 BATCH_SIZE 个数据报, 减少事件循环的调度次数
+    - 已建立关联的数据报同步转发, 只有新的关联需要创建任务解析域名
+    - 回复使用 sendmsg 分散写入头部与数据
+
+    Python 没有提供 recvmmsg/sendmmsg, 每个数据报仍是一次系统调用.
+    """
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.table = get_udp_associations()
+        self._loop = asyncio.get_running_loop()
+        self._pending: Dict[Hashable, asyncio.Task] = {}
+
+    @classmethod
+    async def create(cls, host: str, port: int, sock: Optional[socket.socket] = None) -> 'UdpServer':
+        """sock 为从旧进程接收的已绑定 socket 时直接使用"""
+        loop = asyncio.get_running_loop()
+        if sock is None:
+            infos = await loop.getaddrinfo(host, port, type=socket.SOCK_DGRAM, flags=socket.AI_PASSIVE)
+            family, type_, proto, _, sockaddr = infos[0]
+            sock = socket.socket(family, type_, proto)
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if hasattr(socket, 'SO_REUSEPORT'):
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                sock.bind(sockaddr)
+            except BaseException:
+                sock.close()
+                raise
+        sock.setblocking(False)
+        server = cls(sock)
+        loop.add_reader(sock.fileno(), server._on_readable)
+        return server
+
+    def pause_reading(self):
+        """停止读取客户端的数据报, 已有关联仍可通过 sendto 回复"""
+        self._loop.remove_reader(self.sock.fileno())
+
+    def close(self):
+        for task in self._pending.values():
+            task.cancel()
+        if self.sock.fileno() >= 0:
+            self._loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+
+    def sendto(self, buffers: Sequence[bytes], addr: Tuple[str, int]):
+        """发送给客户端, 发送缓冲区已满时丢弃"""
+        try:
+            if HAS_SENDMSG:
+                self.sock.sendmsg(buffers, (), 0, addr)
+            else:
+                self.sock.sendto(b''.join(buffers), addr)
+            metrics.UDP_DATAGRAMS_DOWNSTREAM.inc()
+        except BlockingIOError:
+            metrics.UDP_DROPPED_BUFFER_FULL.inc()
+        except OSError as e:
+            logger.warning(f'[UdpServer] send to {addr} failed: {e!r}')
+
+    def _on_readable(self):
+        for _ in range(BATCH_SIZE):
+            try:
+                data, addr = self.sock.recvfrom(MAX_DATAGRAM_SIZE)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                logger.warning(f'[UdpServer] error received: {e!r}')
+                return
+            self.datagram_received(data, addr)
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]):
+        result = Socks5ProxyParser.parse(data)
+        # 不支持分片, 分片的数据报与不合法的数据报直接丢弃
+        if result is None or data[2]:
+            logger.debug('drop invalid datagram from %r', addr)
+            metrics.UDP_DROPPED_INVALID.inc()
             return
+        dst, end = result
 
-        if addr not in self.MANAGER:
-            loop = asyncio.get_running_loop()
-            remote_transport, remote_protocol = await loop.create_datagram_endpoint(
-                lambda: UdpForwardProtocol(self.MANAGER, self.LAST_ACTIVITY, header, self.transport, addr), remote_addr=dst)
-            self.MANAGER[addr] = (remote_transport, remote_protocol)  # type: ignore
-        self.MANAGER[addr][0].sendto(message)
+        association = self.table.get(addr)
+        if association is not None:
+            self.table.touch(addr)
+            association.send(memoryview(data)[end:])
+            return
+
+        authenticator = get_authenticator()
+        if authenticator is not None and not authenticator.udp_allowed(addr[0]):
+            logger.debug('drop datagram from unauthorized %r', addr)
+            metrics.UDP_DROPPED_UNAUTHORIZED.inc()
+            return
 
-    def error_received(self, exc):
-        logger.warning(f'Error received:{exc!r}')
+        # 建立关联期间同一客户端的数据报直接丢弃
+        if addr not in self._pending:
+            task = self._loop.create_task(self.associate(data, addr, dst, end))
+            self._pending[addr] = task
+            task.add_done_callback(lambda _: self._pending.pop(addr, None))
+
+    async def associate(self, data: bytes, addr: Tuple[str, int], dst: Tuple[str, int], end: int):
+        logger.debug('associate addr: %r, dst: %r, associations: %d', addr, dst, len(self.table))
+        # 上级代理只转发 TCP, UDP 关联只区分拒绝与直连
+        try:
+            route(dst[0])
+        except RouteRejected:
+            logger.debug('drop datagram from %r to rejected %r', addr, dst)
+            metrics.UDP_DROPPED_REJECTED.inc()
+            return
+        try:
+            host = (await get_resolver().resolve(dst[0]))[0]
+        except socket.gaierror as e:
+            logger.debug('resolve %s failed: %r', dst[0], e)
+            return
+
+        sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setblocking(False)
+            sock.connect((host, dst[1]))
+        except OSError as e:
+            sock.close()
+            logger.warning(f'connect to {dst} failed: {e!r}')
+            return
 
-    def connection_lost(self, exc):
-        logger.debug(f"Connection Lost {exc!r}\n\n")
+        association = UdpAssociation(self, addr, data[:end], sock, get_rate_limiter().open(addr[0]), dst)
+        self.table.add(association)
+        association.start(self._loop)
+        association.send(memoryview(data)[end:])
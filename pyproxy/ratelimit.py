@@ -0,0 +1,122 @@
+import time
+
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+
+class TokenBucket:
+    """令牌桶, rate 为每秒补充的字节数, burst 为桶容量
+
+    consume 允许令牌数为负(先转发再等待), 返回令牌恢复为非负数所需的等待时间,
+    try_consume 只在令牌足够时扣除, 用于可以直接丢弃的 UDP 数据报.
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def consume(self, n: int) -> float:
+        self._refill(time.monotonic())
+        self.tokens -= n
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def try_consume(self, n: int) -> bool:
+        self._refill(time.monotonic())
+        if self.tokens < n:
+            return False
+        self.tokens -= n
+        return True
+
+
+class Throttle:
+    """单个客户端连接的限速, 同时受连接、客户端 IP 和全局三个令牌桶限制"""
+
+    __slots__ = ('_limiter', '_ip', '_buckets', '_closed')
+
+    def __init__(self, limiter: 'RateLimiter', ip: str, buckets: List[TokenBucket]):
+        self._limiter = limiter
+        self._ip = ip
+        self._buckets = buckets
+        self._closed = False
+
+    def consume(self, n: int) -> float:
+        """扣除 n 字节, 返回在继续读取之前需要等待的时间"""
+        delay = 0.0
+        for bucket in self._buckets:
+            delay = max(delay, bucket.consume(n))
+        return delay
+
+    def try_consume(self, n: int) -> bool:
+        now = time.monotonic()
+        for bucket in self._buckets:
+            bucket._refill(now)
+            if bucket.tokens < n:
+                return False
+        for bucket in self._buckets:
+            bucket.tokens -= n
+        return True
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._limiter._release(self._ip)
+
+
+class RateLimiter:
+    """按客户端连接、客户端 IP 与全局三个级别限制转发带宽, 单位字节/秒, 0 表示不限制
+
+    同一客户端 IP 的所有连接共享一个令牌桶, 最后一个连接关闭时移除.
+    """
+
+    def __init__(self, connection_rate: float = 0, ip_rate: float = 0, global_rate: float = 0):
+        self.connection_rate = connection_rate
+        self.ip_rate = ip_rate
+        self._global = TokenBucket(global_rate) if global_rate > 0 else None
+        self._ips: Dict[str, Tuple[TokenBucket, int]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.connection_rate > 0 or self.ip_rate > 0 or self._global is not None
+
+    def open(self, ip: str) -> Optional[Throttle]:
+        """为客户端连接创建限速, 未启用限速时返回 None"""
+        if not self.enabled:
+            return None
+
+        buckets: List[TokenBucket] = []
+        if self.connection_rate > 0:
+            buckets.append(TokenBucket(self.connection_rate))
+        if self.ip_rate > 0:
+            bucket, refs = self._ips.get(ip) or (TokenBucket(self.ip_rate), 0)
+            self._ips[ip] = (bucket, refs + 1)
+            buckets.append(bucket)
+        if self._global is not None:
+            buckets.append(self._global)
+        return Throttle(self, ip, buckets)
+
+    def _release(self, ip: str):
+        item = self._ips.get(ip)
+        if item is None:
+            return
+        bucket, refs = item
+        if refs <= 1:
+            del self._ips[ip]
+        else:
+            self._ips[ip] = (bucket, refs - 1)
+
+
+_rate_limiter: ContextVar[RateLimiter] = ContextVar('rate_limiter')
+
+
+def get_rate_limiter() -> RateLimiter:
+    limiter = _rate_limiter.get(None)
+    if limiter is None:
+        limiter = RateLimiter()
+        _rate_limiter.set(limiter)
+    return limiter
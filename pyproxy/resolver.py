@@ -0,0 +1,126 @@
+import asyncio
+import ipaddress
+import logging
+import socket
+
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import Dict, List, Tuple, Union
+
+from pyproxy import metrics
+
+logger = logging.getLogger(__name__)
+
+_CacheKey = Tuple[str, int]
+_CacheValue = Tuple[float, Union[List[str], socket.gaierror]]
+
+
+class Resolver:
+    """异步 DNS 解析, 带 TTL 缓存
+
+    - 通过事件循环的 getaddrinfo 解析, 不阻塞事件循环
+    - 缓存容量有上限, 超出时按 LRU 淘汰
+    - 解析失败的结果同样缓存一段时间(negative caching)
+    - 同一域名的并发解析请求合并为一次
+
+    getaddrinfo 不返回记录的 TTL, 缓存时间由 ttl/negative_ttl 配置.
+    """
+
+    def __init__(self, maxsize: int = 4096, ttl: float = 60, negative_ttl: float = 5):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._cache: 'OrderedDict[_CacheKey, _CacheValue]' = OrderedDict()
+        self._inflight: Dict[_CacheKey, asyncio.Future] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+    async def resolve(self, host: str, family: int = socket.AF_UNSPEC) -> List[str]:
+        """解析域名, 返回 IP 地址列表, 失败时抛出 socket.gaierror"""
+        if _is_ip_address(host):
+            return [host]
+
+        loop = asyncio.get_running_loop()
+        key = (host, family)
+        cached = self._cache.get(key)
+        if cached is not None:
+            expire, value = cached
+            if expire > loop.time():
+                self.hits += 1
+                self._cache.move_to_end(key)
+                if isinstance(value, socket.gaierror):
+                    raise socket.gaierror(*value.args)
+                return value
+            del self._cache[key]
+
+        fut = self._inflight.get(key)
+        if fut is None:
+            self.misses += 1
+            fut = loop.create_task(self._lookup(host, family))
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+
+        # 单个请求被取消时不影响其他等待同一结果的请求
+        return await asyncio.shield(fut)
+
+    async def _lookup(self, host: str, family: int) -> List[str]:
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            infos = await loop.getaddrinfo(host, None, family=family, type=socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            logger.debug('[Resolver] resolve %s failed: %r', host, e)
+            self._store((host, family), e, self.negative_ttl)
+            raise
+        except (UnicodeError, ValueError) as e:
+            # 标签过长等无效的 IDNA 域名在编码时失败, 按解析失败处理, 调用方只需要处理 OSError
+            logger.debug('[Resolver] invalid host %r: %r', host, e)
+            error = socket.gaierror(socket.EAI_NONAME, f'invalid host name: {e}')
+            self._store((host, family), error, self.negative_ttl)
+            raise error from e
+        finally:
+            metrics.DNS_SECONDS_ALL.observe(loop.time() - start)
+
+        addrs: List[str] = []
+        for _, _, _, _, sockaddr in infos:
+            if sockaddr[0] not in addrs:
+                addrs.append(sockaddr[0])
+        self._store((host, family), addrs, self.ttl)
+        return addrs
+
+    def _store(self, key: _CacheKey, value: Union[List[str], socket.gaierror], ttl: float):
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        self._cache[key] = (asyncio.get_running_loop().time() + ttl, value)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def clear(self):
+        self._cache.clear()
+
+
+def _is_ip_address(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return True
+
+
+_resolver: ContextVar[Resolver] = ContextVar('resolver')
+
+
+def get_resolver() -> Resolver:
+    resolver = _resolver.get(None)
+    if resolver is None:
+        resolver = Resolver()
+        _resolver.set(resolver)
+    return resolver
@@ -0,0 +1,309 @@
+import asyncio
+import errno
+import logging
+import os
+import signal
+import socket
+import sys
+
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple, Union
+
+from pyproxy import metrics
+from pyproxy.const import RouteAction
+from pyproxy.errors import RouteRejected
+
+logger = logging.getLogger(__name__)
+
+_ACTIONS = {action.value: action for action in RouteAction}
+# 规则的决策: RouteAction 或 proxy:<name>, 后者经由指定名称的上级代理
+Action = Union[RouteAction, str]
+_PARENT_PREFIX = 'proxy:'
+
+
+def parse_action(value: str) -> Action:
+    """解析规则中的决策, 上级代理名称不区分大小写, 相同的决策共用一个字符串"""
+    value = value.strip().lower()
+    action = _ACTIONS.get(value)
+    if action is not None:
+        return action
+    if value.startswith(_PARENT_PREFIX) and len(value) > len(_PARENT_PREFIX):
+        return sys.intern(value)
+    raise ValueError(f'invalid action: {value}')
+
+
+def parent_name(action: Action) -> Optional[str]:
+    """proxy:<name> 决策中的上级代理名称, 其他决策返回 None"""
+    if action.startswith(_PARENT_PREFIX):
+        return action[len(_PARENT_PREFIX):]
+    return None
+
+
+class DomainMatcher:
+    """域名规则, 完全匹配优先, 其次是最长的后缀匹配
+
+    后缀规则以完整的后缀字符串为键, 查找时从完整域名开始逐级去掉最左边的标签,
+    第一个命中的即最长后缀. 与按标签逆序构建的字典树等价, 但每条规则只占用一个字典项,
+    50 万条规则时内存与查找速度都优于嵌套字典.
+    """
+
+    def __init__(self):
+        self.exact: Dict[str, Action] = {}
+        self.suffixes: Dict[str, Action] = {}
+
+    def __len__(self):
+        return len(self.exact) + len(self.suffixes)
+
+    def add(self, domain: str, action: Action, suffix: bool = True):
+        domain = domain.lower().strip('.')
+        (self.suffixes if suffix else self.exact)[domain] = action
+
+    def match(self, host: str) -> Optional[Action]:
+        action = self.exact.get(host)
+        if action is not None:
+            return action
+        suffixes = self.suffixes
+        while True:
+            action = suffixes.get(host)
+            if action is not None:
+                return action
+            i = host.find('.')
+            if i < 0:
+                return None
+            host = host[i + 1:]
+
+
+class CidrMatcher:
+    """IP 地址段规则, 最长前缀匹配
+
+    每个前缀长度一张表, 键为地址右移后的网络号. 查找时按前缀长度从长到短逐表查找,
+    次数只与规则中出现的前缀长度种类有关, 与规则数量无关.
+    """
+
+    def __init__(self, bits: int):
+        self.bits = bits
+        self._tables: Dict[int, Dict[int, Action]] = {}
+        # (右移位数, 表), 按前缀长度从长到短
+        self._lookup: List[Tuple[int, Dict[int, Action]]] = []
+
+    def __len__(self):
+        return sum(len(table) for table in self._tables.values())
+
+    def add(self, network: int, prefixlen: int, action: Action):
+        shift = self.bits - prefixlen
+        table = self._tables.get(prefixlen)
+        if table is None:
+            table = self._tables[prefixlen] = {}
+            self._lookup = [(self.bits - n, self._tables[n]) for n in sorted(self._tables, reverse=True)]
+        table[network >> shift] = action
+
+    def match(self, ip: int) -> Optional[Action]:
+        for shift, table in self._lookup:
+            action = table.get(ip >> shift)
+            if action is not None:
+                return action
+        return None
+
+
+class RuleSet:
+    """编译后的路由规则
+
+    规则文件每行一条规则, # 开头为注释, 类型不区分大小写:
+
+        domain,www.example.com,direct
+        domain-suffix,example.com,proxy
+        ip-cidr,10.0.0.0/8,direct
+        ip-cidr6,fc00::/7,reject
+        domain-suffix,example.org,proxy:hk
+        final,proxy
+
+    proxy 经由按策略选择的上级代理, proxy:<name> 经由指定名称的上级代理.
+    域名规则只匹配域名, 地址段规则只匹配 IP 地址, 域名不会为了匹配地址段规则而解析.
+    没有命中任何规则时使用 final, 未指定时由 Router 决定.
+    """
+
+    def __init__(self):
+        self.domains = DomainMatcher()
+        self.ipv4 = CidrMatcher(32)
+        self.ipv6 = CidrMatcher(128)
+        self.final: Optional[Action] = None
+
+    def __len__(self):
+        return len(self.domains) + len(self.ipv4) + len(self.ipv6)
+
+    def add(self, kind: str, value: str, action: Action):
+        kind = kind.lower()
+        if kind == 'domain':
+            self.domains.add(value, action, suffix=False)
+        elif kind == 'domain-suffix':
+            self.domains.add(value, action)
+        elif kind in ('ip-cidr', 'ip-cidr6'):
+            addr, _, prefixlen = value.partition('/')
+            ip, family = _parse_ip(addr)
+            if family is None:
+                raise ValueError(f'invalid address: {value}')
+            matcher = self.ipv4 if family == socket.AF_INET else self.ipv6
+            bits = int(prefixlen) if prefixlen else matcher.bits
+            if not 0 <= bits <= matcher.bits:
+                raise ValueError(f'invalid prefix length: {value}')
+            matcher.add(ip, bits, action)
+        else:
+            raise ValueError(f'unknown rule type: {kind}')
+
+    def match(self, host: str) -> Optional[Action]:
+        ip, family = _parse_ip(host)
+        if family is None:
+            return self.domains.match(host.lower().rstrip('.'))
+        if family == socket.AF_INET:
+            return self.ipv4.match(ip)
+        return self.ipv6.match(ip)
+
+    @classmethod
+    def parse(cls, lines) -> 'RuleSet':
+        rules = cls()
+        for lineno, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = [field.strip() for field in line.split(',')]
+            try:
+                if fields[0].lower() in ('final', 'match'):
+                    rules.final = parse_action(fields[1])
+                    continue
+                # 多余的字段(如 no-resolve)忽略
+                rules.add(fields[0], fields[1], parse_action(fields[2]))
+            except (IndexError, ValueError) as e:
+                raise ValueError(f'invalid rule at line {lineno}: {line!r}') from e
+        return rules
+
+    @classmethod
+    def load(cls, path: str) -> 'RuleSet':
+        with open(path, encoding='utf-8') as f:
+            return cls.parse(f)
+
+
+def _parse_ip(host: str) -> Tuple[int, Optional[int]]:
+    """IP 地址转为整数, 不是 IP 地址时 family 为 None"""
+    if ':' in host:
+        try:
+            return int.from_bytes(socket.inet_pton(socket.AF_INET6, host.strip('[]')), 'big'), socket.AF_INET6
+        except OSError:
+            return 0, None
+    # 顶级域名不会是纯数字, 最后一个字符不是数字时一定是域名
+    if host and host[-1].isdigit():
+        try:
+            return int.from_bytes(socket.inet_aton(host), 'big'), socket.AF_INET
+        except OSError:
+            pass
+    return 0, None
+
+
+class Router:
+    """按目标地址选择直连、经由上级代理或拒绝
+
+    决策结果按目标地址缓存, 缓存满时淘汰最早的项. reload 在线程池中编译新的规则文件,
+    编译完成后与清空的缓存一起替换, 进行中的查找不会看到新旧规则混合的状态.
+    编译失败时继续使用原有规则.
+    """
+
+    CACHE_SIZE = 65536
+
+    def __init__(self, rules: RuleSet, default: RouteAction = RouteAction.PROXY, path: str = ''):
+        self.path = path
+        self.default = default
+        self.rules = rules
+        self._cache: Dict[str, Action] = {}
+        self._mtime = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_file(cls, path: str, default: RouteAction = RouteAction.PROXY) -> 'Router':
+        mtime = os.stat(path).st_mtime
+        router = cls(RuleSet.load(path), default, path)
+        router._mtime = mtime
+        logger.info(f'loaded {len(router.rules)} route rules from {path}')
+        return router
+
+    def route(self, host: str) -> Action:
+        action = self._cache.get(host)
+        if action is None:
+            action = self.rules.match(host) or self.rules.final or self.default
+            cache = self._cache
+            if len(cache) >= self.CACHE_SIZE:
+                del cache[next(iter(cache))]
+            cache[host] = action
+        counter = metrics.ROUTE_DECISIONS_BY_ACTION.get(action)
+        if counter is None:
+            # 指定上级代理的决策计入 proxy
+            counter = metrics.ROUTE_DECISIONS_BY_ACTION[RouteAction.PROXY]
+        counter.inc()
+        return action
+
+    def replace(self, rules: RuleSet):
+        self.rules, self._cache = rules, {}
+
+    async def reload(self):
+        assert self.path
+        loop = asyncio.get_running_loop()
+        try:
+            mtime = os.stat(self.path).st_mtime
+            rules = await loop.run_in_executor(None, RuleSet.load, self.path)
+        except (OSError, ValueError) as e:
+            logger.error(f'reload route rules from {self.path} failed, keep current rules: {e!r}')
+            return
+        self._mtime = mtime
+        self.replace(rules)
+        logger.info(f'reloaded {len(rules)} route rules from {self.path}')
+
+    def install_signal_handler(self, loop: asyncio.AbstractEventLoop):
+        """SIGHUP 触发 reload, 只能在主线程中设置"""
+        try:
+            loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self.reload()))
+        except (RuntimeError, ValueError, NotImplementedError, AttributeError) as e:
+            logger.debug(f'install signal handler failed: {e!r}')
+
+    def watch(self, interval: float):
+        """每 interval 秒检查规则文件的修改时间, 有变化时 reload"""
+        self._task = asyncio.ensure_future(self._watch_forever(interval))
+
+    async def _watch_forever(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                continue
+            if mtime != self._mtime:
+                await self.reload()
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+_router: ContextVar[Optional[Router]] = ContextVar('router', default=None)
+
+
+def get_router() -> Optional[Router]:
+    return _router.get()
+
+
+def has_domain_rules() -> bool:
+    """是否配置了域名规则, 没有时嗅探到的域名不会改变 IP 目标的路由决策"""
+    router = _router.get()
+    return router is not None and len(router.rules.domains) > 0
+
+
+def route(host: str) -> Action:
+    """目标地址的路由决策, 拒绝时抛出 RouteRejected, 没有配置规则时返回 PROXY
+
+    PROXY 在没有配置上级代理时等同于 DIRECT, proxy:<name> 由 parent_name 取得上级代理名称.
+    """
+    router = _router.get()
+    if router is None:
+        return RouteAction.PROXY
+    action = router.route(host)
+    if action == RouteAction.REJECT:
+        raise RouteRejected(errno.EACCES, f'{host} rejected by route rules')
+    return action
@@ -1,7 +1,11 @@
 from contextvars import ContextVar
 
+from typing import List
+
 from pydantic import BaseModel
 
+from pyproxy.const import RelayEngine, TransparentMode, UpstreamStrategy
+
 
 class Settings(BaseModel):
 
@@ -13,6 +17,84 @@ class Settings(BaseModel):
     proxy_addr: str
     proxy_port: int
 
+    relay: RelayEngine = RelayEngine.BUFFERED
+
+    # 透明代理监听端口, 0 表示不启用. redirect 只支持 TCP, tproxy 同时转发 UDP
+    transparent_port: int = 0
+    transparent_mode: TransparentMode = TransparentMode.REDIRECT
+
+    # 目标为 IP 时从客户端的第一段数据中读取 TLS SNI 或 HTTP Host, 用于路由与访问日志
+    sniff: bool = False
+    sniff_timeout: float = 0.1
+
+    dns_cache_size: int = 4096
+    dns_cache_ttl: float = 60
+    dns_negative_ttl: float = 5
+
+    connect_timeout: float = 10
+    happy_eyeballs_delay: float = 0.25
+
+    # TCP socket 参数, 见 pyproxy.sockopts.SocketOptions
+    tcp_nodelay: bool = True
+    tcp_sndbuf: int = 0
+    tcp_rcvbuf: int = 0
+    tcp_keepalive_idle: int = 60
+    tcp_keepalive_interval: int = 10
+    tcp_keepalive_count: int = 5
+    tcp_fastopen: int = 0
+    tcp_fastopen_connect: bool = False
+    tcp_defer_accept: int = 0
+    tcp_quickack: bool = False
+    tcp_backlog: int = 1024
+
+    http_pool_max_idle: int = 8
+    http_pool_max_age: float = 60
+    http_pool_idle_timeout: float = 15
+    http_pool_max_per_host: int = 64
+
+    # 转发带宽限制, 单位字节/秒, 0 表示不限制
+    rate_limit_connection: int = 0
+    rate_limit_ip: int = 0
+    rate_limit_global: int = 0
+
+    # 上级代理, socks5://[user:pass@]host:port 或 http://[user:pass@]host:port
+    upstream: List[str] = []
+    upstream_strategy: UpstreamStrategy = UpstreamStrategy.LEAST_CONN
+    # 每个上级代理保持的预热连接数
+    upstream_warm: int = 0
+    upstream_check_interval: float = 10
+
+    # 路由规则文件, 为空时全部经由上级代理(没有上级代理时直连)
+    rules: str = ''
+    # 检查规则文件修改时间的间隔, 单位秒, 0 表示只在收到 SIGHUP 时重新加载
+    rules_reload_interval: float = 0
+
+    # 用户名密码认证, 凭据文件或 module:attr 形式的自定义后端, 都为空时不认证
+    auth_file: str = ''
+    auth_backend: str = ''
+    auth_cache_size: int = 4096
+    auth_cache_ttl: float = 300
+
+    # 准入控制, 0 表示不限制
+    max_connections: int = 0
+    max_connections_per_ip: int = 0
+    max_loop_lag: float = 0
+    # 客户端握手超时与转发空闲超时, 单位秒, 0 表示不限制
+    handshake_timeout: float = 30
+    idle_timeout: float = 0
+
+    # 收到 SIGTERM 后等待现有连接结束的时间, 单位秒
+    drain_timeout: float = 30
+    # 监听 socket 交接使用的 AF_UNIX socket 路径, 为空时不启用
+    handoff_path: str = ''
+
+    # 访问日志文件路径, '-' 表示标准输出, 为空时不记录
+    access_log: str = ''
+
+    # 指标服务, 端口为 0 时不启用
+    metrics_host: str = '127.0.0.1'
+    metrics_port: int = 0
+
 
 _settings: ContextVar[Settings] = ContextVar('settings')
 
@@ -0,0 +1,133 @@
+import asyncio
+import struct
+
+from typing import Dict, Optional, Tuple, Union
+
+from pyproxy.errors import HttpParseError
+from pyproxy.http import HEAD_END, HttpRequest, parse_authority
+from pyproxy.utils import eof_received, stream_buffer, wait_for_buffered
+
+# 嗅探最多等待的字节数, 一个完整的 TLS 记录
+MAX_SNIFF_SIZE = 2**14 + 5
+# 数据不足以判断时 sniff_host 的返回值
+INCOMPLETE = ''
+
+_HTTP_METHODS: Dict[int, Tuple[bytes, ...]] = {}
+for _method in (b'GET ', b'POST ', b'HEAD ', b'PUT ', b'DELETE ', b'OPTIONS ', b'PATCH ', b'TRACE '):
+    _HTTP_METHODS[_method[0]] = _HTTP_METHODS.get(_method[0], ()) + (_method, )
+_u16 = struct.Struct('!H').unpack_from
+_EXT_HEADER = struct.Struct('!HH').unpack_from
+_TLS_HANDSHAKE = 0x16
+_TLS_CLIENT_HELLO = 1
+_TLS_EXT_SERVER_NAME = 0
+
+
+def sniff_tls(data: Union[bytes, bytearray]) -> Optional[str]:
+    """从 TLS ClientHello 的 server_name 扩展中读取域名
+
+    只解析第一个 TLS 记录, ClientHello 跨越多个记录时放弃. 按偏移量检查每个长度字段, 只复制域名.
+    """
+    if len(data) < 5:
+        return INCOMPLETE
+    end = 5 + _u16(data, 3)[0]
+    if len(data) < end:
+        return INCOMPLETE
+    # HandshakeType(1) length(3) version(2) random(32)
+    pos = 5
+    if data[pos] != _TLS_CLIENT_HELLO:
+        return None
+    end = min(end, pos + 4 + int.from_bytes(data[pos + 1:pos + 4], 'big'))
+    pos += 38
+    # session_id(1+n) cipher_suites(2+n) compression_methods(1+n)
+    if pos >= end:
+        return None
+    pos += 1 + data[pos]
+    if pos + 2 > end:
+        return None
+    pos += 2 + _u16(data, pos)[0]
+    if pos >= end:
+        return None
+    pos += 1 + data[pos]
+    if pos + 2 > end:
+        return None
+    end = min(end, pos + 2 + _u16(data, pos)[0])
+    pos += 2
+    while pos + 4 <= end:
+        ext_type, ext_len = _EXT_HEADER(data, pos)
+        ext_end = pos + 4 + ext_len
+        pos += 4
+        if ext_type != _TLS_EXT_SERVER_NAME:
+            pos = ext_end
+            continue
+        # ServerNameList(2) NameType(1) HostName(2+n)
+        if ext_end > end or pos + 5 > ext_end or data[pos + 2] != 0:
+            return None
+        name_end = pos + 5 + _u16(data, pos + 3)[0]
+        if name_end > ext_end:
+            return None
+        try:
+            return data[pos + 5:name_end].decode('ascii').lower() or None
+        except UnicodeDecodeError:
+            return None
+    return None
+
+
+def sniff_http(data: Union[bytes, bytearray]) -> Optional[str]:
+    """从 HTTP/1.x 请求的 Host 首部读取域名"""
+    end = data.find(HEAD_END, 0, MAX_SNIFF_SIZE)
+    if end < 0:
+        return INCOMPLETE if len(data) < MAX_SNIFF_SIZE else None
+    try:
+        host = HttpRequest(bytes(data[:end + 4])).get_header(b'host')
+        if not host:
+            return None
+        return parse_authority(host)[0].lower() or None
+    except HttpParseError:
+        return None
+
+
+def sniff_host(data: Union[bytes, bytearray]) -> Optional[str]:
+    """从客户端发送的第一段数据中读取目标域名
+
+    返回域名; 数据不足以判断时返回 INCOMPLETE; 不是 TLS/HTTP 请求或其中没有域名时返回 None.
+    """
+    if not data:
+        return INCOMPLETE
+    if data[0] == _TLS_HANDSHAKE:
+        if len(data) > 1 and data[1] != 3:
+            return None
+        return sniff_tls(data)
+    methods = _HTTP_METHODS.get(data[0])
+    if methods is None:
+        return None
+    head = bytes(data[:8])
+    for method in methods:
+        if head.startswith(method):
+            return sniff_http(data)
+        if method.startswith(head):
+            return INCOMPLETE
+    return None
+
+
+async def sniff(reader: asyncio.StreamReader, timeout: float) -> Optional[str]:
+    """在 StreamReader 的缓冲区中查看客户端数据, 不消费数据
+
+    超时、数据超过 MAX_SNIFF_SIZE 或客户端关闭时放弃, 服务器先发送数据的协议最多等待 timeout 秒.
+    读取到的数据留在缓冲区中, 由转发引擎原样发送给目标服务器.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    buffer = stream_buffer(reader)
+    while True:
+        host = sniff_host(buffer)
+        if host != INCOMPLETE:
+            return host
+        remaining = deadline - loop.time()
+        if remaining <= 0 or len(buffer) >= MAX_SNIFF_SIZE:
+            return None
+        if eof_received(reader):
+            return None
+        try:
+            await asyncio.wait_for(wait_for_buffered(reader, len(buffer)), remaining)
+        except asyncio.TimeoutError:
+            return None
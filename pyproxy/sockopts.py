@@ -0,0 +1,162 @@
+import logging
+import socket
+import sys
+
+from contextvars import ContextVar
+from typing import Any, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_Option = Tuple[int, int, int]
+
+
+def _option(name: str) -> Optional[int]:
+    """平台不支持的选项返回 None"""
+    return getattr(socket, name, None)
+
+
+TCP_KEEPIDLE = _option('TCP_KEEPIDLE')
+TCP_KEEPINTVL = _option('TCP_KEEPINTVL')
+TCP_KEEPCNT = _option('TCP_KEEPCNT')
+TCP_FASTOPEN = _option('TCP_FASTOPEN')
+# Linux 4.11+, socket 模块没有定义该常量
+TCP_FASTOPEN_CONNECT = _option('TCP_FASTOPEN_CONNECT') or (30 if sys.platform.startswith('linux') else None)
+TCP_DEFER_ACCEPT = _option('TCP_DEFER_ACCEPT')
+TCP_QUICKACK = _option('TCP_QUICKACK')
+
+
+class SocketOptions:
+    """TCP socket 参数, 客户端连接与目标服务器连接使用相同的设置
+
+    - nodelay: 关闭 Nagle 算法, asyncio 与 uvloop 默认已经开启, 设置为 False 时关闭
+    - sndbuf/rcvbuf: 发送/接收缓冲区大小, 0 表示使用系统默认值并保留内核的自动调整.
+      接收缓冲区决定窗口扩大因子, 需要在 connect/listen 之前设置
+    - keepalive_*: TCP keepalive, idle 为 0 时不开启, 用于发现已经断开却没有通知的对端
+    - fastopen: 监听 socket 的 TCP Fast Open 队列长度, 0 表示不开启
+    - fastopen_connect: 连接目标服务器时使用 TCP Fast Open, 第一个数据包随 SYN 发送
+    - defer_accept: 客户端发送数据后才完成 accept, 单位秒, 0 表示不开启.
+      socks5 与 HTTP 都由客户端先发送数据, 只建立连接不发送数据的扫描不会占用文件描述符
+    - quickack: 连接建立时关闭延迟确认, 内核会自动恢复, 只影响握手阶段的往返
+    - backlog: 监听队列长度, 受 net.core.somaxconn 限制
+    平台不支持的选项忽略.
+    """
+
+    def __init__(
+        self,
+        nodelay: bool = True,
+        sndbuf: int = 0,
+        rcvbuf: int = 0,
+        keepalive_idle: int = 0,
+        keepalive_interval: int = 0,
+        keepalive_count: int = 0,
+        fastopen: int = 0,
+        fastopen_connect: bool = False,
+        defer_accept: int = 0,
+        quickack: bool = False,
+        backlog: int = 100,
+    ):
+        self.backlog = backlog
+        # 连接建立前设置的选项
+        self.pre_connect: List[_Option] = []
+        # 连接建立后设置的选项, 客户端连接在 accept 后设置
+        self.connected: List[_Option] = []
+        # 监听 socket 的选项
+        self.listen: List[_Option] = []
+
+        buffers = []
+        if sndbuf > 0:
+            buffers.append((socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf))
+        if rcvbuf > 0:
+            buffers.append((socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf))
+        # accept 得到的 socket 继承监听 socket 的缓冲区大小
+        self.pre_connect += buffers
+        self.listen += buffers
+        if fastopen_connect and TCP_FASTOPEN_CONNECT is not None:
+            self.pre_connect.append((socket.IPPROTO_TCP, TCP_FASTOPEN_CONNECT, 1))
+
+        if not nodelay:
+            self.connected.append((socket.IPPROTO_TCP, socket.TCP_NODELAY, 0))
+        if keepalive_idle > 0:
+            self.connected.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+            for opt, value in ((TCP_KEEPIDLE, keepalive_idle), (TCP_KEEPINTVL, keepalive_interval),
+                               (TCP_KEEPCNT, keepalive_count)):
+                if opt is not None and value > 0:
+                    self.connected.append((socket.IPPROTO_TCP, opt, value))
+        if quickack and TCP_QUICKACK is not None:
+            self.connected.append((socket.IPPROTO_TCP, TCP_QUICKACK, 1))
+
+        if fastopen > 0 and TCP_FASTOPEN is not None:
+            self.listen.append((socket.IPPROTO_TCP, TCP_FASTOPEN, fastopen))
+        if defer_accept > 0 and TCP_DEFER_ACCEPT is not None:
+            self.listen.append((socket.IPPROTO_TCP, TCP_DEFER_ACCEPT, defer_accept))
+
+    @classmethod
+    def from_settings(cls, settings: Any) -> 'SocketOptions':
+        return cls(
+            nodelay=settings.tcp_nodelay,
+            sndbuf=settings.tcp_sndbuf,
+            rcvbuf=settings.tcp_rcvbuf,
+            keepalive_idle=settings.tcp_keepalive_idle,
+            keepalive_interval=settings.tcp_keepalive_interval,
+            keepalive_count=settings.tcp_keepalive_count,
+            fastopen=settings.tcp_fastopen,
+            fastopen_connect=settings.tcp_fastopen_connect,
+            defer_accept=settings.tcp_defer_accept,
+            quickack=settings.tcp_quickack,
+            backlog=settings.tcp_backlog,
+        )
+
+    @staticmethod
+    def _apply(sock: Any, options: List[_Option]):
+        for level, opt, value in options:
+            try:
+                sock.setsockopt(level, opt, value)
+            except OSError as e:
+                logger.debug(f'setsockopt({level}, {opt}, {value}) failed: {e!r}')
+
+    def apply(self, sock: Any):
+        """已建立连接的 socket, 可以是 transport 的 get_extra_info('socket')"""
+        if self.connected and sock is not None:
+            self._apply(sock, self.connected)
+
+    def apply_listen(self, sock: Any):
+        self._apply(sock, self.listen)
+
+    def create_listen_socket(self, family: int, sockaddr: Any) -> socket.socket:
+        """创建并绑定监听 socket, 由 start_server(sock=...) 调用 listen
+
+        缓冲区大小决定窗口扩大因子, TCP Fast Open 与 TCP_DEFER_ACCEPT 也需要在 listen 之前设置才对队列中的连接生效.
+        """
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, 'SO_REUSEPORT'):
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.apply_listen(sock)
+            sock.bind(sockaddr)
+            sock.setblocking(False)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    def create_connection_socket(self, family: int) -> socket.socket:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.setblocking(False)
+            self._apply(sock, self.pre_connect)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+
+_socket_options: ContextVar[SocketOptions] = ContextVar('socket_options')
+
+
+def get_socket_options() -> SocketOptions:
+    options = _socket_options.get(None)
+    if options is None:
+        options = SocketOptions()
+        _socket_options.set(options)
+    return options
@@ -0,0 +1,83 @@
+from typing import Callable, Dict, Generic, Hashable, List, TypeVar
+
+K = TypeVar('K', bound=Hashable)
+
+
+class TimerWheel(Generic[K]):
+    """哈希时间轮, 用于大量对象的空闲超时
+
+    - touch 只记录最近活跃时间, 不移动对象在时间轮中的位置, 时间复杂度 O(1)
+    - advance 只检查到期槽位中的对象, 仍然活跃的对象按新的到期时间放回时间轮
+    - 超时精度为 resolution, 每个对象每个超时周期最多被检查一次
+
+    时间轮不持有时钟, 由调用方通过 advance 推进时间, now 为最近一次推进的时间, 可作为缓存的时钟使用.
+    """
+
+    def __init__(self, timeout: float, on_expire: Callable[[K], None], resolution: float = 1.0, now: float = 0):
+        assert timeout > 0 and resolution > 0
+        self.timeout = timeout
+        self.resolution = resolution
+        self.now = now
+        self._on_expire = on_expire
+        # 到期时间最多比当前时间晚 timeout, 多留两个槽位避免与当前槽位重叠
+        self._slots: List[Dict[K, None]] = [{} for _ in range(int(timeout / resolution) + 2)]
+        self._tick = self._tick_of(now)
+        self._active: Dict[K, float] = {}
+        self._slot_of: Dict[K, int] = {}
+
+    def __len__(self):
+        return len(self._active)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._active
+
+    def _tick_of(self, t: float) -> int:
+        return int(t / self.resolution)
+
+    def _schedule(self, key: K, deadline: float):
+        index = max(self._tick_of(deadline), self._tick + 1) % len(self._slots)
+        self._slots[index][key] = None
+        self._slot_of[key] = index
+
+    def add(self, key: K):
+        if key in self._active:
+            self._active[key] = self.now
+            return
+        self._active[key] = self.now
+        self._schedule(key, self.now + self.timeout)
+
+    def touch(self, key: K):
+        if key in self._active:
+            self._active[key] = self.now
+
+    def remove(self, key: K):
+        if self._active.pop(key, None) is None:
+            return
+        index = self._slot_of.pop(key)
+        self._slots[index].pop(key, None)
+
+    def advance(self, now: float):
+        """推进时间, 对超时的对象调用 on_expire"""
+        self.now = now
+        target = self._tick_of(now)
+        expired: List[K] = []
+        # 长时间未推进时每个槽位最多检查一次
+        steps = min(target - self._tick, len(self._slots)) if self._active else 0
+        for tick in range(target - steps + 1, target + 1):
+            self._tick = tick
+            slot = self._slots[tick % len(self._slots)]
+            if not slot:
+                continue
+            keys = list(slot)
+            slot.clear()
+            for key in keys:
+                deadline = self._active[key] + self.timeout
+                if deadline < now:
+                    expired.append(key)
+                else:
+                    self._schedule(key, deadline)
+        self._tick = max(self._tick, target)
+
+        for key in expired:
+            self.remove(key)
+            self._on_expire(key)
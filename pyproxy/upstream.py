@@ -0,0 +1,360 @@
+import asyncio
+import base64
+import errno
+import ipaddress
+import logging
+import random
+import struct
+import urllib.parse
+
+from collections import deque
+from contextvars import ContextVar
+from typing import Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+from pyproxy import metrics
+from pyproxy.connector import open_connection
+from pyproxy.const import RouteAction, UpstreamStrategy
+from pyproxy.errors import HttpParseError, UpstreamError
+from pyproxy.http import HEAD_END, MAX_HEAD_SIZE, HttpResponse
+from pyproxy.routing import Action, parent_name, route
+from pyproxy.settings import _settings
+
+logger = logging.getLogger(__name__)
+
+_Stream = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+# socks5 回复码对应的异常, 便于向客户端返回相同的错误
+_SOCKS5_ERRORS = {
+    2: (errno.EACCES, 'connection not allowed by ruleset'),
+    3: (errno.ENETUNREACH, 'network unreachable'),
+    4: (errno.EHOSTUNREACH, 'host unreachable'),
+    5: (errno.ECONNREFUSED, 'connection refused'),
+}
+
+
+def _connect_timeout() -> float:
+    settings = _settings.get(None)
+    return settings.connect_timeout if settings else 10
+
+
+class UpstreamProxy:
+    """上级代理, 支持 socks5://[user:pass@]host:port 与 http://[user:pass@]host:port
+
+    可以用 #name 指定名称, 路由规则通过 proxy:<name> 选择该代理, 未指定时名称为 scheme://host:port.
+
+    预热连接已完成 TCP 连接与 socks5 认证, 取用后只需要发送 CONNECT 请求.
+    active 为经由该代理的连接数, 连接结束时调用 release.
+    """
+
+    LATENCY_DECAY = 0.8
+    # 预热连接的最长保留时间, 上级代理可能关闭长时间空闲的连接
+    WARM_MAX_AGE = 30
+
+    def __init__(self, url: str, warm: int = 0):
+        u = urllib.parse.urlsplit(url)
+        scheme = u.scheme.lower()
+        if scheme in ('socks5', 'socks5h'):
+            scheme = 'socks5'
+        elif scheme not in ('http', ):
+            raise ValueError(f'unsupported upstream proxy: {url}')
+        if not u.hostname or not u.port:
+            raise ValueError(f'upstream proxy requires host and port: {url}')
+        self.scheme = scheme
+        self.host = u.hostname
+        self.port = u.port
+        self.username = urllib.parse.unquote(u.username) if u.username else None
+        self.password = urllib.parse.unquote(u.password) if u.password else ''
+        self.name = u.fragment or f'{scheme}://{self.host}:{self.port}'
+
+        self.warm = warm
+        self.active = 0
+        self.latency = 0.0
+        self.healthy = True
+        self._warm: Deque[Tuple[asyncio.StreamReader, asyncio.StreamWriter, float]] = deque()
+        self._refilling = False
+
+    def __repr__(self):
+        return f'<UpstreamProxy {self.name} active={self.active} healthy={self.healthy}>'
+
+    async def open_connection(self, host: str, port: int) -> _Stream:
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        stream = self._pop_warm(start)
+        self._refill()
+        if stream is not None:
+            try:
+                await asyncio.wait_for(self._connect(stream, host, port), _connect_timeout())
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # 预热连接可能已被上级代理关闭, 使用新连接重试
+                stream = None
+        if stream is None:
+            stream = await self.open_session()
+            await asyncio.wait_for(self._connect(stream, host, port), _connect_timeout())
+
+        sample = loop.time() - start
+        self.latency = sample if not self.latency else self.latency * self.LATENCY_DECAY + sample * (
+            1 - self.LATENCY_DECAY
+        )
+        self.active += 1
+        return stream
+
+    async def _connect(self, stream: _Stream, host: str, port: int):
+        try:
+            if self.scheme == 'socks5':
+                await self._socks5_connect(stream, host, port)
+            else:
+                await self._http_connect(stream, host, port)
+        except BaseException:
+            stream[1].close()
+            raise
+
+    def release(self):
+        self.active -= 1
+
+    async def open_session(self) -> _Stream:
+        """连接上级代理并完成认证, 上级代理接受连接后不回复时同样按 connect_timeout 超时"""
+        return await asyncio.wait_for(self._open_session(), _connect_timeout())
+
+    async def _open_session(self) -> _Stream:
+        reader, writer = await open_connection(self.host, self.port)
+        if self.scheme == 'socks5':
+            try:
+                await self._socks5_auth(reader, writer)
+            except BaseException:
+                writer.close()
+                raise
+        return reader, writer
+
+    async def _socks5_auth(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        writer.write(b'\x05\x02\x00\x02' if self.username else b'\x05\x01\x00')
+        ver, method = await reader.readexactly(2)
+        if ver != 5 or method not in (0, 2) or (method == 2 and not self.username):
+            raise ConnectionRefusedError(f'{self.name} refused authentication methods')
+        if method == 2:
+            assert self.username is not None
+            username, password = self.username.encode(), self.password.encode()
+            writer.write(bytes((1, len(username))) + username + bytes((len(password), )) + password)
+            _, status = await reader.readexactly(2)
+            if status != 0:
+                raise PermissionError(errno.EACCES, f'{self.name} authentication failed')
+
+    async def _socks5_connect(self, stream: _Stream, host: str, port: int):
+        reader, writer = stream
+        try:
+            ip = ipaddress.ip_address(host)
+            addr = (b'\x01' if ip.version == 4 else b'\x04') + ip.packed
+        except ValueError:
+            # 域名交给上级代理解析
+            name = host.encode('idna')
+            addr = b'\x03' + bytes((len(name), )) + name
+        writer.write(b'\x05\x01\x00' + addr + struct.pack('>H', port))
+        ver, rep, _, atyp = await reader.readexactly(4)
+        if ver != 5:
+            raise ConnectionError(f'{self.name} invalid socks5 reply')
+        if rep != 0:
+            code, message = _SOCKS5_ERRORS.get(rep, (errno.EIO, f'socks5 reply {rep}'))
+            raise UpstreamError(code, f'{self.name}: {message}')
+        if atyp == 1:
+            size = 4
+        elif atyp == 4:
+            size = 16
+        else:
+            size = (await reader.readexactly(1))[0]
+        await reader.readexactly(size + 2)
+
+    async def _http_connect(self, stream: _Stream, host: str, port: int):
+        reader, writer = stream
+        authority = f'[{host}]:{port}' if ':' in host else f'{host}:{port}'
+        head = f'CONNECT {authority} HTTP/1.1\r\nHost: {authority}\r\n'
+        if self.username:
+            token = base64.b64encode(f'{self.username}:{self.password}'.encode()).decode()
+            head += f'Proxy-Authorization: Basic {token}\r\n'
+        writer.write((head + '\r\n').encode())
+        # 直接从 StreamReader 读取响应头, 目标服务器先发送的数据留在缓冲区中
+        try:
+            raw = await reader.readuntil(HEAD_END)
+            status = HttpResponse(raw).status
+        except asyncio.LimitOverrunError:
+            raise ConnectionError(f'{self.name} response head exceeds {MAX_HEAD_SIZE} bytes')
+        except HttpParseError as e:
+            raise ConnectionError(f'{self.name} invalid response: {e}')
+        if status == 407:
+            raise PermissionError(errno.EACCES, f'{self.name} proxy authentication required')
+        if status != 200:
+            code = errno.ETIMEDOUT if status == 504 else errno.ECONNREFUSED
+            raise UpstreamError(code, f'{self.name} CONNECT {authority} returned {status}')
+
+    def _pop_warm(self, now: float) -> Optional[_Stream]:
+        while self._warm:
+            reader, writer, created = self._warm.popleft()
+            if now - created < self.WARM_MAX_AGE and not reader.at_eof() and not writer.transport.is_closing():
+                return reader, writer
+            writer.close()
+        return None
+
+    def put_warm(self, stream: _Stream) -> bool:
+        if len(self._warm) >= self.warm:
+            return False
+        self._warm.append((*stream, asyncio.get_running_loop().time()))
+        return True
+
+    def _refill(self):
+        if self.warm and not self._refilling and len(self._warm) < self.warm:
+            self._refilling = True
+            asyncio.ensure_future(self._do_refill())
+
+    async def _do_refill(self):
+        try:
+            while self.healthy and len(self._warm) < self.warm:
+                stream = await self.open_session()
+                if not self.put_warm(stream):
+                    stream[1].close()
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.debug(f'[UpstreamProxy] {self.name} warm up failed: {e!r}')
+        finally:
+            self._refilling = False
+
+    async def check(self, timeout: float):
+        """健康检查: 连接上级代理并完成认证, 成功的连接作为预热连接保留"""
+        try:
+            stream = await asyncio.wait_for(self.open_session(), timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            if self.healthy:
+                logger.warning(f'[UpstreamProxy] {self.name} is down: {e!r}')
+            self.healthy = False
+            return
+        if not self.healthy:
+            logger.info(f'[UpstreamProxy] {self.name} is up')
+        self.healthy = True
+        if not self.put_warm(stream):
+            stream[1].close()
+        self._refill()
+
+    def close(self):
+        while self._warm:
+            self._warm.popleft()[1].close()
+
+
+class UpstreamGroup:
+    """一组上级代理
+
+    - least_conn: 选择连接数最少的代理, 相同时选择延迟较低的
+    - latency: 按握手延迟的倒数加权随机选择
+    不健康的代理不参与选择, 全部不健康时仍然尝试. 连接失败时标记为不健康并尝试下一个代理,
+    由定期的健康检查恢复. 路由规则指定了上级代理时只使用该代理, 不参与选择.
+    """
+
+    def __init__(
+        self,
+        proxies: Sequence[UpstreamProxy],
+        strategy: UpstreamStrategy = UpstreamStrategy.LEAST_CONN,
+        check_interval: float = 10,
+    ):
+        assert proxies
+        self.proxies = list(proxies)
+        self.named: Dict[str, UpstreamProxy] = {proxy.name.lower(): proxy for proxy in self.proxies}
+        self.strategy = strategy
+        self.check_interval = check_interval
+        self._task: Optional[asyncio.Task] = None
+        self._unregister: List[Callable[[], None]] = []
+
+    @classmethod
+    def from_urls(cls, urls: Sequence[str], strategy: UpstreamStrategy, warm: int = 0, check_interval: float = 10):
+        return cls([UpstreamProxy(url, warm) for url in urls], strategy, check_interval)
+
+    def candidates(self) -> List[UpstreamProxy]:
+        """按选择策略排列的代理"""
+        healthy = [proxy for proxy in self.proxies if proxy.healthy] or list(self.proxies)
+        if self.strategy == UpstreamStrategy.LATENCY and len(healthy) > 1:
+            # 没有延迟数据的代理权重最高, 优先探测
+            weights = [1 / (proxy.latency + 0.001) for proxy in healthy]
+            first = random.choices(healthy, weights)[0]
+            healthy.remove(first)
+            return [first] + sorted(healthy, key=lambda proxy: proxy.latency)
+        return sorted(healthy, key=lambda proxy: (proxy.active, proxy.latency))
+
+    async def open_connection(
+        self,
+        host: str,
+        port: int,
+        parent: Optional[str] = None,
+    ) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter, UpstreamProxy]:
+        """parent 为路由规则指定的上级代理名称"""
+        if parent is None:
+            candidates = self.candidates()
+        else:
+            proxy = self.named.get(parent)
+            if proxy is None:
+                raise OSError(errno.EHOSTUNREACH, f'unknown parent proxy: {parent}')
+            candidates = [proxy]
+        exc: Optional[BaseException] = None
+        for proxy in candidates:
+            try:
+                reader, writer = await proxy.open_connection(host, port)
+                return reader, writer, proxy
+            except UpstreamError:
+                # 上级代理返回的目标服务器错误, 不再重试
+                raise
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                # 上级代理不可用, 换一个代理重试
+                logger.warning(f'[UpstreamGroup] {proxy.name} failed: {e!r}')
+                proxy.healthy = False
+                exc = e
+        assert exc is not None
+        if isinstance(exc, asyncio.IncompleteReadError):
+            raise ConnectionResetError(str(exc))
+        raise exc
+
+    def start(self):
+        for proxy in self.proxies:
+            self._unregister += [
+                metrics.PARENT_PROXY_ACTIVE.labels(proxy.name).add_function(lambda proxy=proxy: proxy.active),
+                metrics.PARENT_PROXY_HEALTHY.labels(proxy.name).add_function(lambda proxy=proxy: int(proxy.healthy)),
+            ]
+        self._task = asyncio.ensure_future(self._check_forever())
+
+    async def _check_forever(self):
+        while True:
+            await asyncio.gather(*(proxy.check(self.check_interval) for proxy in self.proxies))
+            await asyncio.sleep(self.check_interval)
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for proxy in self.proxies:
+            proxy.close()
+        for remove in self._unregister:
+            remove()
+        self._unregister = []
+
+
+_upstream: ContextVar[Optional[UpstreamGroup]] = ContextVar('upstream', default=None)
+
+
+def get_upstream() -> Optional[UpstreamGroup]:
+    return _upstream.get()
+
+
+async def connect(
+    host: str,
+    port: int,
+    action: Optional[Action] = None,
+) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter, Optional[UpstreamProxy]]:
+    """按路由规则连接目标服务器, 经由上级代理时返回的代理需要在连接结束后 release
+
+    action 为调用方已经得到的路由决策, 为空时查找路由规则, 拒绝时抛出 RouteRejected.
+    proxy:<name> 经由指定的上级代理, 没有配置上级代理或没有该名称的代理时连接失败.
+    """
+    if action is None:
+        action = route(host)
+    parent = parent_name(action)
+    group = get_upstream()
+    if parent is not None:
+        if group is None:
+            raise OSError(errno.EHOSTUNREACH, f'unknown parent proxy: {parent}')
+        return await group.open_connection(host, port, parent)
+    if group is None or action == RouteAction.DIRECT:
+        reader, writer = await open_connection(host, port)
+        return reader, writer, None
+    return await group.open_connection(host, port)
@@ -1,18 +1,16 @@
+import asyncio
 import ipaddress
 import logging
 import os
 import resource
 import socket
-import struct
 import urllib.parse
 import urllib.request
 
 from contextvars import Token
-from typing import Dict, Mapping, Optional, Tuple, Union
+from typing import Any, Dict, List, Mapping, Optional, Tuple
 
-import socks
-
-from pyproxy._types import UDP_MAPPING_TABLE_TYPE
+from pyproxy.const import EventLoop, RelayEngine
 from pyproxy.settings import Settings, _settings
 
 logger = logging.getLogger(__name__)
@@ -32,21 +30,41 @@ def set_open_file_limit(soft_limit: Optional[int] = None):
             logger.debug(f'Open file soft limit set to {soft_limit}.')
 
 
-def open_system_proxy(system_proxies: Optional[Mapping[str, str]] = None):
+def install_event_loop(name: EventLoop = EventLoop.AUTO) -> EventLoop:
+    """设置事件循环实现, 返回实际使用的事件循环
+
+    auto 在 uvloop 可用时使用 uvloop, 否则使用 asyncio 默认事件循环.
+    """
+    if name == EventLoop.ASYNCIO:
+        asyncio.set_event_loop_policy(None)
+        return EventLoop.ASYNCIO
+
+    try:
+        import uvloop
+    except ImportError:
+        if name == EventLoop.UVLOOP:
+            logger.warning('uvloop is not installed, fallback to asyncio event loop.')
+        asyncio.set_event_loop_policy(None)
+        return EventLoop.ASYNCIO
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return EventLoop.UVLOOP
+
+
+def open_system_proxy(system_proxies: Optional[Mapping[str, str]] = None) -> List[str]:
+    """系统代理中的 socks5 代理(all_proxy), 作为上级代理使用"""
     if system_proxies is None:
         system_proxies = urllib.request.getproxies()
 
-    # TODO: 系统代理优化
-    if 'all' in system_proxies:
-        u = urllib.parse.urlparse(system_proxies['all'])
-        addr = u.netloc.split(':').copy()
-
-        if len(addr) == 1:
-            host, port = addr[0], None
-        else:
-            host, port = addr[0], int(addr[1])
-        socks.set_default_proxy(socks.SOCKS5, host, port)
-        socket.socket = socks.socksocket  # type: ignore
+    proxy = system_proxies.get('all')
+    if not proxy:
+        return []
+    u = urllib.parse.urlsplit(proxy)
+    if u.scheme not in ('socks5', 'socks5h') or not u.hostname:
+        logger.warning(f'unsupported system proxy: {proxy}')
+        return []
+    # 没有端口时使用 socks 默认端口
+    return [proxy if u.port else f'{proxy.rstrip("/")}:1080']
 
 
 def initialize(
@@ -60,42 +78,28 @@ def initialize(
                                      str]] = None,
     enable_system_proxy: bool = False,
     settings: Optional[Settings] = None,
+    **options: Any,
 ) -> Token:
 
     if settings is None:
         assert proxy_addr and proxy_port
-        settings = Settings(host=host, port=port, proxy_addr=proxy_addr, proxy_port=proxy_port)
+        settings = Settings(host=host, port=port, proxy_addr=proxy_addr, proxy_port=proxy_port, **options)
     token = _settings.set(settings)
 
-    try:
-        _ = socket.inet_pton(socket.AF_INET, settings.proxy_addr)
-    except socket.error:
-        settings.proxy_addr = socket.gethostbyname(settings.proxy_addr)
+    # splice 模块使用本模块的 StreamReader 辅助函数, 在这里导入以免循环导入
+    from pyproxy.protocols.splice import SPLICE_SUPPORTED
+    if settings.relay == RelayEngine.SPLICE and not SPLICE_SUPPORTED:
+        logger.warning('splice(2) is not supported on this platform, fallback to buffered relay.')
+        settings.relay = RelayEngine.BUFFERED
 
     set_open_file_limit(soft_limit)
 
     if enable_system_proxy:
-        open_system_proxy(system_proxies)
+        settings.upstream = settings.upstream + open_system_proxy(system_proxies)
 
     return token
 
 
-def release_udp_transport(
-    dst: Tuple[str,
-               int],
-    manager: UDP_MAPPING_TABLE_TYPE,
-    last_activity: Dict[Tuple[str,
-                              int],
-                        Union[int,
-                              float]]
-):
-    pair = manager.pop(dst, None)
-    last_activity.pop(dst, None)
-    if pair:
-        transport = pair[0]
-        transport.close()
-
-
 def parse_address(address: str, default_port: int = 80) -> Tuple[str, int, int]:
     """解析地址字符串
 
@@ -120,44 +124,107 @@ def parse_address(address: str, default_port: int = 80) -> Tuple[str, int, int]:
     return ip, port, version
 
 
+# asyncio.StreamReader 没有查看或取出已缓存数据的公开接口, 转发引擎接管连接与嗅探只通过以下函数访问其内部属性
+# _buffer/_eof/_wait_for_data. 这些属性在 CPython 3.7-3.12 中没有变化, uvloop 同样使用 asyncio 的 StreamReader.
+if not hasattr(asyncio.StreamReader, '_wait_for_data'):
+    raise ImportError('unsupported asyncio.StreamReader implementation')
+
+
+def stream_buffer(reader: asyncio.StreamReader) -> bytearray:
+    """StreamReader 中已缓存但尚未读取的数据, 返回内部缓冲区本身, 调用方不能修改"""
+    return reader._buffer  # type: ignore
+
+
+def take_buffered(reader: asyncio.StreamReader) -> bytes:
+    """取出 StreamReader 中已缓存的数据, 不等待新数据, 用于转发引擎接管 transport"""
+    buffer = reader._buffer  # type: ignore
+    data = bytes(buffer)
+    buffer.clear()
+    return data
+
+
+def eof_received(reader: asyncio.StreamReader) -> bool:
+    """对端已关闭或连接出错, 与 at_eof 不同, 缓冲区中仍可能有数据"""
+    return reader._eof or reader.exception() is not None  # type: ignore
+
+
+async def wait_for_buffered(reader: asyncio.StreamReader, size: int):
+    """等待缓冲区超过 size 字节或连接关闭, 不消费数据
+
+    在 wait_for 创建的新任务中调用时, 任务开始前到达的数据不会唤醒 _wait_for_data, 因此先检查缓冲区.
+    """
+    if len(reader._buffer) == size and not reader._eof:  # type: ignore
+        await reader._wait_for_data('wait_for_buffered')  # type: ignore
+
+
 class Socks5ProxyParser:
+    """解析 socks5 请求与 UDP 数据报中的目标地址
+
+    地址从第 4 个字节的 ATYP 开始, 请求(VER CMD RSV)与 UDP 数据报(RSV FRAG)格式相同.
+    解析结果只包含目标地址和头部长度, 消息体通过偏移量从原数据中获取.
+    同一个域名重复出现时(同一个 UDP 关联的数据报)直接使用缓存的目标地址.
+    """
 
     IPV4 = 1
     HOST = 3
     IPV6 = 4
 
-    @staticmethod
-    def unpack(data: bytes) -> Tuple[Tuple[str, int], bytes, bytes]:
-        """按照 socks5 协议解析数据包
+    CACHE_SIZE = 4096
+    _cache: Dict[bytes, Tuple[str, int]] = {}
+
+    @classmethod
+    def parse(cls, data: bytes) -> Optional[Tuple[Tuple[str, int], int]]:
+        """返回目标地址与头部长度, 数据不合法时返回 None
+
+        不合法的数据很可能来自扫描或攻击, 这里不抛出异常也不记录日志.
+        """
+        size = len(data)
+        if size < 5:
+            return None
+        atyp = data[3]
+        if atyp == cls.IPV4:
+            end = 10
+        elif atyp == cls.IPV6:
+            end = 22
+        elif atyp == cls.HOST and data[4]:
+            end = 7 + data[4]
+        else:
+            return None
+        if size < end:
+            return None
+
+        port = data[end - 2] << 8 | data[end - 1]
+        if atyp == cls.IPV4:
+            return (socket.inet_ntop(socket.AF_INET, data[4:8]), port), end
+        if atyp == cls.IPV6:
+            return (socket.inet_ntop(socket.AF_INET6, data[4:20]), port), end
+
+        # 只缓存域名, IP 地址的转换开销很小
+        key = data[5:end]
+        dst = cls._cache.get(key)
+        if dst is None:
+            host = key[:-2]
+            if not host.isascii():
+                return None
+            dst = (host.decode('ascii'), port)
+
+            cache = cls._cache
+            if len(cache) >= cls.CACHE_SIZE:
+                # 多个线程中的事件循环共用缓存, 淘汰时其他线程可能同时修改, 不能抛出异常
+                try:
+                    cache.pop(next(iter(cache), None), None)
+                except RuntimeError:
+                    pass
+            cache[key] = dst
+        return dst, end
+
+    @classmethod
+    def unpack(cls, data: bytes) -> Tuple[Tuple[str, int], bytes, bytes]:
+        """按照 socks5 协议解析数据包, 返回目标地址、头部与消息体, 数据不合法时返回空值
         """
-        dst: tuple[str, int] = ("", 0)
-        message: bytes = b''
-        header: bytes = b''
-        try:
-            atyp = data[3]
-            if atyp == Socks5ProxyParser.IPV4:
-                addr = socket.inet_ntop(socket.AF_INET, data[4:8])
-                port = int.from_bytes(data[8:10], 'big')
-                dst = (addr, port)
-                header = data[:10]
-                message = data[10:]
-
-            elif atyp == Socks5ProxyParser.IPV6:
-                addr = socket.inet_ntop(socket.AF_INET6, data[4:20])
-                port = int.from_bytes(data[20:22], 'big')
-                dst = (addr, port)
-                header = data[:22]
-                message = data[22:]
-
-            elif atyp == Socks5ProxyParser.HOST:
-                hostLen = data[4]
-                addr = (data[5:5 + hostLen]).decode()
-                port = struct.unpack('>H', data[5 + hostLen:7 + hostLen])[0]
-                dst = (addr, port)
-                header = data[:7 + hostLen]
-                message = data[7 + hostLen:]
-
-        except Exception as e:
-            logger.exception(e)
-
-        return dst, header, message
+        result = cls.parse(data)
+        if result is None:
+            logger.debug(f'invalid socks5 packet: {data[:32]!r}')
+            return ('', 0), b'', b''
+        dst, end = result
+        return dst, data[:end], data[end:]
@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import os
+import signal
+import socket
+import time
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+from pyproxy.auth import get_authenticator
+from pyproxy.protocols.udp import get_udp_associations
+
+logger = logging.getLogger(__name__)
+
+
+class UdpReleaseBus:
+    """worker 之间广播 UDP 关联的释放事件
+
+    SOCKS5 UDP ASSOCIATE 的 TCP 控制连接与 UDP 数据报可能被内核分配给不同的 worker,
+    控制连接断开时需要通知所有 worker 释放对应的 UDP 转发. 配置了认证时同样广播通过认证的客户端 IP.
+    每个 worker 持有一对 AF_UNIX 数据报 socket, 在 fork 之前创建, worker 重启后复用.
+    """
+
+    def __init__(self, workers: int):
+        self._pairs = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(workers)]
+        for pair in self._pairs:
+            for sock in pair:
+                sock.setblocking(False)
+        self._index: Optional[int] = None
+
+    def bind(self, index: int):
+        """在 worker 进程中调用, 确定本 worker 的接收端"""
+        self._index = index
+
+    def publish(self, dst: Tuple[str, int]):
+        self._send(f'release {dst[0]} {dst[1]}'.encode())
+
+    def publish_udp_client(self, ip: str, allowed: bool):
+        self._send(f'{"allow" if allowed else "disallow"} {ip}'.encode())
+
+    def _send(self, payload: bytes):
+        for idx, (_, sender) in enumerate(self._pairs):
+            if idx == self._index:
+                continue
+            try:
+                sender.send(payload)
+            except OSError as e:
+                logger.debug(f'[UdpReleaseBus] publish to worker {idx} failed: {e!r}')
+
+    def listen(self, loop: asyncio.AbstractEventLoop):
+        assert self._index is not None
+        receiver = self._pairs[self._index][0]
+        loop.add_reader(receiver.fileno(), self._on_readable, receiver)
+
+    def _on_readable(self, receiver: socket.socket):
+        while True:
+            try:
+                payload = receiver.recv(1024)
+            except BlockingIOError:
+                return
+            kind, *args = payload.decode().split(' ')
+            if kind == 'release':
+                get_udp_associations().release((args[0], int(args[1])))
+                continue
+            authenticator = get_authenticator()
+            if authenticator is None:
+                continue
+            if kind == 'allow':
+                authenticator.allow_udp(args[0])
+            else:
+                authenticator.disallow_udp(args[0])
+
+
+_release_bus: Optional[UdpReleaseBus] = None
+
+
+def get_release_bus() -> Optional[UdpReleaseBus]:
+    return _release_bus
+
+
+def _exit_code(status: int) -> int:
+    """与 os.waitstatus_to_exitcode(3.9+) 一致, 被信号终止时返回负的信号值"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class Supervisor:
+    """多进程模式
+
+    fork N 个 worker, 每个 worker 运行独立的事件循环并通过 SO_REUSEPORT 监听同一端口.
+    worker 异常退出后自动重启, 收到 SIGTERM/SIGINT 时转发给所有 worker 并等待其退出, SIGHUP 直接转发.
+    """
+
+    RESTART_DELAY = 1
+
+    def __init__(self, workers: int, target: Callable[[int], None]):
+        assert workers > 0
+        self._workers = workers
+        self._target = target
+        self._children: Dict[int, Tuple[int, float]] = {}
+        self._stopping = False
+        self._bus = UdpReleaseBus(workers)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        # 重新加载路由规则
+        signal.signal(signal.SIGHUP, lambda signum, frame: self._kill(signal.SIGHUP))
+
+        for index in range(self._workers):
+            self._spawn(index)
+
+        while self._children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            if pid not in self._children:
+                continue
+            index, started = self._children.pop(pid)
+            code = _exit_code(status)
+            if self._stopping:
+                logger.info(f'worker {index} (pid {pid}) exited with {code}')
+                continue
+
+            logger.warning(f'worker {index} (pid {pid}) exited unexpectedly with {code}, restarting')
+            # 避免 worker 启动即崩溃时频繁重启
+            if time.monotonic() - started < self.RESTART_DELAY:
+                time.sleep(self.RESTART_DELAY)
+            if not self._stopping:
+                self._spawn(index)
+
+    def _spawn(self, index: int):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                # worker 在事件循环中处理 SIGHUP, 此前收到时忽略
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+                global _release_bus
+                self._bus.bind(index)
+                _release_bus = self._bus
+                self._target(index)
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                logger.exception(f'worker {index} crashed')
+                code = 1
+            finally:
+                os._exit(code)
+
+        logger.info(f'worker {index} started, pid: {pid}')
+        self._children[pid] = (index, time.monotonic())
+
+    def _on_signal(self, signum: int, frame):
+        if self._stopping:
+            return
+        self._stopping = True
+        logger.info(f'received signal {signum}, stopping workers')
+        self._kill(signal.SIGTERM)
+
+    def _kill(self, signum: int):
+        pids: List[int] = list(self._children)
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
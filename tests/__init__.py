@@ -1,6 +1,9 @@
 import asyncio
+import http.server
+import os
 import socket
 import threading
+import time
 
 from typing import Generator
 
@@ -9,11 +12,43 @@ import pytest
 from httpx._types import ProxiesTypes
 
 from pyproxy.console import start_server
+from pyproxy.const import EventLoop, RelayEngine
 from pyproxy.settings import Settings
+from pyproxy.utils import install_event_loop
+
+# 通过环境变量 loop=asyncio|uvloop 选择运行测试的事件循环
+event_loop = install_event_loop(EventLoop(os.environ.get('loop', EventLoop.ASYNCIO.value)))
 
 proxy_default_settings = Settings(host='127.0.0.1', port=7999, proxy_addr='127.0.0.1', proxy_port=7999)
 proxy_settings = Settings(host='127.0.0.1', port=7555, proxy_addr='127.0.0.1', proxy_port=7555)
 proxy_over_host_settings = Settings(host='127.0.0.1', port=7888, proxy_addr='localhost', proxy_port=7888)
+proxy_stream_settings = Settings(
+    host='127.0.0.1',
+    port=7666,
+    proxy_addr='127.0.0.1',
+    proxy_port=7666,
+    relay=RelayEngine.STREAM
+)
+proxy_splice_settings = Settings(
+    host='127.0.0.1',
+    port=7667,
+    proxy_addr='127.0.0.1',
+    proxy_port=7667,
+    relay=RelayEngine.SPLICE
+)
+
+
+def _serve(coro, settings: Settings) -> threading.Thread:
+    t = threading.Thread(target=asyncio.run, args=(coro, ), daemon=True)
+    t.start()
+    # 等待代理服务开始监听
+    for _ in range(50):
+        try:
+            socket.create_connection((settings.host, settings.port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return t
 
 
 @pytest.fixture(scope="session")
@@ -24,17 +59,13 @@ def proxy() -> Generator[threading.Thread, None, None]:
         proxy_addr=proxy_default_settings.proxy_addr,
         proxy_port=proxy_default_settings.proxy_port
     )
-    t = threading.Thread(target=asyncio.run, args=(coro, ), daemon=True)
-    t.start()
-    yield t
+    yield _serve(coro, proxy_default_settings)
 
 
 @pytest.fixture(scope="session")
 def proxy_with_settings() -> Generator[threading.Thread, None, None]:
     coro = start_server(proxy_settings.host, proxy_settings.port, settings=proxy_settings)
-    t = threading.Thread(target=asyncio.run, args=(coro, ), daemon=True)
-    t.start()
-    yield t
+    yield _serve(coro, proxy_settings)
 
 
 @pytest.fixture(scope="session")
@@ -44,11 +75,94 @@ def proxy_over_host() -> Generator[threading.Thread, None, None]:
         proxy_over_host_settings.port,
         settings=proxy_over_host_settings
     )
-    t = threading.Thread(target=asyncio.run, args=(coro, ), daemon=True)
+    yield _serve(coro, proxy_over_host_settings)
+
+
+@pytest.fixture(scope="session")
+def proxy_stream() -> Generator[threading.Thread, None, None]:
+    coro = start_server(proxy_stream_settings.host, proxy_stream_settings.port, settings=proxy_stream_settings)
+    yield _serve(coro, proxy_stream_settings)
+
+
+@pytest.fixture(scope="session")
+def proxy_splice() -> Generator[threading.Thread, None, None]:
+    coro = start_server(proxy_splice_settings.host, proxy_splice_settings.port, settings=proxy_splice_settings)
+    yield _serve(coro, proxy_splice_settings)
+
+
+@pytest.fixture(scope="session")
+def tcp_echo_server() -> Generator[threading.Thread, None, None]:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 31338))
+    sock.listen()
+    t = threading.Thread(target=_tcp_echo_server, args=(sock, ), daemon=True)
     t.start()
     yield t
 
 
+def _tcp_echo_server(sock: socket.socket):
+    while True:
+        conn, _ = sock.accept()
+        threading.Thread(target=_tcp_echo_handler, args=(conn, ), daemon=True).start()
+
+
+def _tcp_echo_handler(conn: socket.socket):
+    with conn:
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            conn.sendall(data)
+
+
+class _HttpOriginHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    connections: set = set()
+
+    def setup(self):
+        super().setup()
+        self.connections.add(self.client_address)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        body = self.path.encode()
+        if self.path.startswith('/headers'):
+            body = str(self.headers).encode()
+        if self.path.startswith('/chunked'):
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for part in (body, b'\r\n\r\n', body):
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(part), part))
+            self.wfile.write(b'0\r\n\r\n')
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture(scope="session")
+def http_origin_server() -> Generator[http.server.ThreadingHTTPServer, None, None]:
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 31380), _HttpOriginHandler)
+    server.daemon_threads = True
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+    yield server
+
+
 @pytest.fixture(scope="session")
 def udp_echo_server() -> Generator[threading.Thread, None, None]:
     t = threading.Thread(target=_udp_echo_server, daemon=True)
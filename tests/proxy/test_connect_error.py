@@ -0,0 +1,40 @@
+import socket
+import struct
+
+from tests import proxy, proxy_default_settings  # nopycln: import
+
+from pyproxy.const import Socks5REP
+
+CLOSED_PORT = 31399
+
+
+def test_socks5_connection_refused(proxy):
+    settings = proxy_default_settings
+    s = socket.create_connection((settings.proxy_addr, settings.proxy_port), timeout=10)
+    s.sendall(b'\x05\x01\x00')
+    assert s.recv(2) == b'\x05\x00'
+
+    s.sendall(b'\x05\x01\x00\x01' + socket.inet_aton('127.0.0.1') + struct.pack('>H', CLOSED_PORT))
+    reply = s.recv(10)
+    assert reply[1] == Socks5REP.CONNECTION_REFUSED, reply
+    s.close()
+
+
+def test_socks5_command_not_supported(proxy):
+    settings = proxy_default_settings
+    s = socket.create_connection((settings.proxy_addr, settings.proxy_port), timeout=10)
+    s.sendall(b'\x05\x01\x00')
+    assert s.recv(2) == b'\x05\x00'
+
+    s.sendall(b'\x05\x02\x00\x01' + socket.inet_aton('127.0.0.1') + struct.pack('>H', CLOSED_PORT))
+    reply = s.recv(10)
+    assert reply[1] == Socks5REP.COMMAND_NOT_SUPPORTED, reply
+    s.close()
+
+
+def test_http_connect_bad_gateway(proxy):
+    settings = proxy_default_settings
+    s = socket.create_connection((settings.proxy_addr, settings.proxy_port), timeout=10)
+    s.sendall(b'CONNECT 127.0.0.1:%d HTTP/1.1\r\n\r\n' % CLOSED_PORT)
+    assert s.recv(4096).startswith(b'HTTP/1.1 502'), 'expect bad gateway'
+    s.close()
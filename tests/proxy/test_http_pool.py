@@ -0,0 +1,80 @@
+import socket
+
+import httpx
+
+from tests import http_origin_server, proxy  # nopycln: import
+from tests import _HttpOriginHandler, _proxies_http, proxy_default_settings
+
+ORIGIN = 'http://127.0.0.1:31380'
+
+
+def _read_response(s: socket.socket, buf: bytes = b'') -> bytes:
+    while b'\r\n\r\n' not in buf:
+        buf += s.recv(4096)
+    head, _, body = buf.partition(b'\r\n\r\n')
+    length = int([line for line in head.split(b'\r\n') if line.lower().startswith(b'content-length')][0].split(b':')[1])
+    while len(body) < length:
+        body += s.recv(4096)
+    return body
+
+
+def test_http_keep_alive_reuses_upstream(proxy, http_origin_server):
+    settings = proxy_default_settings
+    _HttpOriginHandler.connections.clear()
+    s = socket.create_connection((settings.proxy_addr, settings.proxy_port), timeout=10)
+    for i in range(3):
+        s.sendall(b'GET %s/keep-alive/%d HTTP/1.1\r\nHost: 127.0.0.1:31380\r\n\r\n' % (ORIGIN.encode(), i))
+        assert _read_response(s) == b'/keep-alive/%d' % i
+
+    s.sendall(b'POST %s/post HTTP/1.1\r\nHost: 127.0.0.1:31380\r\nContent-Length: 8\r\n\r\n\r\n\r\nbody' % ORIGIN.encode())
+    assert _read_response(s) == b'\r\n\r\nbody'
+    s.close()
+
+    # 所有请求复用同一个上游连接
+    assert len(_HttpOriginHandler.connections) <= 1
+
+
+def test_http_chunked_response(proxy, http_origin_server):
+    settings = proxy_default_settings
+    with httpx.Client(proxies=_proxies_http(settings), timeout=10) as client:
+        for _ in range(2):
+            r = client.get(f'{ORIGIN}/chunked')
+            assert r.status_code == 200
+            assert r.content == b'/chunked\r\n\r\n/chunked'
+
+
+def test_http_hop_by_hop_headers(proxy, http_origin_server):
+    settings = proxy_default_settings
+    s = socket.create_connection((settings.proxy_addr, settings.proxy_port), timeout=10)
+    s.sendall(b'GET %s/headers HTTP/1.1\r\n'
+              b'Host: 127.0.0.1:31380\r\n'
+              b'Proxy-Authorization: Basic dXNlcjpwYXNz\r\n'
+              b'Proxy-Connection: keep-alive\r\n'
+              b'Connection: keep-alive, X-Hop\r\n'
+              b'X-Hop: 1\r\n'
+              b'TE: trailers\r\n'
+              b'X-End: 1\r\n'
+              b'\r\n' % ORIGIN.encode())
+    headers = _read_response(s).lower()
+    s.close()
+    assert b'x-end: 1' in headers
+    for name in (b'proxy-authorization', b'proxy-connection', b'connection', b'x-hop', b'te'):
+        assert b'\n%s:' % name not in b'\n' + headers
+
+
+def test_http_ambiguous_length_rejected(proxy, http_origin_server):
+    settings = proxy_default_settings
+    s = socket.create_connection((settings.proxy_addr, settings.proxy_port), timeout=10)
+    s.sendall(b'POST %s/post HTTP/1.1\r\nHost: 127.0.0.1:31380\r\n'
+              b'Transfer-Encoding: chunked\r\nContent-Length: 4\r\n\r\n0\r\n\r\n' % ORIGIN.encode())
+    assert s.recv(4096).startswith(b'HTTP/1.1 400 ')
+    s.close()
+
+    # 同一连接上的后续请求同样检查
+    s = socket.create_connection((settings.proxy_addr, settings.proxy_port), timeout=10)
+    s.sendall(b'GET %s/a HTTP/1.1\r\nHost: 127.0.0.1:31380\r\n\r\n' % ORIGIN.encode())
+    assert _read_response(s) == b'/a'
+    s.sendall(b'POST %s/post HTTP/1.1\r\nHost: 127.0.0.1:31380\r\n'
+              b'Content-Length: 4\r\nContent-Length: 8\r\n\r\nbodybody' % ORIGIN.encode())
+    assert s.recv(4096).startswith(b'HTTP/1.1 400 ')
+    s.close()
@@ -0,0 +1,63 @@
+import socket
+
+import pytest
+import socks
+
+from tests import proxy, proxy_splice, proxy_stream, tcp_echo_server  # nopycln: import
+from tests import proxy_default_settings, proxy_splice_settings, proxy_stream_settings
+
+ECHO_ADDR = ('127.0.0.1', 31338)
+
+
+def _recv_exactly(s: socket.socket, size: int) -> bytes:
+    chunks = []
+    while size:
+        data = s.recv(min(size, 65536))
+        assert data, 'connection closed'
+        chunks.append(data)
+        size -= len(data)
+    return b''.join(chunks)
+
+
+ALL_ENGINES = [proxy_default_settings, proxy_stream_settings, proxy_splice_settings]
+
+
+@pytest.mark.parametrize('settings', ALL_ENGINES)
+def test_socks5_relay(proxy, proxy_stream, proxy_splice, tcp_echo_server, settings):
+    s = socks.socksocket()
+    s.set_proxy(socks.SOCKS5, settings.proxy_addr, settings.proxy_port)
+    s.settimeout(10)
+    s.connect(ECHO_ADDR)
+
+    payload = bytes(range(256)) * 4096
+    s.sendall(payload)
+    assert _recv_exactly(s, len(payload)) == payload
+    s.close()
+
+
+@pytest.mark.parametrize('settings', ALL_ENGINES)
+def test_http_connect_relay(proxy, proxy_stream, proxy_splice, tcp_echo_server, settings):
+    s = socket.create_connection((settings.proxy_addr, settings.proxy_port), timeout=10)
+    s.sendall(b'CONNECT %s:%d HTTP/1.1\r\n\r\n' % (ECHO_ADDR[0].encode(), ECHO_ADDR[1]))
+    resp = b''
+    while b'\r\n\r\n' not in resp:
+        resp += s.recv(4096)
+    assert resp.startswith(b'HTTP/1.0 200'), resp
+
+    s.sendall(b'ping')
+    assert _recv_exactly(s, 4) == b'ping'
+    s.close()
+
+
+@pytest.mark.parametrize('settings', [proxy_default_settings, proxy_splice_settings])
+def test_relay_half_close(proxy, proxy_splice, tcp_echo_server, settings):
+    s = socks.socksocket()
+    s.set_proxy(socks.SOCKS5, settings.proxy_addr, settings.proxy_port)
+    s.settimeout(10)
+    s.connect(ECHO_ADDR)
+
+    # 半关闭后仍能收到对端的剩余数据
+    s.sendall(b'pong')
+    s.shutdown(socket.SHUT_WR)
+    assert _recv_exactly(s, 4) == b'pong'
+    s.close()
@@ -0,0 +1,139 @@
+import json
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+from typing import Generator
+
+import pytest
+import socks
+
+from pyproxy.console import start_server
+from pyproxy.const import Socks5REP
+from pyproxy.settings import Settings
+from tests import _serve, _tcp_echo_server
+
+ECHO_ADDR = ('127.0.0.1', 31340)
+CLOSED_PORT = 31399
+
+
+@pytest.fixture(scope='module')
+def sniff_settings() -> Generator[Settings, None, None]:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(ECHO_ADDR)
+    sock.listen()
+    threading.Thread(target=_tcp_echo_server, args=(sock, ), daemon=True).start()
+
+    fd, rules = tempfile.mkstemp()
+    with os.fdopen(fd, 'w') as f:
+        f.write('domain-suffix,blocked.example,reject\n')
+    settings = Settings(
+        host='127.0.0.1', port=7682, proxy_addr='127.0.0.1', proxy_port=7682, sniff=True, rules=rules
+    )
+    _serve(start_server(settings.host, settings.port, settings=settings), settings)
+    yield settings
+    os.unlink(rules)
+
+
+def _connect(settings: Settings) -> socks.socksocket:
+    s = socks.socksocket()
+    s.set_proxy(socks.SOCKS5, settings.proxy_addr, settings.proxy_port)
+    s.settimeout(10)
+    s.connect(ECHO_ADDR)
+    return s
+
+
+def test_sniff_http_host(sniff_settings):
+    s = _connect(sniff_settings)
+    # 嗅探的数据原样转发
+    request = b'GET / HTTP/1.1\r\nHost: allowed.example\r\n\r\n'
+    s.sendall(request)
+    assert s.recv(len(request), socket.MSG_WAITALL) == request
+    s.close()
+
+
+def test_sniff_route_rejected(sniff_settings):
+    # 目标为 IP, 按请求中的域名匹配路由规则
+    s = _connect(sniff_settings)
+    s.sendall(b'GET / HTTP/1.1\r\nHost: www.blocked.example\r\n\r\n')
+    assert s.recv(4096) == b''
+    s.close()
+
+
+def test_sniff_timeout(sniff_settings):
+    # 客户端不先发送数据时, 超时后连接目标服务器
+    s = _connect(sniff_settings)
+    time.sleep(sniff_settings.sniff_timeout * 2)
+    s.sendall(b'ping')
+    assert s.recv(4, socket.MSG_WAITALL) == b'ping'
+    s.close()
+
+
+def _rules_file(content: str) -> str:
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, 'w') as f:
+        f.write(content)
+    return path
+
+
+def test_sniff_ip_rejected():
+    # 嗅探到的域名被允许时, 目标 IP 的拒绝规则仍然生效
+    rules = _rules_file('ip-cidr,127.0.0.0/8,reject\ndomain-suffix,allowed.example,direct\n')
+    settings = Settings(host='127.0.0.1', port=7684, proxy_addr='127.0.0.1', proxy_port=7684, sniff=True, rules=rules)
+    _serve(start_server(settings.host, settings.port, settings=settings), settings)
+    s = _connect(settings)
+    s.sendall(b'GET / HTTP/1.1\r\nHost: www.allowed.example\r\n\r\n')
+    # 代理关闭连接时客户端数据未读取, 可能收到 RST
+    try:
+        assert s.recv(4096) == b''
+    except ConnectionResetError:
+        pass
+    s.close()
+    os.unlink(rules)
+
+
+@pytest.fixture(scope='module')
+def sniff_log_settings(sniff_settings) -> Generator[Settings, None, None]:
+    # 没有域名规则, 嗅探只用于访问日志
+    fd, access_log = tempfile.mkstemp()
+    os.close(fd)
+    settings = Settings(
+        host='127.0.0.1', port=7683, proxy_addr='127.0.0.1', proxy_port=7683, sniff=True, access_log=access_log
+    )
+    _serve(start_server(settings.host, settings.port, settings=settings), settings)
+    yield settings
+    os.unlink(access_log)
+
+
+def test_sniff_connection_refused(sniff_log_settings):
+    # 没有域名规则时嗅探不会改变路由, 先连接目标服务器再按结果回复
+    settings = sniff_log_settings
+    s = socket.create_connection((settings.proxy_addr, settings.proxy_port), timeout=10)
+    s.sendall(b'\x05\x01\x00')
+    assert s.recv(2) == b'\x05\x00'
+
+    s.sendall(b'\x05\x01\x00\x01' + socket.inet_aton('127.0.0.1') + struct.pack('>H', CLOSED_PORT))
+    reply = s.recv(10)
+    assert reply[1] == Socks5REP.CONNECTION_REFUSED, reply
+    s.close()
+
+
+def test_sniff_access_log(sniff_log_settings):
+    s = _connect(sniff_log_settings)
+    request = b'GET / HTTP/1.1\r\nHost: logged.example\r\n\r\n'
+    s.sendall(request)
+    assert s.recv(len(request), socket.MSG_WAITALL) == request
+    s.close()
+
+    records = []
+    for _ in range(50):
+        with open(sniff_log_settings.access_log) as f:
+            records = [json.loads(line) for line in f]
+        if any(record['host'] == 'logged.example' for record in records):
+            break
+        time.sleep(0.1)
+    assert any(record['host'] == 'logged.example' for record in records), records
@@ -0,0 +1,69 @@
+import socket
+import struct
+import sys
+import threading
+
+from typing import Generator, Tuple
+
+import pytest
+
+from pyproxy.console import start_server
+from pyproxy.protocols.transparent import parse_sockaddr
+from pyproxy.settings import Settings
+from tests import _serve, _tcp_echo_server
+
+ECHO_ADDR = ('127.0.0.1', 31339)
+
+transparent_settings = Settings(
+    host='127.0.0.1', port=7680, proxy_addr='127.0.0.1', proxy_port=7680, transparent_port=7681
+)
+
+# 没有 iptables 时由测试指定原始目标地址
+_original_dst = [ECHO_ADDR]
+
+
+def _fake_original_dst(sock, mode) -> Tuple[str, int]:
+    return _original_dst[0]
+
+
+@pytest.fixture(scope='module')
+def transparent_proxy() -> Generator[None, None, None]:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(ECHO_ADDR)
+    sock.listen()
+    threading.Thread(target=_tcp_echo_server, args=(sock, ), daemon=True).start()
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr('pyproxy.protocols.socks5.original_dst', _fake_original_dst)
+        coro = start_server(transparent_settings.host, transparent_settings.port, settings=transparent_settings)
+        _serve(coro, transparent_settings)
+        yield
+
+
+def test_parse_sockaddr():
+    family = socket.AF_INET.to_bytes(2, sys.byteorder)
+    addr = socket.inet_aton('10.0.0.1')
+    assert parse_sockaddr(family + struct.pack('!H', 443) + addr + bytes(8)) == ('10.0.0.1', 443)
+
+    family = socket.AF_INET6.to_bytes(2, sys.byteorder)
+    addr = socket.inet_pton(socket.AF_INET6, '2001:db8::1')
+    assert parse_sockaddr(family + struct.pack('!H', 53) + bytes(4) + addr + bytes(4)) == ('2001:db8::1', 53)
+    mapped = socket.inet_pton(socket.AF_INET6, '::ffff:10.0.0.2')
+    assert parse_sockaddr(family + struct.pack('!H', 80) + bytes(4) + mapped + bytes(4)) == ('10.0.0.2', 80)
+
+
+def test_transparent_relay(transparent_proxy):
+    _original_dst[0] = ECHO_ADDR
+    s = socket.create_connection(('127.0.0.1', transparent_settings.transparent_port), timeout=10)
+    # 没有握手, 第一个数据包就转发给目标服务器
+    s.sendall(b'ping')
+    assert s.recv(4) == b'ping'
+    s.close()
+
+
+def test_transparent_loop_rejected(transparent_proxy):
+    # 直接连接透明代理端口时原始目标地址是代理自身
+    _original_dst[0] = ('127.0.0.1', transparent_settings.transparent_port)
+    s = socket.create_connection(('127.0.0.1', transparent_settings.transparent_port), timeout=10)
+    assert s.recv(4) == b''
+    s.close()
@@ -0,0 +1,19 @@
+import json
+
+from pyproxy.accesslog import AccessLog
+
+
+def test_access_log(tmp_path):
+    path = tmp_path / 'access.log'
+    access_log = AccessLog(str(path))
+    access_log.record(('127.0.0.1', 50000), ('example.com', 443), 'https', 517, 4096, 1.5, 'closed')
+    access_log.record(('127.0.0.1', 50001), None, 'unknown', 0, 0, 0.001, 'handshake_error')
+    access_log.close()
+
+    entries = [json.loads(line) for line in path.read_text().splitlines()]
+    assert len(entries) == 2
+    assert entries[0]['client'] == '127.0.0.1:50000'
+    assert entries[0]['target'] == 'example.com:443'
+    assert entries[0]['bytes_in'] == 517 and entries[0]['bytes_out'] == 4096
+    assert entries[1]['target'] is None
+    assert entries[1]['reason'] == 'handshake_error'
@@ -0,0 +1,53 @@
+import asyncio
+import time
+
+from pyproxy.admission import AdmissionControl, IdleTimer
+
+
+def test_admission_control():
+    admission = AdmissionControl(max_connections=3, max_connections_per_ip=2)
+    assert admission.admit('10.0.0.1')
+    assert admission.admit('10.0.0.1')
+    assert not admission.admit('10.0.0.1')
+    assert admission.admit('10.0.0.2')
+    assert not admission.admit('10.0.0.3')
+
+    admission.release('10.0.0.1')
+    assert admission.admit('10.0.0.3')
+    for ip in ('10.0.0.1', '10.0.0.2', '10.0.0.3'):
+        admission.release(ip)
+    assert admission.connections == 0
+    assert not admission._ips
+
+
+def test_load_shedding():
+    admission = AdmissionControl(max_loop_lag=0.05)
+
+    async def main():
+        admission.start(asyncio.get_running_loop())
+        await asyncio.sleep(0.15)
+        idle = admission.admit('127.0.0.1')
+        # 阻塞事件循环, 下一次采样的延迟约为 0.2 秒
+        time.sleep(0.3)
+        await asyncio.sleep(0.01)
+        overloaded = admission.admit('127.0.0.1')
+        admission.close()
+        return idle, overloaded
+
+    assert asyncio.run(main()) == (True, False)
+
+
+def test_idle_timer():
+
+    async def main():
+        activity = [0]
+        idle = asyncio.Event()
+        timer = IdleTimer(0.05, lambda: activity[0], idle.set)
+        for _ in range(5):
+            activity[0] += 1
+            await asyncio.sleep(0.03)
+        assert not idle.is_set()
+        await asyncio.wait_for(idle.wait(), 1)
+        timer.cancel()
+
+    asyncio.run(main())
@@ -0,0 +1,143 @@
+import asyncio
+import base64
+import socket
+import struct
+import threading
+import time
+
+from pyproxy.auth import (
+    AuthBackend,
+    Authenticator,
+    FileBackend,
+    _authenticator,
+    check_password,
+    hash_password,
+    parse_basic_auth,
+)
+from pyproxy.http import HttpRequest
+from pyproxy.protocols.socks5 import SocksProtocol
+from pyproxy.settings import Settings, _settings
+
+
+class _SlowBackend(AuthBackend):
+
+    def __init__(self):
+        self.calls = 0
+        self.threads = set()
+
+    def verify(self, username: str, password: str) -> bool:
+        self.calls += 1
+        self.threads.add(threading.get_ident())
+        time.sleep(0.05)
+        return (username, password) == ('alice', 's3cret')
+
+
+def test_hash_password():
+    encoded = hash_password('s3cret', iterations=1000)
+    assert encoded.startswith('pbkdf2_sha256$1000$')
+    assert check_password('s3cret', encoded)
+    assert not check_password('wrong', encoded)
+    assert not check_password('s3cret', 'md5$1$abc$def')
+
+
+def test_file_backend(tmp_path):
+    path = tmp_path / 'users.txt'
+    path.write_text(f'# users\nalice:{hash_password("s3cret", iterations=1000)}\n')
+    backend = FileBackend(str(path))
+    assert backend.verify('alice', 's3cret')
+    assert not backend.verify('alice', 'wrong')
+    assert not backend.verify('bob', 's3cret')
+
+
+def test_authenticator_cache():
+    backend = _SlowBackend()
+    authenticator = Authenticator(backend, maxsize=2)
+
+    async def main():
+        # 并发的相同凭据合并为一次后端调用, 后端在线程池中执行
+        results = await asyncio.gather(*(authenticator.authenticate('alice', 's3cret') for _ in range(10)))
+        assert results == [True] * 10
+        assert backend.calls == 1
+        assert threading.get_ident() not in backend.threads
+
+        assert await authenticator.authenticate('alice', 's3cret')
+        assert not await authenticator.authenticate('alice', 'wrong')
+        assert not await authenticator.authenticate('alice', 'wrong')
+        assert backend.calls == 2
+        assert authenticator.hits == 2
+
+        # 超出容量时淘汰最久未使用的结果
+        await authenticator.authenticate('bob', 'x')
+        assert await authenticator.authenticate('alice', 's3cret')
+        assert backend.calls == 4
+
+    asyncio.run(main())
+
+
+def test_parse_basic_auth():
+    token = base64.b64encode(b'alice:p:w')
+    assert parse_basic_auth(b'Basic ' + token) == ('alice', 'p:w')
+    assert parse_basic_auth(b'Bearer ' + token) is None
+    assert parse_basic_auth(b'Basic !!!') is None
+
+    request = HttpRequest(b'GET http://a/ HTTP/1.1\r\nProxy-Authorization: Basic x\r\nHost: a\r\n\r\n')
+    assert request.without_header(b'proxy-authorization').raw == b'GET http://a/ HTTP/1.1\r\nHost: a\r\n\r\n'
+
+
+async def _echo(reader, writer):
+    while True:
+        data = await reader.read(1024)
+        if not data:
+            break
+        writer.write(data)
+    writer.close()
+
+
+def test_proxy_authentication():
+    credentials = base64.b64encode(b'alice:s3cret')
+
+    async def socks5(port, username, password, target):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'\x05\x01\x00')
+        # 配置了认证时不接受匿名
+        assert await reader.read(2) == b'\x05\xff'
+        writer.close()
+
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'\x05\x02\x00\x02')
+        assert await reader.readexactly(2) == b'\x05\x02'
+        writer.write(bytes((1, len(username))) + username + bytes((len(password), )) + password)
+        status = await reader.readexactly(2)
+        if status != b'\x01\x00':
+            writer.close()
+            return status
+        writer.write(b'\x05\x01\x00\x01' + socket.inet_aton('127.0.0.1') + struct.pack('>H', target))
+        assert (await reader.readexactly(10))[1] == 0
+        writer.write(b'ping')
+        data = await reader.readexactly(4)
+        writer.close()
+        return data
+
+    async def http_connect(port, head, target):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'CONNECT 127.0.0.1:%d HTTP/1.1\r\n%s\r\n' % (target, head))
+        status = (await reader.readuntil(b'\r\n\r\n')).split(b' ')[1]
+        writer.close()
+        return status
+
+    async def main():
+        _settings.set(Settings(host='127.0.0.1', port=0, proxy_addr='127.0.0.1', proxy_port=0))
+        _authenticator.set(Authenticator(_SlowBackend()))
+        echo = await asyncio.start_server(_echo, '127.0.0.1', 0)
+        server = await asyncio.start_server(SocksProtocol.handler, '127.0.0.1', 0)
+        port, target = server.sockets[0].getsockname()[1], echo.sockets[0].getsockname()[1]
+        try:
+            assert await socks5(port, b'alice', b's3cret', target) == b'ping'
+            assert await socks5(port, b'alice', b'wrong', target) == b'\x01\x01'
+            assert await http_connect(port, b'', target) == b'407'
+            assert await http_connect(port, b'Proxy-Authorization: Basic ' + credentials + b'\r\n', target) == b'200'
+        finally:
+            server.close()
+            echo.close()
+
+    asyncio.run(main())
@@ -0,0 +1,35 @@
+from pyproxy.buffers import INITIAL_READ_SIZE, MAX_READ_SIZE, MIN_READ_SIZE, BufferPool, ReadSize
+
+
+def test_read_size():
+    size = ReadSize()
+    # 读满时加倍, 直到上限
+    for _ in range(10):
+        size.update(size.size)
+    assert size.size == MAX_READ_SIZE
+
+    # 偶尔的小数据段不缩小
+    size.update(10)
+    size.update(MAX_READ_SIZE // 2)
+    size.update(10)
+    assert size.size == MAX_READ_SIZE
+
+    # 持续的小数据段逐步缩小, 直到下限
+    for _ in range(100):
+        size.update(10)
+    assert size.size == MIN_READ_SIZE
+    assert MIN_READ_SIZE <= INITIAL_READ_SIZE <= MAX_READ_SIZE
+
+
+def test_buffer_pool():
+    pool = BufferPool(limit=3 * 4096)
+    buffers = [pool.acquire(4096) for _ in range(4)]
+    assert pool.misses == 4
+    for buffer in buffers:
+        pool.release(buffer)
+    # 每一级最多保留 limit 字节
+    assert pool.nbytes == 3 * 4096
+
+    assert pool.acquire(4096) is buffers[2]
+    assert pool.acquire(8192) is not None
+    assert (pool.hits, pool.misses) == (1, 5)
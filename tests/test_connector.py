@@ -0,0 +1,78 @@
+import asyncio
+import time
+
+from pyproxy import connector
+from pyproxy.connector import interleave, open_connection
+from pyproxy.resolver import Resolver, _resolver
+
+
+def test_interleave():
+    assert interleave(['::1', '::2', '10.0.0.1']) == ['::1', '10.0.0.1', '::2']
+    assert interleave(['10.0.0.1', '10.0.0.2', '::1']) == ['10.0.0.1', '::1', '10.0.0.2']
+    assert interleave(['10.0.0.1', '10.0.0.2']) == ['10.0.0.1', '10.0.0.2']
+
+
+def test_happy_eyeballs(monkeypatch):
+    attempts = []
+
+    async def fake_open_connection(host, port):
+        attempts.append((host, time.monotonic()))
+        if host == '::1':
+            await asyncio.sleep(60)
+        if host == '10.0.0.2':
+            raise ConnectionRefusedError(111, 'Connection refused')
+        return host, port
+
+    async def fake_resolve(host, family=0):
+        return ['::1', '10.0.0.2', '::2', '10.0.0.3']
+
+    async def main():
+        resolver = Resolver()
+        monkeypatch.setattr(resolver, 'resolve', fake_resolve)
+        _resolver.set(resolver)
+        monkeypatch.setattr(connector, 'connect_addr', fake_open_connection)
+
+        start = time.monotonic()
+        result = await open_connection('example.test', 80, delay=0.1, timeout=5)
+        # ::1 无响应, 0.1 秒后尝试 10.0.0.2, 被拒绝后立即尝试 ::2
+        assert result == ('::2', 80)
+        assert [host for host, _ in attempts] == ['::1', '10.0.0.2', '::2']
+        assert time.monotonic() - start < 1
+
+    asyncio.run(main())
+
+
+def test_happy_eyeballs_close_loser(monkeypatch):
+    closed = []
+
+    class FakeWriter:
+        def __init__(self, host):
+            self.host = host
+
+        def close(self):
+            closed.append(self.host)
+
+    async def fake_open_connection(host, port):
+        if host == '::1':
+            # 取消时连接恰好建立
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                pass
+        return None, FakeWriter(host)
+
+    async def fake_resolve(host, family=0):
+        return ['::1', '10.0.0.2']
+
+    async def main():
+        resolver = Resolver()
+        monkeypatch.setattr(resolver, 'resolve', fake_resolve)
+        _resolver.set(resolver)
+        monkeypatch.setattr(connector, 'connect_addr', fake_open_connection)
+
+        _, writer = await open_connection('example.test', 80, delay=0.05, timeout=5)
+        assert writer.host == '10.0.0.2'
+        await asyncio.sleep(0.05)
+        assert closed == ['::1']
+
+    asyncio.run(main())
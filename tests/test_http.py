@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+from pyproxy.errors import HttpParseError
+from pyproxy.http import HttpRequest, HttpStream, read_request, read_response
+
+
+class _SegmentReader:
+
+    def __init__(self, data: bytes, segment: int):
+        self._chunks = [data[i:i + segment] for i in range(0, len(data), segment)]
+
+    async def read(self, n: int = -1) -> bytes:
+        return self._chunks.pop(0) if self._chunks else b''
+
+
+def test_read_request_segmented():
+    data = (b'POST http://example.com:8080/a?b HTTP/1.1\r\n'
+            b'HOST: example.com:8080\r\n'
+            b'content-length: 8\r\n'
+            b'\r\n'
+            b'\r\n\r\nbody')
+
+    async def main():
+        for segment in (1, 3, 7, len(data)):
+            stream = HttpStream(_SegmentReader(data, segment))  # type: ignore
+            request = await read_request(stream)
+            assert request.method == b'POST'
+            assert request.address() == ('example.com', 8080)
+            assert request.get_header(b'host') == b'example.com:8080'
+            assert request.content_length == 8
+            assert request.origin_form().startswith(b'POST /a?b HTTP/1.1\r\n')
+            # 消息体中的空行不影响请求头的边界
+            body = b''
+            while True:
+                chunk = await stream.read()
+                if not chunk:
+                    break
+                body += chunk
+            assert body == b'\r\n\r\nbody'
+
+    asyncio.run(main())
+
+
+def test_read_request_invalid():
+
+    async def main():
+        stream = HttpStream(_SegmentReader(b'GET / HTTP/1.1\r\nHost: a\r\n' + b'x' * 2**17, 2**10))  # type: ignore
+        with pytest.raises(HttpParseError):
+            await read_request(stream)
+
+        assert await read_request(HttpStream(_SegmentReader(b'', 1))) is None  # type: ignore
+        with pytest.raises(asyncio.IncompleteReadError):
+            await read_request(HttpStream(_SegmentReader(b'GET / HTTP/1.1\r\n', 4)))  # type: ignore
+
+    asyncio.run(main())
+
+    with pytest.raises(HttpParseError):
+        HttpRequest(b'GARBAGE\r\n\r\n')
+    assert HttpRequest(b'CONNECT [::1]:8443 HTTP/1.1\r\n\r\n').address(443) == ('::1', 8443)
+
+
+def test_without_hop_by_hop():
+    request = HttpRequest(b'GET / HTTP/1.1\r\n'
+                          b'Host: a\r\n'
+                          b'Connection: Keep-Alive, X-Hop, Content-Length\r\n'
+                          b'Keep-Alive: timeout=5\r\n'
+                          b'X-Hop: 1\r\n'
+                          b'Content-Length: 0\r\n'
+                          b'\r\n')
+    assert request.origin_form() == b'GET / HTTP/1.1\r\nHost: a\r\nContent-Length: 0\r\n\r\n'
+
+    # 协议升级请求保留 Upgrade 首部
+    request = HttpRequest(b'GET / HTTP/1.1\r\nHost: a\r\nConnection: keep-alive, Upgrade\r\nUpgrade: websocket\r\n\r\n')
+    assert request.origin_form() == b'GET / HTTP/1.1\r\nHost: a\r\nUpgrade: websocket\r\nConnection: upgrade\r\n\r\n'
+
+
+def test_message_framing():
+
+    async def main():
+        for head in (b'Content-Length: 3\r\nContent-Length: 4\r\n', b'Content-Length: 3, 4\r\n',
+                     b'Transfer-Encoding: chunked\r\nContent-Length: 3\r\n', b'Transfer-Encoding: gzip\r\n',
+                     b'Transfer-Encoding: xchunked\r\n', b'Transfer-Encoding: gzip;chunked\r\n',
+                     b'Transfer-Encoding: chunked, identity\r\n',
+                     b'Transfer-Encoding: chunked\r\nTransfer-Encoding: identity\r\n',
+                     b'Transfer-Encoding: chunked\r\nTransfer-Encoding: chunked\r\n'):
+            data = b'POST / HTTP/1.1\r\nHost: a\r\n' + head + b'\r\n'
+            with pytest.raises(HttpParseError):
+                await read_request(HttpStream(_SegmentReader(data, len(data))))  # type: ignore
+
+        # 多个 Transfer-Encoding 首部合并, 最后一个传输编码为 chunked
+        data = b'POST / HTTP/1.1\r\nHost: a\r\nTransfer-Encoding: gzip\r\nTransfer-Encoding: Chunked\r\n\r\n'
+        assert (await read_request(HttpStream(_SegmentReader(data, len(data))))).chunked  # type: ignore
+
+        data = b'POST / HTTP/1.1\r\nHost: a\r\nContent-Length: 3\r\nContent-Length: 3\r\n\r\n'
+        assert (await read_request(HttpStream(_SegmentReader(data, len(data))))).content_length == 3  # type: ignore
+
+        # 响应以 Transfer-Encoding 为准, 去掉 Content-Length
+        data = b'HTTP/1.1 200 OK\r\nContent-Length: 3\r\nTransfer-Encoding: chunked\r\n\r\n'
+        response = await read_response(HttpStream(_SegmentReader(data, len(data))))  # type: ignore
+        assert response.raw == b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+
+    asyncio.run(main())
@@ -0,0 +1,69 @@
+import asyncio
+import socket
+
+from pyproxy.lifecycle import HandoffServer, Lifecycle, confirm_takeover, take_over
+
+
+class _Connection:
+
+    def __init__(self, idle=False):
+        self.idle = idle
+
+
+def test_drain():
+
+    async def main():
+        lifecycle = Lifecycle(drain_timeout=0.2)
+        connections = [_Connection(), _Connection(), _Connection(idle=True)]
+        tasks = [
+            asyncio.ensure_future(asyncio.sleep(0.05)),
+            asyncio.ensure_future(asyncio.sleep(10)),
+            asyncio.ensure_future(asyncio.sleep(10)),
+        ]
+        for connection, task in zip(connections, tasks):
+            lifecycle.track(connection, task)
+            task.add_done_callback(lambda _, c=connection: lifecycle.discard(c))
+
+        lifecycle.shutdown()
+        await lifecycle.wait_shutdown()
+        await asyncio.sleep(0)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await lifecycle.drain()
+        elapsed = loop.time() - start
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return elapsed, [task.cancelled() for task in tasks], len(lifecycle)
+
+    elapsed, cancelled, remaining = asyncio.run(main())
+    assert 0.15 < elapsed < 1
+    # 正常结束的连接不受影响, 空闲连接立即关闭, 超时的连接被取消
+    assert cancelled == [False, True, True]
+    assert remaining == 0
+
+
+def test_handoff(tmp_path):
+    path = str(tmp_path / 'handoff.sock')
+
+    async def main():
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen()
+        handed_off = asyncio.Event()
+        server = HandoffServer(path, [listener.fileno()], handed_off.set)
+        await server.start()
+        try:
+            result = await take_over(path)
+            assert result is not None
+            sockets, channel = result
+            confirm_takeover(channel)
+            await asyncio.wait_for(handed_off.wait(), 5)
+            names = [sock.getsockname() for sock in sockets]
+            for sock in sockets:
+                sock.close()
+            return listener.getsockname(), names
+        finally:
+            server.close()
+            listener.close()
+
+    addr, inherited = asyncio.run(main())
+    assert inherited == [addr]
@@ -0,0 +1,66 @@
+import asyncio
+
+from pyproxy.metrics import Counter, Gauge, Histogram, Registry, start_metrics_server
+
+
+def test_render():
+    registry = Registry()
+    counter = Counter('test_requests', 'requests', ['code'], registry=registry)
+    gauge = Gauge('test_active', 'active', registry=registry)
+    histogram = Histogram('test_seconds', 'seconds', buckets=(0.1, 1), registry=registry)
+
+    counter.labels('200').inc(3)
+    gauge.set_function(lambda: 7)
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    lines = registry.render().decode().splitlines()
+    assert '# TYPE test_requests_total counter' in lines
+    assert 'test_requests_total{code="200"} 3' in lines
+    assert 'test_active 7' in lines
+    assert 'test_seconds_bucket{le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{le="1"} 2' in lines
+    assert 'test_seconds_bucket{le="+Inf"} 3' in lines
+    assert 'test_seconds_count 3' in lines
+    assert 'test_seconds_sum 5.55' in lines
+
+
+def test_metrics_server():
+
+    async def main():
+        server = await start_metrics_server('127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            responses = []
+            for path in (b'/metrics', b'/'):
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(b'GET ' + path + b' HTTP/1.1\r\nHost: localhost\r\n\r\n')
+                responses.append(await reader.read())
+                writer.close()
+            return responses
+        finally:
+            server.close()
+
+    found, not_found = asyncio.run(main())
+    assert found.startswith(b'HTTP/1.0 200 OK')
+    assert b'# TYPE pyproxy_relay_bytes_total counter' in found
+    assert not_found.startswith(b'HTTP/1.0 404')
+
+
+def test_gauge_functions():
+    registry = Registry()
+    gauge = Gauge('test_associations', 'associations', registry=registry)
+    lag = Gauge('test_lag', 'lag', registry=registry, aggregate=max)
+
+    # 同一进程中的两个服务各自注册
+    remove = gauge.add_function(lambda: 3)
+    gauge.add_function(lambda: 4)
+    lag.add_function(lambda: 0.5)
+    lag.add_function(lambda: 0.25)
+    assert 'test_associations 7' in registry.render().decode().splitlines()
+    assert 'test_lag 0.5' in registry.render().decode().splitlines()
+
+    remove()
+    remove()
+    assert 'test_associations 4' in registry.render().decode().splitlines()
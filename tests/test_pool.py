@@ -0,0 +1,50 @@
+import asyncio
+
+from pyproxy.pool import ConnectionPool
+
+
+def test_connection_pool():
+
+    async def main():
+        peers = []
+
+        async def handler(reader, writer):
+            peers.append(writer)
+            await reader.read()
+            writer.close()
+
+        server = await asyncio.start_server(handler, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        pool = ConnectionPool(max_idle=1, max_age=60, idle_timeout=60, max_per_host=2)
+
+        a = await pool.acquire('127.0.0.1', port)
+        pool.release(a)
+        assert pool.idle_count('127.0.0.1', port) == 1
+        assert await pool.acquire('127.0.0.1', port) is a
+        assert pool.hits == 1 and pool.misses == 1
+
+        # 达到单个目标服务器的连接数上限时等待其他连接释放
+        b = await pool.acquire('127.0.0.1', port)
+        waiter = asyncio.ensure_future(pool.acquire('127.0.0.1', port))
+        await asyncio.sleep(0.05)
+        assert not waiter.done()
+        pool.release(b)
+        assert await waiter is b
+
+        # 对端关闭的空闲连接不再复用
+        pool.release(a)
+        pool.release(b)
+        assert pool.idle_count('127.0.0.1', port) == 1
+        for peer in peers:
+            peer.close()
+        await asyncio.sleep(0.05)
+        c = await pool.acquire('127.0.0.1', port)
+        assert c is not a and c is not b
+        pool.release(c, reusable=False)
+        assert pool.idle_count('127.0.0.1', port) == 0
+
+        pool.close()
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(main())
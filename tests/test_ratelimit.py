@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+from pyproxy.protocols.relay import Tunnel
+from pyproxy.ratelimit import RateLimiter, TokenBucket
+
+
+def test_token_bucket():
+    bucket = TokenBucket(1000)
+    assert bucket.consume(1000) == 0
+    assert 0.4 < bucket.consume(500) <= 0.5
+    assert not bucket.try_consume(1)
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(connection_rate=0, ip_rate=0, global_rate=0)
+    assert limiter.open('127.0.0.1') is None
+
+    limiter = RateLimiter(connection_rate=1000, ip_rate=1000, global_rate=0)
+    a = limiter.open('127.0.0.1')
+    b = limiter.open('127.0.0.1')
+    assert a and b
+    # 同一 IP 的连接共享令牌桶
+    assert a.try_consume(1000)
+    assert not b.try_consume(1)
+    a.close()
+    b.close()
+    assert not limiter._ips
+    assert limiter.open('127.0.0.1').try_consume(1000)  # type: ignore
+
+
+def test_throttled_tunnel():
+    size = 2**20
+    rate = 2**19
+
+    async def main():
+
+        async def source(reader, writer):
+            writer.write(bytes(size))
+            await writer.drain()
+            writer.close()
+
+        async def relay(reader, writer):
+            target = await asyncio.open_connection('127.0.0.1', source_port)
+            throttle = RateLimiter(connection_rate=rate).open('127.0.0.1')
+            tunnel = Tunnel((reader, writer), target, throttle=throttle)
+            tunnel.start()
+            await tunnel.wait_closed()
+
+        source_server = await asyncio.start_server(source, '127.0.0.1', 0)
+        source_port = source_server.sockets[0].getsockname()[1]
+        relay_server = await asyncio.start_server(relay, '127.0.0.1', 0)
+        relay_port = relay_server.sockets[0].getsockname()[1]
+
+        start = time.monotonic()
+        reader, writer = await asyncio.open_connection('127.0.0.1', relay_port)
+        received = len(await reader.read())
+        elapsed = time.monotonic() - start
+        writer.close()
+        source_server.close()
+        relay_server.close()
+        return received, elapsed
+
+    received, elapsed = asyncio.run(main())
+    assert received == size
+    # 桶容量为 1 秒的流量, 剩余部分按限速转发
+    assert elapsed >= (size - rate) / rate * 0.9
@@ -0,0 +1,80 @@
+import asyncio
+import socket
+
+import pytest
+
+from pyproxy.resolver import Resolver
+
+
+def _patch_getaddrinfo(loop: asyncio.AbstractEventLoop, calls: list):
+
+    async def getaddrinfo(host, port, *, family=0, type=0, proto=0, flags=0):
+        calls.append(host)
+        await asyncio.sleep(0.01)
+        if host == 'nxdomain.test':
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+        return [
+            (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('10.0.0.1', 0)),
+            (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('10.0.0.2', 0)),
+            (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('10.0.0.1', 0)),
+        ]
+
+    loop.getaddrinfo = getaddrinfo  # type: ignore
+
+
+def test_resolver_cache_and_coalescing():
+
+    async def main():
+        calls: list = []
+        _patch_getaddrinfo(asyncio.get_running_loop(), calls)
+        resolver = Resolver(maxsize=2, ttl=60)
+
+        results = await asyncio.gather(*(resolver.resolve('example.test') for _ in range(10)))
+        assert all(r == ['10.0.0.1', '10.0.0.2'] for r in results)
+        assert calls == ['example.test']
+        assert resolver.misses == 1 and resolver.coalesced == 9
+
+        assert await resolver.resolve('example.test') == ['10.0.0.1', '10.0.0.2']
+        assert resolver.hits == 1 and calls == ['example.test']
+
+        assert await resolver.resolve('127.0.0.1') == ['127.0.0.1']
+        assert len(calls) == 1
+
+        # 超出容量时淘汰最久未使用的记录
+        await resolver.resolve('a.test')
+        await resolver.resolve('b.test')
+        assert len(resolver) == 2
+        await resolver.resolve('example.test')
+        assert calls[-1] == 'example.test'
+
+    asyncio.run(main())
+
+
+def test_resolver_negative_cache():
+
+    async def main():
+        calls: list = []
+        _patch_getaddrinfo(asyncio.get_running_loop(), calls)
+        resolver = Resolver(negative_ttl=60)
+        for _ in range(3):
+            with pytest.raises(socket.gaierror):
+                await resolver.resolve('nxdomain.test')
+        assert calls == ['nxdomain.test']
+        assert resolver.hits == 2
+
+    asyncio.run(main())
+
+
+def test_resolver_invalid_idna():
+
+    async def main():
+        resolver = Resolver(negative_ttl=60)
+        # 标签超过 63 个字符, IDNA 编码失败时按解析失败处理
+        host = 'a' * 70 + '.example'
+        for _ in range(2):
+            with pytest.raises(socket.gaierror):
+                await resolver.resolve(host)
+        assert resolver.misses == 1
+        assert resolver.hits == 1
+
+    asyncio.run(main())
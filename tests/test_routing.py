@@ -0,0 +1,142 @@
+import asyncio
+import os
+
+import pytest
+
+from pyproxy.const import RouteAction, UpstreamStrategy
+from pyproxy.errors import RouteRejected
+from pyproxy.routing import Router, RuleSet, _router, parent_name
+from pyproxy.upstream import UpstreamGroup, _upstream, connect
+
+RULES = '''
+# 注释与空行忽略
+domain,www.example.com,reject
+domain-suffix,example.com,direct
+DOMAIN-SUFFIX,ads.example.com,reject
+domain-suffix,cn,direct
+ip-cidr,10.0.0.0/8,direct
+ip-cidr,10.1.0.0/16,reject,no-resolve
+ip-cidr6,fc00::/7,reject
+final,proxy
+'''
+
+
+def test_rule_set_match():
+    rules = RuleSet.parse(RULES.splitlines())
+    assert len(rules) == 7
+    assert rules.match('www.example.com') == RouteAction.REJECT
+    assert rules.match('example.com') == RouteAction.DIRECT
+    assert rules.match('Img.Example.COM.') == RouteAction.DIRECT
+    # 最长后缀优先
+    assert rules.match('x.ads.example.com') == RouteAction.REJECT
+    assert rules.match('ads.example.com') == RouteAction.REJECT
+    assert rules.match('badexample.com') is None
+    assert rules.match('baidu.cn') == RouteAction.DIRECT
+    # 最长前缀优先
+    assert rules.match('10.2.3.4') == RouteAction.DIRECT
+    assert rules.match('10.1.3.4') == RouteAction.REJECT
+    assert rules.match('11.1.3.4') is None
+    assert rules.match('fd00::1') == RouteAction.REJECT
+    assert rules.match('2001:db8::1') is None
+    assert rules.final == RouteAction.PROXY
+
+
+def test_rule_set_invalid():
+    with pytest.raises(ValueError, match='line 2'):
+        RuleSet.parse(['domain,a.com,direct', 'ip-cidr,10.0.0.0/33,direct'])
+    with pytest.raises(ValueError):
+        RuleSet.parse(['domain-suffix,a.com,unknown'])
+    with pytest.raises(ValueError):
+        RuleSet.parse(['geoip,cn,direct'])
+
+
+def test_router_reload(tmp_path):
+    path = tmp_path / 'rules.txt'
+    path.write_text('domain-suffix,example.com,reject\n')
+
+    async def main():
+        router = Router.from_file(str(path))
+        assert router.route('www.example.com') == RouteAction.REJECT
+        assert router.route('example.org') == RouteAction.PROXY
+
+        # 编译失败时保留原有规则
+        path.write_text('domain-suffix,example.com\n')
+        await router.reload()
+        assert router.route('www.example.com') == RouteAction.REJECT
+
+        path.write_text('domain-suffix,example.com,direct\nfinal,reject\n')
+        stat = path.stat()
+        os.utime(path, (stat.st_atime, stat.st_mtime + 1))
+        router.watch(0.01)
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if router.route('www.example.com') == RouteAction.DIRECT:
+                break
+        router.close()
+        assert router.route('www.example.com') == RouteAction.DIRECT
+        assert router.route('example.org') == RouteAction.REJECT
+
+    asyncio.run(main())
+
+
+def test_connect_rejected():
+
+    async def main():
+        _router.set(Router(RuleSet.parse(['ip-cidr,127.0.0.0/8,reject'])))
+        with pytest.raises(RouteRejected):
+            await connect('127.0.0.1', 80)
+
+    asyncio.run(main())
+
+
+def test_connect_named_parent():
+    rules = RuleSet.parse(['domain-suffix,a.test,proxy:one', 'domain-suffix,b.test,Proxy:Two', 'final,direct'])
+    assert parent_name(rules.match('www.a.test')) == 'one'
+    assert parent_name(rules.match('b.test')) == 'two'
+    assert parent_name(RouteAction.PROXY) is None
+    with pytest.raises(ValueError):
+        RuleSet.parse(['domain,a.test,proxy:'])
+
+    async def main():
+        received = []
+
+        def parent(name):
+
+            async def handle(reader, writer):
+                head = await reader.readuntil(b'\r\n\r\n')
+                received.append((name, head.split()[1]))
+                writer.write(b'HTTP/1.1 200 Connection Established\r\n\r\n')
+                writer.write(name.encode())
+                await writer.drain()
+                writer.close()
+
+            return handle
+
+        one = await asyncio.start_server(parent('one'), '127.0.0.1', 0)
+        two = await asyncio.start_server(parent('two'), '127.0.0.1', 0)
+        ports = [server.sockets[0].getsockname()[1] for server in (one, two)]
+        group = UpstreamGroup.from_urls(
+            [f'http://127.0.0.1:{ports[0]}#one', f'http://127.0.0.1:{ports[1]}#Two'], UpstreamStrategy.LEAST_CONN
+        )
+        _upstream.set(group)
+        _router.set(Router(rules))
+        try:
+            # 两条规则分别经由不同的上级代理
+            for host, name in (('www.a.test', 'one'), ('b.test', 'two')):
+                reader, writer, proxy = await connect(host, 443)
+                assert proxy is group.named[name]
+                assert await reader.read() == name.encode()
+                writer.close()
+                proxy.release()
+            assert received == [('one', b'www.a.test:443'), ('two', b'b.test:443')]
+
+            # 规则指定的上级代理不存在时连接失败, 不使用其他代理
+            _router.set(Router(RuleSet.parse(['final,proxy:three'])))
+            with pytest.raises(OSError, match='unknown parent proxy'):
+                await connect('c.test', 443)
+        finally:
+            group.close()
+            one.close()
+            two.close()
+
+    asyncio.run(main())
@@ -0,0 +1,38 @@
+import ssl
+
+from pyproxy.sniff import INCOMPLETE, sniff_host
+
+
+def _client_hello(server_hostname: str) -> bytes:
+    context = ssl.create_default_context()
+    incoming, outgoing = ssl.MemoryBIO(), ssl.MemoryBIO()
+    tls = context.wrap_bio(incoming, outgoing, server_hostname=server_hostname)
+    try:
+        tls.do_handshake()
+    except ssl.SSLWantReadError:
+        pass
+    return outgoing.read()
+
+
+def test_sniff_tls():
+    hello = _client_hello('WWW.Example.com')
+    assert sniff_host(hello) == 'www.example.com'
+    assert sniff_host(bytearray(hello)) == 'www.example.com'
+    # ClientHello 分段到达
+    assert sniff_host(hello[:3]) == INCOMPLETE
+    assert sniff_host(hello[:len(hello) // 2]) == INCOMPLETE
+    # 目标为 IP 时不发送 server_name
+    assert sniff_host(_client_hello('127.0.0.1')) is None
+    # 记录长度小于 ClientHello, 解析不越过记录边界
+    assert sniff_host(hello[:3] + (50).to_bytes(2, 'big') + hello[5:]) is None
+
+
+def test_sniff_http():
+    request = b'GET /index.html HTTP/1.1\r\nUser-Agent: curl\r\nHOST: Example.com:8080\r\n\r\n'
+    assert sniff_host(request) == 'example.com'
+    assert sniff_host(b'GE') == INCOMPLETE
+    assert sniff_host(request[:30]) == INCOMPLETE
+    assert sniff_host(b'GET / HTTP/1.0\r\n\r\n') is None
+    # 其他协议
+    assert sniff_host(b'SSH-2.0-OpenSSH_9.0\r\n') is None
+    assert sniff_host(b'\x00\x01') is None
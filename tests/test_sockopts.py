@@ -0,0 +1,52 @@
+import asyncio
+import socket
+
+from pyproxy.connector import connect_addr
+from pyproxy.sockopts import TCP_DEFER_ACCEPT, TCP_KEEPIDLE, SocketOptions, _socket_options
+
+
+def test_socket_options():
+    options = SocketOptions(nodelay=False, rcvbuf=2**16, keepalive_idle=30, keepalive_interval=5, defer_accept=1)
+
+    async def main():
+        _socket_options.set(options)
+        accepted = asyncio.get_running_loop().create_future()
+
+        async def handle(reader, writer):
+            options.apply(writer.get_extra_info('socket'))
+            accepted.set_result(writer.get_extra_info('socket'))
+            await reader.read()
+            writer.close()
+
+        # 监听 socket 的选项在 listen 之前设置
+        sock = options.create_listen_socket(socket.AF_INET, ('127.0.0.1', 0))
+        server = await asyncio.start_server(handle, sock=sock, backlog=options.backlog)
+        try:
+            # 缓冲区大小在 connect 之前设置
+            reader, writer = await connect_addr('127.0.0.1', sock.getsockname()[1])
+            writer.write(b'x')
+            client = writer.get_extra_info('socket')
+            peer = await asyncio.wait_for(accepted, 5)
+            result = {}
+            for name, s in (('client', client), ('server', peer)):
+                result[name] = (
+                    s.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY),
+                    s.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE),
+                    TCP_KEEPIDLE and s.getsockopt(socket.IPPROTO_TCP, TCP_KEEPIDLE),
+                )
+            # Linux 返回的缓冲区大小为设置值的两倍
+            result['rcvbuf'] = all(s.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= 2**16 for s in (client, peer))
+            result['defer_accept'] = TCP_DEFER_ACCEPT is None or sock.getsockopt(
+                socket.IPPROTO_TCP, TCP_DEFER_ACCEPT
+            ) > 0
+            writer.close()
+            return result
+        finally:
+            server.close()
+
+    result = asyncio.run(main())
+    keepidle = 30 if TCP_KEEPIDLE else None
+    assert result['client'] == (0, 1, keepidle)
+    assert result['server'] == (0, 1, keepidle)
+    assert result['rcvbuf']
+    assert result['defer_accept']
@@ -0,0 +1,62 @@
+import random
+import socket
+import struct
+
+from pyproxy.utils import Socks5ProxyParser
+
+CORPUS = [
+    (b'\x05\x01\x00\x01' + socket.inet_aton('127.0.0.1') + struct.pack('>H', 80), ('127.0.0.1', 80)),
+    (b'\x00\x00\x00\x01' + socket.inet_aton('8.8.8.8') + struct.pack('>H', 53), ('8.8.8.8', 53)),
+    (b'\x05\x01\x00\x04' + socket.inet_pton(socket.AF_INET6, '::1') + struct.pack('>H', 443), ('::1', 443)),
+    (b'\x00\x00\x00\x04' + socket.inet_pton(socket.AF_INET6, '2001:db8::8:1') + struct.pack('>H', 65535),
+     ('2001:db8::8:1', 65535)),
+    (b'\x05\x01\x00\x03\x0bexample.com' + struct.pack('>H', 8080), ('example.com', 8080)),
+    (b'\x00\x00\x00\x03\x01a' + struct.pack('>H', 0), ('a', 0)),
+]
+
+
+def test_parse_corpus():
+    for header, dst in CORPUS:
+        for payload in (b'', b'payload', bytes(range(256))):
+            data = header + payload
+            assert Socks5ProxyParser.parse(data) == (dst, len(header))
+            assert Socks5ProxyParser.unpack(data) == (dst, header, payload)
+
+
+def test_parse_malformed():
+    malformed = [
+        b'',
+        b'\x05',
+        b'\x05\x01\x00',
+        b'\x05\x01\x00\x02' + bytes(6),
+        b'\x05\x01\x00\x01\x7f\x00\x00\x01\x00',
+        b'\x05\x01\x00\x04' + bytes(17),
+        b'\x05\x01\x00\x03\x00\x00\x50',
+        b'\x05\x01\x00\x03\x0bexample.co',
+        b'\x05\x01\x00\x03\x02\xff\xfe\x00\x50',
+    ]
+    for data in malformed:
+        assert Socks5ProxyParser.parse(data) is None, data
+        assert Socks5ProxyParser.unpack(data) == (('', 0), b'', b'')
+
+
+def test_parse_fuzz():
+    rnd = random.Random(0)
+    for _ in range(20000):
+        header, _ = rnd.choice(CORPUS)
+        data = bytearray(header + bytes(rnd.randrange(256) for _ in range(rnd.randrange(8))))
+        for _ in range(rnd.randrange(4)):
+            data[rnd.randrange(len(data))] = rnd.randrange(256)
+        data = bytes(data[:rnd.randrange(len(data) + 1)])
+
+        result = Socks5ProxyParser.parse(data)
+        if result is None:
+            continue
+        dst, end = result
+        assert end <= len(data)
+        assert dst[1] == struct.unpack('>H', data[end - 2:end])[0]
+        if data[3] == Socks5ProxyParser.HOST:
+            assert dst[0].encode() == data[5:end - 2]
+        else:
+            family = socket.AF_INET if data[3] == Socks5ProxyParser.IPV4 else socket.AF_INET6
+            assert socket.inet_pton(family, dst[0]) == data[4:end - 2]
@@ -0,0 +1,28 @@
+from pyproxy.timerwheel import TimerWheel
+
+
+def test_timer_wheel():
+    expired = []
+    wheel = TimerWheel(5, expired.append, resolution=1, now=100)
+    wheel.add('a')
+    wheel.add('b')
+    for now in range(101, 104):
+        wheel.advance(now)
+    assert not expired
+
+    # 活跃的对象按最近活跃时间重新计算超时
+    wheel.touch('b')
+    for now in range(104, 107):
+        wheel.advance(now)
+    assert expired == ['a']
+    for now in range(107, 110):
+        wheel.advance(now)
+    assert expired == ['a', 'b']
+
+    wheel.add('c')
+    wheel.add('d')
+    wheel.remove('d')
+    # 长时间未推进时间
+    wheel.advance(10000)
+    assert expired == ['a', 'b', 'c']
+    assert len(wheel) == 0
@@ -0,0 +1,43 @@
+import asyncio
+
+from pyproxy.protocols.udp import UdpAssociationTable, _udp_associations
+from pyproxy.workers import UdpReleaseBus
+
+
+class _Association:
+
+    closed = False
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.key = addr
+
+    def close(self, reason='closed'):
+        self.closed = True
+
+
+def test_udp_release_bus():
+    bus = UdpReleaseBus(2)
+    dst = ('127.0.0.1', 40000)
+    association = _Association(dst)
+    table = UdpAssociationTable(60)
+
+    # worker 0 发布释放事件, worker 1 收到后释放本地的 UDP 转发
+    bus.bind(0)
+    bus.publish(dst)
+
+    async def receive():
+        _udp_associations.set(table)
+        table.add(association)  # type: ignore
+        bus.bind(1)
+        bus.listen(asyncio.get_running_loop())
+        for _ in range(100):
+            if dst not in table:
+                break
+            await asyncio.sleep(0.01)
+        released = dst not in table
+        table.close()
+        return released
+
+    assert asyncio.run(receive())
+    assert association.closed